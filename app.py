@@ -17,38 +17,91 @@
 
 from flask_admin import Admin
 from config import SECRET_KEY, SQLALCHEMY_DATABASE_URI, INPUT_STAGING_AREA, OUTPUT_STAGING_AREA, \
-    INPUTSET_STAGING_AREA, MAX_USER_JOBS, REMOTE_JOB_STATE_REFRESH_PERIOD, APP_STATIC_URL, APP_LOGFILE, USE_WOS
-from utils import queryresult_to_dict, queryresult_to_array, compute_hash_for_dir_contents
-from flask_sqlalchemy import SQLAlchemy
+    INPUTSET_STAGING_AREA, MAX_USER_JOBS, REMOTE_JOB_STATE_REFRESH_PERIOD, APP_STATIC_URL, APP_LOGFILE, USE_WOS, \
+    QUEUE_SNAPSHOT_REFRESH_PERIOD, USE_PILOT_JOBS, PILOT_MAX_CPUS, PILOT_NUM_CPUS, PILOT_WALLCLOCK_LIMIT, \
+    PILOT_IDLE_TIMEOUT, SUBMISSION_WORKERS, SUBMISSION_MAX_PER_USER, SUBMISSION_MAX_PER_SERVICE, \
+    QUEUED_JOB_DRAIN_PERIOD, WALLTIME_HISTORY, WALLTIME_MIN_SAMPLES, WALLTIME_MARGIN, WALLTIME_PADDING, \
+    SPECULATIVE_STAGING, SPECULATIVE_STAGING_WORKERS, SERVICE_CACHE_MAX_AGE, TEMPLATE_CACHE_MAX_AGE, \
+    PRINCIPAL_CACHE_MAX_AGE, \
+    JOB_LIST_DEFAULT_LIMIT, JOB_LIST_MAX_LIMIT, ARCHIVE_AGE, ARCHIVE_BATCH_SIZE, ARCHIVE_PERIOD
+from utils import queryresult_to_dict, queryresult_to_array, compute_hash_for_dir_contents, count_fluid_sites, \
+    choose_cores, compute_input_hash, compute_file_hash, json_array
 from flask_security import Security, SQLAlchemyUserDatastore, \
     UserMixin, RoleMixin, login_required, utils
 from flask_admin import helpers as admin_helpers
 from flask_admin.contrib import sqla
-from flask import Flask, url_for, redirect, request, abort
+from flask import Flask, url_for, redirect, request, abort, g, Response, stream_with_context, json
 from wtforms import StringField, PasswordField
 from flask_login import current_user
 from flask_security.forms import RegisterForm
-from sqlalchemy.sql import text
 from flask import jsonify
 import uuid
 from flask_admin.contrib.sqla import ModelView
+from sqlalchemy import event
 import os
+import saga
 import saga_utils
+import db_utils
+from db_utils import execute, stream
+import pilot_utils
+from job import PBSProJob
+from submission import SubmissionExecutor, ServiceAdmission
+from service_cache import ServiceCache
+from job_templates import TemplateRegistry, split_arguments, parse_env
+from principal import Principal, PrincipalCache
+import walltime
+import schema
+import job_state
+from job_state import transition, transition_array
+import datetime
 from flask import send_from_directory
 from apscheduler.schedulers.background import BackgroundScheduler
 from saga_utils import stage_output_files, cleanup_directory
 from werkzeug.utils import secure_filename
 import shutil
 import re
+import threading
 from logging.config import dictConfig
 
-from wos_utils import s3_upload, s3_list_files_for_job, get_presigned_url, s3_delete_files_for_job
+from wos_utils import s3_upload, s3_iter_files_for_job, get_presigned_url, s3_delete_files_for_job
 import urllib3
 
 # role definitions
 SUPERUSER_ROLE = 'superuser'
 POWERUSER_ROLE = 'poweruser'
 
+# service name that asks for the least loaded service able to run a job's template
+AUTO_SERVICE = 'auto'
+
+# num_total_cpus value that asks for the job to be sized from its uploaded geometry
+AUTO_CPUS = 'auto'
+
+# wallclock_limit value that asks for the job's walltime to be predicted from earlier runs
+AUTO_WALLTIME = 'auto'
+
+# latest queue snapshot for each service id, refreshed in the background
+queue_snapshots = {}
+
+# held while choosing or starting a pilot, so concurrent submissions share one
+pilot_lock = threading.Lock()
+
+# held while copying a job's input files to its service, so that speculative staging and staging at
+# submission don't copy the same file at once. striped over the job ids to keep the number bounded
+staging_locks = [threading.Lock() for i in range(64)]
+
+# states in which a job is moved to JOB_ARCHIVE once it has been in them for ARCHIVE_AGE days
+ARCHIVABLE_STATES = ['DELETED', 'Done', 'DONE', 'Failed', 'FAILED', 'Canceled', 'STAGING_FAILED']
+
+# the columns of JOB copied to JOB_ARCHIVE, named rather than relying on the two tables' column order
+ARCHIVED_JOB_COLUMNS = ', '.join([c.name for c in schema.job.columns])
+
+# format of the creation time in a job list cursor
+JOB_CURSOR_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# reservation states in which jobs can be routed to the reservation's queue, and states still tracked
+RESERVATION_USABLE_STATES = ['CONFIRMED', 'RUNNING']
+RESERVATION_LIVE_STATES = ['UNCONFIRMED', 'CONFIRMED', 'RUNNING', 'DEGRADED']
+
 
 scheduler = BackgroundScheduler()
 
@@ -92,7 +145,12 @@ admin = Admin(app, name='HemelB Offload Service', template_mode='bootstrap3', ba
 # add database connection
 app.config['SECRET_KEY'] = SECRET_KEY
 app.config['SQLALCHEMY_DATABASE_URI'] = SQLALCHEMY_DATABASE_URI
-db = SQLAlchemy(app)
+db = db_utils.PooledSQLAlchemy(app)
+db_utils.init_app(app, db)
+
+# a local SQLite database is set up by the app itself, rather than from compbiomed.sql
+if db.engine.dialect.name == 'sqlite':
+    schema.create_all(db.engine)
 
 # TODO:
 # if we're using the WOS, should test the setup before we do anything else
@@ -104,6 +162,29 @@ else:
 # possibly a bad idea, but don't want the log full of certificate warnings
 urllib3.disable_warnings()
 
+# job submissions (staging and qsub) run on their own workers, shared fairly between users
+submission_executor = SubmissionExecutor(SUBMISSION_WORKERS, SUBMISSION_MAX_PER_USER, SUBMISSION_MAX_PER_SERVICE,
+                                         app.logger)
+
+# speculative staging runs on workers of its own, so that copying uploads can hold up neither
+# submissions nor the scheduler's refresh and retrieval tasks
+staging_executor = None
+if SPECULATIVE_STAGING:
+    staging_executor = SubmissionExecutor(SPECULATIVE_STAGING_WORKERS, SPECULATIVE_STAGING_WORKERS,
+                                          SPECULATIVE_STAGING_WORKERS, app.logger)
+
+# qsub rate and in-flight limits for each service
+service_admission = ServiceAdmission()
+
+# service configurations, read from the SERVICE table when first needed
+service_cache = ServiceCache(lambda: load_services(), SERVICE_CACHE_MAX_AGE)
+
+# job templates, compiled when first needed and again whenever one is saved or deleted
+template_registry = TemplateRegistry(lambda: execute("SELECT * FROM JOB_TEMPLATE").fetchall(), TEMPLATE_CACHE_MAX_AGE)
+
+# users' ids and roles, kept for a short while between requests
+principal_cache = PrincipalCache(PRINCIPAL_CACHE_MAX_AGE)
+
 
 
 # Define models
@@ -170,6 +251,27 @@ class ServiceModel(db.Model):
         return self.name
 
 
+# the cached service configurations are dropped whenever a change to a service through the ORM is
+# committed. changes are noted when they're flushed, but a reload before the commit would still see
+# the old rows, so the cache is only invalidated after it
+@event.listens_for(db.session, 'after_flush')
+def note_service_changes(session, flush_context):
+    changed = list(session.new) + list(session.dirty) + list(session.deleted)
+    if any([isinstance(o, ServiceModel) for o in changed]):
+        session.info['services_changed'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def services_committed(session):
+    if session.info.pop('services_changed', False):
+        service_cache.invalidate()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def services_rolled_back(session):
+    session.info.pop('services_changed', None)
+
+
 # model for managing job templates
 class JobTemplateModel(db.Model):
 
@@ -187,6 +289,7 @@ class JobTemplateModel(db.Model):
     queue = db.Column(db.String(80))
     arguments = db.Column(db.String(256))
     filter = db.Column(db.String(256))
+    family = db.Column(db.String(45))
 
 
     def __repr__(self):
@@ -202,6 +305,12 @@ class JobTemplateModelView(ModelView):
         if is_created:
             model.user_id = current_user.id
 
+    def after_model_change(self, form, model, is_created):
+        template_registry.invalidate()
+
+    def after_model_delete(self, model):
+        template_registry.invalidate()
+
     def is_accessible(self):
         if current_user.has_role(SUPERUSER_ROLE):
             return True
@@ -251,6 +360,19 @@ def security_context_processor():
         get_url=url_for
     )
 
+
+def get_principal():
+
+    # the user making the current request and their roles, worked out once per request rather than at every check
+    principal = getattr(g, 'principal', None)
+    if principal is None:
+        user_id = int(current_user.get_id())
+        principal = principal_cache.get(user_id, lambda: Principal(user_id,
+                                                                   frozenset([r.name for r in current_user.roles])))
+        g.principal = principal
+    return principal
+
+
 # Create customized model view class
 class UserModelView(sqla.ModelView):
 
@@ -304,9 +426,18 @@ class UserModelView(sqla.ModelView):
             # TODO - put a password strength checker here?
             model.password = utils.hash_password(model.password2)
 
+    def after_model_change(self, form, model, is_created):
+        principal_cache.invalidate(model.id)
+
 
 class RoleModelView(sqla.ModelView):
 
+        def after_model_change(self, form, model, is_created):
+            principal_cache.invalidate()
+
+        def after_model_delete(self, model):
+            principal_cache.invalidate()
+
         def is_accessible(self):
             if not current_user.is_active or not current_user.is_authenticated:
                 return False
@@ -341,31 +472,91 @@ admin.add_view(JobTemplateModelView(JobTemplateModel, db.session))
 def list_jobs():
     # normal users can only see their own jobs
     # super users and power users can see all jobs
-    result = None
-    if current_user.has_role(SUPERUSER_ROLE) or current_user.has_role(POWERUSER_ROLE):
-        cmd = 'SELECT local_job_id, name, state FROM JOB ORDER BY created'
-        result = db.engine.execute(text(cmd))
-    else:
-        cmd = 'SELECT local_job_id, name, state FROM JOB WHERE user_id = :user_id'
-        result = db.engine.execute(text(cmd), user_id=current_user.get_id())
-
-    return jsonify(queryresult_to_array({'local_job_id','name','state'}, result))
-
-@app.route('/jobs',  methods=['POST'])
-@login_required
-def create_new_job():
+    # jobs are listed newest first, a page of up to ?limit= at a time. when there are more, the
+    # X-Next-Cursor header holds the cursor to pass as ?after= for the next page. the list can be
+    # filtered by ?state= (a comma separated list), ?service= and ?created_after= / ?created_before=.
+    # ?archived=true lists the jobs that have been moved to the archive instead
+    table = 'JOB'
+    if request.args.get('archived') == 'true':
+        table = 'JOB_ARCHIVE'
+
+    conditions = []
+    params = {}
+    if not get_principal().has_any_role(SUPERUSER_ROLE, POWERUSER_ROLE):
+        conditions.append('user_id=:user_id')
+        params['user_id'] = get_principal().user_id
+
+    after = request.args.get('after')
+    if after is not None:
+        try:
+            created, id = after.rsplit(',', 1)
+            params['after_created'] = datetime.datetime.strptime(created, JOB_CURSOR_TIME_FORMAT)
+            params['after_id'] = int(id)
+        except ValueError:
+            abort(500, "Invalid cursor " + after)
+        conditions.append('(created < :after_created OR (created = :after_created AND id < :after_id))')
+
+    if 'state' in request.args:
+        conditions.append('state IN :states')
+        params['states'] = request.args.get('state').split(',')
+
+    if 'service' in request.args:
+        service = service_cache.get_by_name(request.args.get('service'))
+        if service is None:
+            abort(404, "No matching service found")
+        conditions.append('service_id=:service_id')
+        params['service_id'] = service['id']
+
+    for arg, op in [('created_after', '>='), ('created_before', '<')]:
+        if arg in request.args:
+            params[arg] = parse_datetime(request.args.get(arg))
+            if params[arg] is None:
+                abort(500, "Invalid date " + request.args.get(arg))
+            conditions.append('created ' + op + ' :' + arg)
+
+    limit = max(1, min(request.args.get('limit', JOB_LIST_DEFAULT_LIMIT, type=int), JOB_LIST_MAX_LIMIT))
+
+    where = ''
+    if len(conditions) > 0:
+        where = ' WHERE ' + ' AND '.join(conditions)
+    order = ' ORDER BY created DESC, id DESC'
+
+    # the last job of the page and whether there's one after it, found first so that the cursor can go in
+    # the headers before the page itself is streamed
+    headers = {}
+    cmd = 'SELECT id, created FROM ' + table + where + order + ' LIMIT 2 OFFSET :offset'
+    bounds = execute(cmd, offset=limit - 1, **params).fetchall()
+    if len(bounds) == 2:
+        created = db_utils.to_datetime(bounds[0]['created'])
+        headers['X-Next-Cursor'] = created.strftime(JOB_CURSOR_TIME_FORMAT) + ',' + str(bounds[0]['id'])
+
+    cmd = 'SELECT local_job_id, name, state FROM ' + table + where + order + ' LIMIT :limit'
+    result = stream(cmd, limit=limit, **params)
+    return json_stream_response(result, ['local_job_id', 'name', 'state'], headers)
+
+
+def json_stream_response(items, keys=None, headers=None):
+
+    # a response with the items as a JSON array, sent as they're read. a request's database connection
+    # stays open until the whole array has been sent, so rows can be read from a server side cursor
+    return Response(stream_with_context(json_array(items, json.dumps, keys)), mimetype='application/json',
+                    headers=headers)
+
+
+def parse_datetime(value):
+
+    # a date, or a date and time, from a query string; None if it isn't one
+    for time_format in [JOB_CURSOR_TIME_FORMAT, '%Y-%m-%d %H:%M', '%Y-%m-%d']:
+        try:
+            return datetime.datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    return None
 
-    # check the user is within their limit
-    cmd = "SELECT COUNT(id) AS TOTAL_JOBS FROM JOB WHERE user_id=:user_id and state!='DELETED'"
-    user_id = current_user.get_id()
-    result = db.engine.execute(text(cmd), user_id=user_id)
-    total_jobs = int(result.fetchone()['TOTAL_JOBS'])
-    if total_jobs >= MAX_USER_JOBS:
-        abort(500, "Maximum number of user jobs exceeded - delete some jobs")
 
-    # look for json job description in payload
+def build_job_spec(payload):
 
-    payload = request.json
+    # turn a json job description into a job spec, taking defaults from a template if one is named
 
     job_spec = {
 
@@ -381,32 +572,41 @@ def create_new_job():
         'queue': None,
         'extended': None,
         'filter': None,
-        'input_set_id': None
+        'input_set_id': None,
+        'auto_cpus': False,
+        'auto_walltime': False,
+        'reuse': False,
+        'hold': False,
+        'template_id': None
     }
 
 
     # if a template has been specified we take all our parameters from the template record and ignore everything else
     template_name = payload.get('template_name')
+    template = None
     if template_name is not None:
 
-        cmd = "SELECT * FROM JOB_TEMPLATE WHERE name=:name"
-        result = db.engine.execute(text(cmd), name=template_name).fetchone()
-        if result is None:
+        template = template_registry.get(template_name)
+        if template is None:
             abort(404, "No matching job template found for name " + template_name)
 
-        job_spec['job_name'] = result['name']
-        job_spec['service_id'] = result['service_id']
-        job_spec['executable'] = result['executable']
-        job_spec['arguments'] = result['arguments']
-        job_spec['env'] = result['env']
-        job_spec['num_total_cpus'] = result['num_total_cpus']
-        job_spec['total_physical_memory'] = result['total_physical_memory']
-        job_spec['wallclock_limit'] = result['wallclock_limit']
-        job_spec['project'] = result['project']
-        job_spec['queue'] = result['queue']
-        job_spec['extended'] = result['extended']
-        job_spec['filter'] = result['filter']
-        job_spec['input_set_id'] = result['input_set_id']
+        if payload.get('service') == AUTO_SERVICE:
+            template = choose_least_loaded_template(template)
+
+        job_spec['job_name'] = template.name
+        job_spec['template_id'] = template.id
+        job_spec['service_id'] = template.service_id
+        job_spec['executable'] = template.executable
+        job_spec['arguments'] = template.arguments
+        job_spec['env'] = template.env
+        job_spec['num_total_cpus'] = template.num_total_cpus
+        job_spec['total_physical_memory'] = template.total_physical_memory
+        job_spec['wallclock_limit'] = template.wallclock_limit
+        job_spec['project'] = template.project
+        job_spec['queue'] = template.queue
+        job_spec['extended'] = template.extended
+        job_spec['filter'] = template.filter
+        job_spec['input_set_id'] = template.input_set_id
 
 
     # now look at the rest of the payload; user-supplied arguments override template arguments
@@ -419,22 +619,22 @@ def create_new_job():
     # for security reasons only powerusers or admins may override other aspects of the job
     # otherwise, any additional information in the payload is ignored
 
-    if current_user.has_role(SUPERUSER_ROLE) or current_user.has_role(POWERUSER_ROLE):
+    if get_principal().has_any_role(SUPERUSER_ROLE, POWERUSER_ROLE):
 
         if 'name' in payload: job_spec['job_name'] = payload['name']
 
         if 'executable' in payload: job_spec['executable'] = payload['executable']
 
-        if 'service' in payload:
-            cmd = 'SELECT id FROM SERVICE where name=:name'
-            result = db.engine.execute(text(cmd), name=payload['service'])
-            job_spec['service_id'] = result.fetchone()['id']
+        if 'service' in payload and payload['service'] != AUTO_SERVICE:
+            job_spec['service_id'] = service_cache.get_by_name(payload['service'])['id']
 
         # look for additional information, will set as NULL if not in payload
 
-        if 'num_total_cpus' in payload: job_spec['num_total_cpus'] = payload.get('num_total_cpus')
+        if 'num_total_cpus' in payload and payload['num_total_cpus'] != AUTO_CPUS:
+            job_spec['num_total_cpus'] = payload.get('num_total_cpus')
         if 'total_physical_memory' in payload: job_spec['total_physical_memory'] = payload.get('total_physical_memory')
-        if 'wallclock_limit' in payload: job_spec['wallclock_limit'] = payload.get('wallclock_limit')
+        if 'wallclock_limit' in payload and payload['wallclock_limit'] != AUTO_WALLTIME:
+            job_spec['wallclock_limit'] = payload.get('wallclock_limit')
         if 'project' in payload: job_spec['project'] = payload.get('project')
         if 'queue' in payload: job_spec['queue'] = payload.get('queue')
         if 'extended' in payload: job_spec['extended'] = payload.get('extended')
@@ -444,8 +644,11 @@ def create_new_job():
             job_spec['filter'] = payload.get('filter')
 
 
-    # sanity check the filter rather than have it fail later
-    if job_spec['filter'] is not None:
+    # sanity check the filter rather than have it fail later. a template's own filter was checked when it was loaded
+    if template is not None and job_spec['filter'] == template.filter:
+        if template.error is not None:
+            abort(500, template.error)
+    elif job_spec['filter'] is not None:
         try:
             re.compile(job_spec['filter'])
         except Exception as e:
@@ -457,33 +660,108 @@ def create_new_job():
     if 'env' in payload:
         env = payload.get('env')
         try:
-            env_list = [str(s) for s in env.split()]
-            env_dict = {}
-            for p in env_list:
-                q = p.split("=")
-                env_dict[q[0]] = q[1]
+            parse_env(env)
             job_spec['env'] = env
         except Exception as e:
             abort(500, "Invalid env specification: " + e.message)
 
+    if payload.get('service') == AUTO_SERVICE and template_name is None:
+        abort(500, "Automatic service selection needs a template name")
 
+    # anyone may ask for the job to be sized from the fluid sites in its geometry file when it is submitted.
+    # the template or payload core count is kept as a fallback
+    if payload.get('num_total_cpus') == AUTO_CPUS:
+        job_spec['auto_cpus'] = True
 
-    job_uuid = str(uuid.uuid4())
+    # likewise anyone may opt in to a walltime predicted from earlier runs of the same template,
+    # which is never longer than the template's
+    if payload.get('wallclock_limit') == AUTO_WALLTIME:
+        job_spec['auto_walltime'] = True
+
+    # a job that asks to reuse results takes the outputs of an earlier job of the user's with
+    # identical inputs, if there is one, rather than running again
+    if payload.get('reuse') is True:
+        job_spec['reuse'] = True
+
+    # a job that asks to be held is queued on the service while its inputs are still being staged
+    if payload.get('hold') is True:
+        job_spec['hold'] = True
+
+    return job_spec
+
+
+def choose_least_loaded_template(template):
+
+    # templates in the same family run the same job on different services.
+    # pick the one whose service we expect to start the job soonest, going by the latest queue snapshots
+
+    if template.family is None:
+        return template
+
+    candidates = template_registry.family(template.family)
+
+    # a service whose scheduler doesn't estimate start times isn't one with no wait. the estimates are only
+    # compared if every known service has one; otherwise the services are ranked on their queued jobs alone
+    snapshots = dict([(c.service_id, queue_snapshots.get(c.service_id)) for c in candidates])
+    use_estimates = all([s['estimated_wait'] is not None for s in snapshots.values() if s is not None])
+
+    def expected_wait(candidate):
+        snapshot = snapshots[candidate.service_id]
+        if snapshot is None:
+            # prefer services we know about over ones we don't
+            return (1, 0, 0)
+        if use_estimates:
+            return (0, snapshot['estimated_wait'], snapshot['queued'])
+        return (0, 0, snapshot['queued'])
+
+    chosen = min(candidates, key=expected_wait)
+    app.logger.info("Template " + template.name + " family " + template.family + ": chose " + chosen.name)
+    return chosen
+
+
+@db_utils.task
+def refresh_queue_snapshots():
+
+    try:
+        for service in service_cache.all():
+            try:
+                queue_snapshots[service['id']] = saga_utils.get_queue_snapshot(service)
+            except Exception as e:
+                app.logger.error("refresh_queue_snapshots:" + e.message)
+                # don't keep choosing a service on stale information
+                queue_snapshots.pop(service['id'], None)
+
+    except Exception as e:
+        app.logger.error(e.message)
 
-    # look up the service name to get the correct id
 
+def check_user_job_limit(user_id, new_jobs=1):
 
-    user_id = current_user.get_id()
+    # check the user is within their limit, and count the new jobs against it. the count is part of the
+    # request's transaction, so it's undone if the jobs aren't created after all
+    # finished jobs still count once they have been archived, until they are deleted
+    if not job_state.admit_jobs(user_id, new_jobs, MAX_USER_JOBS):
+        abort(500, "Maximum number of user jobs exceeded - delete some jobs")
+
+
+def insert_job(user_id, job_spec, array_id=None, array_index=None):
+
+    job_uuid = str(uuid.uuid4())
 
     cmd = 'INSERT INTO JOB(user_id, name, executable, service_id, local_job_id, arguments, num_total_cpus, ' \
-          'total_physical_memory, wallclock_limit, project, queue, filter, extended, env) \
+          'total_physical_memory, wallclock_limit, project, queue, filter, extended, env, array_id, array_index, ' \
+          'auto_cpus, auto_walltime, reuse, hold, template_id) \
         VALUES(:user_id, :name, :executable, :service_id, :local_job_id, :arguments, ' \
-          ':num_total_cpus, :total_physical_memory, :wallclock_limit, :project, :queue, :filter, :extended, :env )'
-    db.engine.execute(text(cmd), user_id=user_id, name=job_spec['job_name'], executable=job_spec['executable'],
-                      service_id=job_spec['service_id'], local_job_id=job_uuid, arguments=job_spec['arguments'],
-                      num_total_cpus=job_spec['num_total_cpus'], total_physical_memory=job_spec['total_physical_memory'],
-                      wallclock_limit=job_spec['wallclock_limit'], project=job_spec['project'], queue=job_spec['queue'],
-                      filter=job_spec['filter'], extended=job_spec['extended'], env=job_spec['env'])
+          ':num_total_cpus, :total_physical_memory, :wallclock_limit, :project, :queue, :filter, :extended, :env, ' \
+          ':array_id, :array_index, :auto_cpus, :auto_walltime, :reuse, :hold, :template_id )'
+    execute(cmd, user_id=user_id, name=job_spec['job_name'], executable=job_spec['executable'],
+            service_id=job_spec['service_id'], local_job_id=job_uuid, arguments=job_spec['arguments'],
+            num_total_cpus=job_spec['num_total_cpus'], total_physical_memory=job_spec['total_physical_memory'],
+            wallclock_limit=job_spec['wallclock_limit'], project=job_spec['project'], queue=job_spec['queue'],
+            filter=job_spec['filter'], extended=job_spec['extended'], env=job_spec['env'],
+            array_id=array_id, array_index=array_index, auto_cpus=job_spec['auto_cpus'],
+            auto_walltime=job_spec['auto_walltime'], reuse=job_spec['reuse'],
+            hold=job_spec['hold'], template_id=job_spec['template_id'])
 
     # create a staging area for this job
     try:
@@ -492,41 +770,136 @@ def create_new_job():
         app.logger.error(e.message)
         abort(500, e.message)
 
+    return job_uuid
+
+
+@app.route('/jobs',  methods=['POST'])
+@login_required
+def create_new_job():
+
+    user_id = get_principal().user_id
+
+    # look for json job description in payload
+
+    payload = request.json
+    job_spec = build_job_spec(payload)
+
+    check_user_job_limit(user_id)
+    job_uuid = insert_job(user_id, job_spec)
+
+    # start copying the input set to the service straight away, rather than when the job is submitted
+    if SPECULATIVE_STAGING and job_spec['input_set_id'] is not None:
+        db_utils.commit()
+        staging_executor.submit(user_id, job_spec['service_id'], stage_speculatively, job_uuid, None)
 
     return str(job_uuid)
 
+
+@app.route('/arrays',  methods=['POST'])
+@login_required
+def create_new_job_array():
+
+    # a job array is a set of jobs that share one job description and differ only in their arguments,
+    # eg a parameter sweep. each member is an ordinary job with its own id, input files and outputs,
+    # but the whole array is submitted to the scheduler with a single qsub
+
+    # setting each member's arguments overrides the template, which only powerusers or admins may do
+    if not get_principal().has_any_role(SUPERUSER_ROLE, POWERUSER_ROLE):
+        abort(403)
+
+    payload = request.json
+    array_arguments = payload.get('array_arguments')
+    if not isinstance(array_arguments, list) or len(array_arguments) == 0:
+        abort(500, "array_arguments must be a non-empty list")
+
+    # each member's arguments are a string, or a list of strings
+    member_arguments = []
+    for arguments in array_arguments:
+        if isinstance(arguments, list) and all([isinstance(a, basestring) for a in arguments]):
+            arguments = ' '.join(arguments)
+        if not isinstance(arguments, basestring):
+            abort(500, "array_arguments must contain strings or lists of strings")
+        member_arguments.append(arguments)
+
+    user_id = get_principal().user_id
+    job_spec = build_job_spec(payload)
+
+    check_user_job_limit(user_id, len(member_arguments))
+
+    array_id = str(uuid.uuid4())
+    job_ids = []
+    for index, arguments in enumerate(member_arguments):
+        job_spec['arguments'] = arguments
+        job_ids.append(insert_job(user_id, job_spec, array_id=array_id, array_index=index))
+
+    return jsonify({'array_id': array_id, 'jobs': job_ids})
+
+
+@app.route('/arrays/<array_id>',  methods=['GET'])
+@login_required
+def get_job_array(array_id):
+
+    cmd = "SELECT local_job_id, name, state, user_id FROM JOB WHERE array_id=:array_id ORDER BY array_index"
+    result = execute(cmd, array_id=array_id).fetchall()
+    if len(result) == 0:
+        # arrays are archived whole
+        cmd = "SELECT local_job_id, name, state, user_id FROM JOB_ARCHIVE WHERE array_id=:array_id " \
+              "ORDER BY array_index"
+        result = execute(cmd, array_id=array_id).fetchall()
+    if len(result) == 0:
+        abort(404)
+
+    if int(result[0]['user_id']) != get_principal().user_id:
+        if not (get_principal().has_any_role(SUPERUSER_ROLE, POWERUSER_ROLE)):
+            abort(403)
+
+    return jsonify(queryresult_to_array({'local_job_id', 'name', 'state'}, result))
+
+
 @app.route('/jobs/<id>/state',  methods=['GET'])
 @login_required
 def get_job_state(id):
     # normal users can only see information about jobs they own
     # power and superusers can see everything
-    cmd = "SELECT state, user_id FROM JOB WHERE local_job_id=:local_job_id"
-    result = db.engine.execute(text(cmd), local_job_id = id).fetchone()
+    result = find_job("state, user_id", id)
     if result is None:
         abort(404)
 
     state = result['state']
     owner = result['user_id']
 
-    if int(owner) != int(current_user.get_id()):
-        if not (current_user.has_role(POWERUSER_ROLE) or current_user.has_role(SUPERUSER_ROLE)):
+    if int(owner) != get_principal().user_id:
+        if not (get_principal().has_any_role(SUPERUSER_ROLE, POWERUSER_ROLE)):
             abort(403)
 
     return state, 200, {'Content-Type': 'text/plain'}
 
 
 
+@app.route('/jobs/<id>/walltime',  methods=['GET'])
+@login_required
+def get_job_walltime(id):
+
+    # the job's wallclock limit, with the limit suggested by earlier runs of its template
+    result = find_job("*", id)
+    if result is None:
+        abort(404)
+
+    if int(result['user_id']) != get_principal().user_id:
+        if not (get_principal().has_any_role(SUPERUSER_ROLE, POWERUSER_ROLE)):
+            abort(403)
+
+    return jsonify({'wallclock_limit': result['wallclock_limit'],
+                    'suggested_wallclock_limit': suggest_walltime(result, result['num_total_cpus'])})
+
+
 @app.route('/templates',  methods=['GET'])
 @login_required
 def get_job_templates():
     # normal users can only see information about jobs they own
     # power and superusers can see everything
-    cmd = "SELECT name, id, description FROM JOB_TEMPLATE ORDER BY name"
-    result = db.engine.execute(text(cmd))
-    if result is None:
-        abort(404)
-
-    return jsonify(queryresult_to_array({'name', 'id', 'description'}, result))
+    templates = [{'name': t.name, 'id': t.id, 'description': t.description} for t in template_registry.all()]
+    return jsonify(templates)
 
 
 
@@ -540,16 +913,17 @@ def get_job_templates():
 def get_job_retrieved(id):
     # normal users can only see information about jobs they own
     # power and superusers can see everything
-    cmd = "SELECT user_id, retrieved FROM JOB WHERE local_job_id=:local_job_id"
-    result = db.engine.execute(text(cmd), local_job_id = id).fetchone()
+    result = find_job("user_id, retrieved", id)
     if result is None:
         abort(404)
 
     retrieved = result['retrieved']
+    if retrieved == job_state.RETRIEVING:
+        retrieved = job_state.NOT_RETRIEVED
     owner = result['user_id']
 
-    if int(owner) != int(current_user.get_id()):
-        if not (current_user.has_role(POWERUSER_ROLE) or current_user.has_role(SUPERUSER_ROLE)):
+    if int(owner) != get_principal().user_id:
+        if not (get_principal().has_any_role(SUPERUSER_ROLE, POWERUSER_ROLE)):
             abort(403)
 
     return str(retrieved), 200, {'Content-Type': 'text/plain'}
@@ -561,14 +935,12 @@ def get_job_description(id):
     # normal users can only see information about jobs they own
     # power and superusers can see everything
 
-    cmd = "SELECT * FROM JOB WHERE local_job_id=:local_job_id"
-    result = db.engine.execute(text(cmd), local_job_id = id)
-    job_record = result.fetchone()
+    job_record = find_job("*", id)
     if job_record is None:
         abort(404)
 
-    if int(job_record['user_id']) != int(current_user.get_id()):
-        if not (current_user.has_role(POWERUSER_ROLE) or current_user.has_role(SUPERUSER_ROLE)):
+    if int(job_record['user_id']) != get_principal().user_id:
+        if not (get_principal().has_any_role(SUPERUSER_ROLE, POWERUSER_ROLE)):
             abort(403)
 
 
@@ -591,18 +963,20 @@ def get_job_description(id):
     return jsonify(jd)
 
 
-def submit_job(id):
+def job_template(job):
 
-    cmd = "SELECT * FROM JOB WHERE local_job_id=:local_job_id"
-    result = db.engine.execute(text(cmd), local_job_id=id).fetchone()
+    # the compiled template a JOB record was created from, or None
+    if job['template_id'] is None:
+        return None
+    return template_registry.get_by_id(job['template_id'])
 
-    if result is None:
-        app.logger.error("Error submitting job, job not found")
-        return
 
-    if result['state'] != "NEW":
-        app.logger.error("Error submitting job, inconsistent state")
-        return
+def job_record_to_description(result):
+
+    # build the description passed to saga_utils from a JOB record. arguments and env the job
+    # took unchanged from its template are already parsed in the template
+
+    template = job_template(result)
 
     jd = {}
     jd['local_job_id'] = result['local_job_id']
@@ -612,10 +986,11 @@ def submit_job(id):
 
     # look for additional information, will set as NULL if not in payload
 
-    if result['arguments'] is not None:
-        arguments = result['arguments']
-        arguments_list =  [str(s) for s in arguments.split()]
-        jd['arguments'] = arguments_list
+    if template is not None and result['arguments'] == template.arguments:
+        if template.argument_list is not None:
+            jd['arguments'] = list(template.argument_list)
+    elif result['arguments'] is not None:
+        jd['arguments'] = split_arguments(result['arguments'])
 
     jd['num_total_cpus'] = result['num_total_cpus']
     jd['total_physical_memory'] = result['total_physical_memory']
@@ -626,228 +1001,991 @@ def submit_job(id):
 
     # if env is specified, we need to turn the arguments into a dict
     # we expect the string to take the form name=value name=value etc
-    if result['env'] is not None:
+    if template is not None and result['env'] == template.env and template.env_dict is not None:
+        jd['environment'] = dict(template.env_dict)
+    elif result['env'] is not None:
         try:
-            env = result['env']
-            env_list = [str(s) for s in env.split()]
-            env_dict = {}
-            for p in env_list:
-                q = p.split("=")
-                env_dict[q[0]] = q[1]
-            jd['environment'] = env_dict
+            jd['environment'] = parse_env(result['env'])
         except Exception as e:
             app.logger.error(e.message)
 
+    return jd
 
-    cmd = "UPDATE JOB SET state=:state WHERE local_job_id=:local_job_id"
-    db.engine.execute(text(cmd), state="STAGING", local_job_id=id)
-
-    local_input_file_dir = os.path.join(INPUT_STAGING_AREA, jd['local_job_id'])
-
-    service_id = result['service_id']
-    service = get_service(service_id)
 
-    if result['input_set_id'] is not None:
-        input_set_dir = os.path.join(INPUTSET_STAGING_AREA, result['input_set_id'])
-        try:
-            saga_utils.stage_input_files(id, input_set_dir, service)
-        except Exception as e:
-            app.logger.error(e.message)
-            cmd = "UPDATE JOB SET state=:state WHERE local_job_id=:local_job_id"
-            db.engine.execute(text(cmd), state="STAGING_FAILED", local_job_id=id)
-            return
+def size_job(job, service):
 
-    # stage any input files uploaded for this job
-    try:
-        saga_utils.stage_input_files(id, local_input_file_dir, service)
-    except Exception as e:
-        app.logger.error(e.message)
-        cmd = "UPDATE JOB SET state=:state WHERE local_job_id=:local_job_id"
-        db.engine.execute(text(cmd), state="STAGING_FAILED", local_job_id=id)
-        return
+    # choose a core count for a job from the fluid sites in its geometry, using the service's
+    # sites-per-core model. falls back to the job's own core count if either is missing
 
-    # kick off the job and get an id for tracking the remote job state
-    remote_job_id = None
-    try:
-        remote_job_id = saga_utils.submit_saga_job(jd, service)
-    except Exception as e:
-        app.logger.error(e.message)
-        cmd = "UPDATE JOB SET state=:state WHERE local_job_id=:local_job_id"
-        db.engine.execute(text(cmd), state="FAILED", local_job_id=id)
-        return
+    num_total_cpus = job['num_total_cpus']
 
-    if remote_job_id != -1:
-        # update database
-        cmd = "UPDATE JOB SET state=:state, remote_job_id=:remote_job_id WHERE local_job_id=:local_job_id"
-        db.engine.execute(text(cmd), state="SUBMITTED", remote_job_id=remote_job_id, local_job_id=id)
+    if job['fluid_sites'] is None:
+        app.logger.info("Job " + job['local_job_id'] + " has no geometry file, not sizing it")
+    elif service['sites_per_core'] is None or service['cores_per_node'] is None or service['known_nodes'] is None:
+        app.logger.info("Service " + service['name'] + " has no sizing model, not sizing job " + job['local_job_id'])
     else:
-        cmd = "UPDATE JOB SET state=:state WHERE local_job_id=:local_job_id"
-        db.engine.execute(text(cmd), state="FAILED", local_job_id=id)
+        known_nodes = [int(n) for n in service['known_nodes'].split(',')]
+        num_total_cpus = choose_cores(job['fluid_sites'], service['sites_per_core'], service['cores_per_node'],
+                                      known_nodes)
 
+        cmd = "UPDATE JOB SET num_total_cpus=:num_total_cpus WHERE local_job_id=:local_job_id"
+        execute(cmd, num_total_cpus=num_total_cpus, local_job_id=job['local_job_id'])
+        app.logger.info("Job " + job['local_job_id'] + " with " + str(job['fluid_sites']) + " fluid sites sized to "
+                        + str(num_total_cpus) + " cores")
 
-@app.route('/jobs/<id>/submit',  methods=['POST'])
-@login_required
-def handle_submit_job(id):
+    return num_total_cpus
 
-    # only the owner of a job can submit it
 
-    cmd = "SELECT * FROM JOB WHERE local_job_id=:local_job_id"
-    result = db.engine.execute(text(cmd), local_job_id=id).fetchone()
+def reuse_earlier_outputs(job):
 
-    if result is None:
-        abort(404)
+    # record a hash of the job's inputs. if the job asked to reuse results and the user has an earlier,
+    # completed job with the same hash, this job is finished straight away with that job's outputs
+    # and returns True
 
-    if(int(result['user_id']) != int(current_user.get_id())):
-        abort(403)
+    dirs = [os.path.join(INPUT_STAGING_AREA, job['local_job_id'])]
+    if job['input_set_id'] is not None:
+        dirs.append(os.path.join(INPUTSET_STAGING_AREA, str(job['input_set_id'])))
+    fields = [job['service_id'], job['name'], job['executable'], job['arguments'], job['env'],
+              job['num_total_cpus'], job['auto_cpus'], job['extended'], job['filter']]
+    input_hash = compute_input_hash(dirs, fields)
 
-    if result['state'] != "NEW":
-        abort("inconsistent state", 500)
+    cmd = "UPDATE JOB SET input_hash=:input_hash WHERE local_job_id=:local_job_id"
+    execute(cmd, input_hash=input_hash, local_job_id=job['local_job_id'])
 
-    scheduler.add_job(submit_job, args=[id])
+    if not job['reuse']:
+        return False
 
-    return 'Success', 200, {'Content-Type': 'text/plain'}
+    cmd = "SELECT local_job_id, reused_from FROM JOB WHERE user_id=:user_id AND input_hash=:input_hash " \
+          "AND state IN ('Done', 'DONE') AND retrieved=1 AND local_job_id!=:local_job_id ORDER BY id DESC"
+    earlier = execute(cmd, user_id=job['user_id'], input_hash=input_hash,
+                      local_job_id=job['local_job_id']).fetchone()
+    if earlier is None:
+        return False
 
+    # alias the job that owns the outputs, not another alias of it
+    output_job_id = earlier['reused_from'] or earlier['local_job_id']
+    if not transition(job['local_job_id'], [job_state.STAGING], "Done", retrieved=job_state.RETRIEVED,
+                      reused_from=output_job_id):
+        return True
+    app.logger.info("Job " + job['local_job_id'] + " reuses the outputs of job " + output_job_id)
 
+    # nothing will run, so remove anything staged speculatively
+    cmd = "SELECT COUNT(id) AS STAGED_FILES FROM STAGED_FILE WHERE local_job_id=:local_job_id"
+    if int(execute(cmd, local_job_id=job['local_job_id']).fetchone()['STAGED_FILES']) > 0:
+        try:
+            service = get_service(job['service_id'])
+            cleanup_directory(os.path.join(service['working_directory'], job['local_job_id']), service)
+        except Exception as e:
+            app.logger.error("SAGA: error cleaning up directory:" + e.message)
 
-@app.route('/jobs/<id>/files',  methods=['POST'])
-@login_required
-def add_file_to_job(id):
-    # first check the job exists
-    cmd = "SELECT local_job_id, user_id FROM JOB WHERE local_job_id=:local_job_id"
-    result = db.engine.execute(text(cmd), local_job_id=id)
-    r = result.fetchone()
-    if r is None:
-        abort(404)
-    local_job_id = r['local_job_id']
-    user_id = r['user_id']
-    if int(r['user_id']) != int(current_user.get_id()):
-        abort(403)
+    return True
 
-    print("Uploading files for job " + local_job_id)
 
-    for f in request.files:
-        file = request.files[f]
-        print(f)
-        file_path = os.path.join(INPUT_STAGING_AREA, local_job_id, secure_filename(f))
-        print("upload path is " + file_path)
-        file.save(file_path)
-        try:
-            print(os.path.getsize(file_path))
-        except Exception as e:
-            print(e)
+def outputs_in_use(output_job_id, local_job_id):
 
-    return 'Success', 200, {'Content-Type': 'text/plain'}
+    # whether any job other than the given one still needs the outputs owned by output_job_id
+    for table in ['JOB', 'JOB_ARCHIVE']:
+        cmd = "SELECT COUNT(id) AS USERS FROM " + table + " WHERE state!='DELETED' AND local_job_id!=:local_job_id " \
+              "AND (local_job_id=:output_job_id OR reused_from=:output_job_id)"
+        result = execute(cmd, local_job_id=local_job_id, output_job_id=output_job_id)
+        if int(result.fetchone()['USERS']) > 0:
+            return True
+    return False
 
-@app.route('/jobs/<id>/files',  methods=['GET'])
-@login_required
-def get_job_output_file_list(id):
 
-    # quickly check if the job id is real
-    cmd = "SELECT local_job_id, user_id FROM JOB WHERE local_job_id=:local_job_id"
-    result = db.engine.execute(text(cmd), local_job_id=id)
-    r = result.fetchone()
-    if r is None:
-        abort(404)
-    local_job_id = r['local_job_id']
-    user_id = r['user_id']
+def suggest_walltime(job, num_total_cpus):
 
-    # normal users can only see their own jobs
-    if int(user_id) != int(current_user.get_id()):
-        if not ( current_user.has_role(SUPERUSER_ROLE) or current_user.has_role(POWERUSER_ROLE)):
-            abort(403)
+    # a wallclock limit in minutes for a job, predicted from the recorded run times of earlier
+    # successful jobs of the same template on the same service, or None if there are too few.
+    # jobs are matched on the template they were created from rather than their name, which
+    # powerusers may change; jobs created without a template have no history
 
-    # list the files in the job's output directory
-    # in the case of Azure we would list the output storage container
+    if job['template_id'] is None:
+        return None
 
-    #filelist = []
-    #base_dir = os.path.join(OUTPUT_STAGING_AREA, local_job_id)
-    #for path, subdirs, files in os.walk(base_dir):
-    #    for name in files:
-    #        filelist.append( os.path.join(path, name).replace(base_dir+"/",''))
+    # the history goes back into the archive, for templates that haven't been run for a while
+    cmd = "SELECT * FROM (SELECT id, fluid_sites, num_total_cpus, runtime FROM JOB WHERE service_id=:service_id " \
+          "AND template_id=:template_id AND runtime IS NOT NULL AND state IN ('Done', 'DONE') " \
+          "ORDER BY id DESC LIMIT :history) j " \
+          "UNION ALL " \
+          "SELECT * FROM (SELECT id, fluid_sites, num_total_cpus, runtime FROM JOB_ARCHIVE " \
+          "WHERE service_id=:service_id AND template_id=:template_id AND runtime IS NOT NULL " \
+          "AND state IN ('Done', 'DONE') ORDER BY id DESC LIMIT :history) a " \
+          "ORDER BY id DESC LIMIT :history"
+    result = execute(cmd, service_id=job['service_id'], template_id=job['template_id'], history=WALLTIME_HISTORY)
+    samples = [(r['fluid_sites'], r['num_total_cpus'], r['runtime']) for r in result]
 
+    try:
+        num_total_cpus = int(num_total_cpus)
+    except (TypeError, ValueError):
+        num_total_cpus = None
 
-    # list the files from the WOS
-    if USE_WOS == True:
-        filelist = s3_list_files_for_job(local_job_id)
-        return jsonify(filelist)
-    else:
-        filelist = []
-        base_dir = os.path.join(OUTPUT_STAGING_AREA, local_job_id)
-        for path, subdirs, files in os.walk(base_dir):
-            for name in files:
-                filelist.append( os.path.join(path, name).replace(base_dir+"/",''))
-                return jsonify(filelist)
+    return walltime.suggest_wallclock_limit(samples, job['fluid_sites'], num_total_cpus, job['wallclock_limit'],
+                                            WALLTIME_MIN_SAMPLES, WALLTIME_MARGIN, WALLTIME_PADDING)
 
 
+def fit_walltime(job, num_total_cpus):
 
+    # apply the suggested walltime to a job that opted in, keeping its own if there is no suggestion
 
-@app.route('/jobs/<job_id>/files/<path:path>',  methods=['GET'])
-@login_required
-def get_job_output_file(job_id, path):
+    wallclock_limit = suggest_walltime(job, num_total_cpus)
+    if wallclock_limit is None:
+        app.logger.info("Too few earlier runs to predict walltime for job " + job['local_job_id'])
+        return job['wallclock_limit']
 
-    # quickly check if the job id is real
-    cmd = "SELECT local_job_id, user_id FROM JOB WHERE local_job_id=:local_job_id"
-    result = db.engine.execute(text(cmd), local_job_id=job_id)
-    r = result.fetchone()
-    if r is None:
-        abort(404)
-    local_job_id = r['local_job_id']
-    user_id = r['user_id']
+    cmd = "UPDATE JOB SET wallclock_limit=:wallclock_limit WHERE local_job_id=:local_job_id"
+    execute(cmd, wallclock_limit=wallclock_limit, local_job_id=job['local_job_id'])
+    app.logger.info("Job " + job['local_job_id'] + " walltime set to " + str(wallclock_limit) + " minutes")
 
-    if int(user_id) != int(current_user.get_id()):
-        abort(403)
+    return wallclock_limit
 
-    # check if the requested file exists
-    # we need a check to see if we are listing normal files or redirecting to WOS
 
-    if USE_WOS == True:
-        key_path = os.path.join(job_id, path)
-        url = get_presigned_url(key_path)
-        return redirect(url, code=302)
-    else:
-        exists = os.path.isfile(os.path.join(OUTPUT_STAGING_AREA, local_job_id, path))
-        if not exists:
-           abort(404)
+def record_runtime(local_job_id, remote_job_id, service):
 
-    return send_from_directory(directory=os.path.join(OUTPUT_STAGING_AREA, local_job_id), filename=path)
+    # keep how long a finished job actually ran, to predict the walltime of later ones.
+    # jobs run in a pilot aren't recorded, as PBS only knows about the pilot
+    if pilot_utils.get_pilot_id(remote_job_id) is not None:
+        return
 
+    runtime = saga_utils.get_remote_walltime(remote_job_id, service)
+    if runtime is not None:
+        cmd = "UPDATE JOB SET runtime=:runtime WHERE local_job_id=:local_job_id"
+        execute(cmd, runtime=runtime, local_job_id=local_job_id)
 
-@app.route('/jobs/<id>', methods=['DELETE'])
-@login_required
-def delete_job(id):
 
-    try:
+@db_utils.task
+def submit_job(id):
 
-        # check ownership of the job
-        cmd = "SELECT user_id, service_id, remote_job_id, state, retrieved FROM JOB WHERE local_job_id = :local_job_id"
-        result = db.engine.execute(text(cmd), local_job_id=id)
-        r = result.fetchone()
-        if r is None:
-            return "Resource not found", 404, {'Content-Type': 'text/plain'}
+    cmd = "SELECT * FROM JOB WHERE local_job_id=:local_job_id"
+    result = execute(cmd, local_job_id=id).fetchone()
 
-        if int(r['user_id']) != int(current_user.get_id()):
-            if not ( current_user.has_role(SUPERUSER_ROLE)):
-                return "Permission Denied", 403, {'Content-Type': 'text/plain'}
+    if result is None:
+        app.logger.error("Error submitting job, job not found")
+        return
 
+    # taking the job from NEW makes this the only submission of it, however many times it was asked for
+    if not transition(id, [job_state.NEW], job_state.STAGING):
+        app.logger.error("Error submitting job, inconsistent state")
+        return
 
-        # if the job is already set as deleted, ignore this request
-        if r['state'] == 'DELETED':
-            return 200
+    if reuse_earlier_outputs(result):
+        return
 
-        service = get_service(r['service_id'])
+    jd = job_record_to_description(result)
 
-        # only do remote cleanup if not already done
-        if r['retrieved'] != 1:
+    local_input_file_dir = os.path.join(INPUT_STAGING_AREA, jd['local_job_id'])
 
+    service_id = result['service_id']
+    service = get_service(service_id)
 
+    if result['auto_cpus']:
+        jd['num_total_cpus'] = size_job(result, service)
 
-            # kill the remote job if still running
+    if result['auto_walltime']:
+        jd['wallclock_limit'] = fit_walltime(result, jd['num_total_cpus'])
 
-            remote_job_id = r['remote_job_id']
+    reservation_queue = route_to_reservation([result], service_id, jd)
+    use_pilot = reservation_queue is None and can_use_pilot(jd)
+
+    # a job that asked to be held is qsubbed before its inputs are staged, so that staging overlaps
+    # its wait in the queue, and released once staging is done
+    held_job_id = None
+    if result['hold'] and not use_pilot and admit_job(service_id, service):
+        held_job_id = submit_held_job(id, jd, service_id, service)
+        if held_job_id is None:
+            return
+
+    if result['input_set_id'] is not None:
+        input_set_dir = os.path.join(INPUTSET_STAGING_AREA, str(result['input_set_id']))
+        try:
+            stage_files(id, input_set_dir, service_id, service)
+        except Exception as e:
+            app.logger.error(e.message)
+            staging_failed(id, held_job_id, service)
+            return
+
+    # stage any input files uploaded for this job, other than those already copied speculatively
+    try:
+        stage_files(id, local_input_file_dir, service_id, service)
+    except Exception as e:
+        app.logger.error(e.message)
+        staging_failed(id, held_job_id, service)
+        return
+
+    if held_job_id is not None:
+        release_held_job(id, held_job_id, service)
+        return
+
+    # jobs going to a pilot don't need a qsub of their own; others wait their turn if the service is busy
+    if not use_pilot and not admit_job(service_id, service):
+        app.logger.info("Service " + service['name'] + " is busy, queueing job " + id)
+        transition(id, [job_state.STAGING], job_state.QUEUED)
+        return
+
+    launch_job(id, jd, service_id, service, use_pilot)
+
+
+def submit_held_job(id, jd, service_id, service):
+
+    # qsub a job on hold, before its inputs are staged. returns its remote job id, or None if it
+    # couldn't be submitted. the job must already have been admitted to the service
+
+    jd['hold'] = True
+    remote_job_id = -1
+    try:
+        remote_job_id = saga_utils.submit_saga_job(jd, service)
+    except Exception as e:
+        app.logger.error(e.message)
+    finally:
+        service_admission.release(service_id)
+
+    if remote_job_id == -1:
+        transition(id, [job_state.STAGING], job_state.FAILED)
+        return None
+
+    # the job stays STAGING until it is released
+    if not transition(id, [job_state.STAGING], job_state.STAGING, remote_job_id=remote_job_id):
+        # deleted while it was being submitted
+        cancel_superseded_job(remote_job_id, service)
+        return None
+    return remote_job_id
+
+
+def release_held_job(id, held_job_id, service):
+
+    try:
+        saga_utils.release_job(held_job_id, service)
+    except Exception as e:
+        app.logger.error(e.message)
+        try:
+            saga_utils.cancel_job(held_job_id, service)
+        except Exception as e:
+            app.logger.error("SAGA: error cancelling job:" + e.message)
+        transition(id, [job_state.STAGING], job_state.FAILED)
+        return
+
+    if not transition(id, [job_state.STAGING], job_state.SUBMITTED):
+        cancel_superseded_job(held_job_id, service)
+
+
+def staging_failed(id, held_job_id, service):
+
+    # a held job whose inputs could not be staged will never be released, so delete it
+    if held_job_id is not None:
+        try:
+            saga_utils.cancel_job(held_job_id, service)
+        except Exception as e:
+            app.logger.error("SAGA: error cancelling job:" + e.message)
+
+    transition(id, [job_state.STAGING], job_state.STAGING_FAILED)
+
+
+@db_utils.task
+def launch_job(id, jd, service_id, service, use_pilot):
+
+    # kick off the job and get an id for tracking the remote job state
+    remote_job_id = None
+    try:
+        if use_pilot:
+            remote_job_id = submit_job_to_pilot(jd, service_id, service)
+        else:
+            remote_job_id = saga_utils.submit_saga_job(jd, service)
+    except Exception as e:
+        app.logger.error(e.message)
+        transition(id, [job_state.STAGING], job_state.FAILED)
+        return
+    finally:
+        if not use_pilot:
+            service_admission.release(service_id)
+
+    if remote_job_id != -1:
+        # update database
+        if not transition(id, [job_state.STAGING], job_state.SUBMITTED, remote_job_id=remote_job_id):
+            cancel_superseded_job(remote_job_id, service)
+    else:
+        transition(id, [job_state.STAGING], job_state.FAILED)
+
+
+def cancel_superseded_job(remote_job_id, service):
+
+    # a job was deleted while it was being submitted, so nothing will track the remote job; cancel it
+    app.logger.info("Job " + str(remote_job_id) + " was deleted while being submitted, cancelling it")
+    try:
+        error = cancel_remote_jobs([remote_job_id], service).get(remote_job_id)
+    except Exception as e:
+        error = e.message
+    if error is not None:
+        app.logger.error("SAGA: error cancelling job:" + error)
+
+
+def admit_job(service_id, service):
+
+    # whether a qsub to the service is allowed now, within its rate and in-flight limits.
+    # a job that is admitted must be released once its qsub is done
+
+    cmd = "SELECT COUNT(id) AS SUBMITTED_JOBS FROM JOB WHERE service_id=:service_id AND state='SUBMITTED' " \
+          "AND remote_job_id NOT LIKE :pilot_task"
+    result = execute(cmd, service_id=service_id, pilot_task=pilot_utils.PILOT_TASK_PREFIX + '%')
+    submitted = int(result.fetchone()['SUBMITTED_JOBS'])
+
+    return service_admission.admit(service_id, submitted, max_in_flight=service['max_in_flight'],
+                                   rate=service['qsub_rate'], burst=service['qsub_burst'])
+
+
+@db_utils.task
+def drain_queued_jobs():
+
+    # submit jobs left QUEUED by a busy service, oldest first, as the service's limits allow.
+    # their input files are already staged. the qsubs themselves run on the submission workers,
+    # so as not to hold up the scheduler's thread
+
+    try:
+        cmd = "SELECT * FROM JOB WHERE state='QUEUED' ORDER BY last_modified, id"
+        result = execute(cmd).fetchall()
+
+        busy_services = set()
+        drained_arrays = set()
+
+        for r in result:
+            service_id = r['service_id']
+            if service_id in busy_services or r['array_id'] in drained_arrays:
+                continue
+
+            try:
+                service = get_service(service_id)
+
+                if r['array_id'] is None:
+                    jd = job_record_to_description(r)
+                    use_pilot = route_to_reservation([r], service_id, jd) is None and can_use_pilot(jd)
+                    if not use_pilot and not admit_job(service_id, service):
+                        busy_services.add(service_id)
+                        continue
+                    # another drain, or a delete, may have taken the job since it was read
+                    if not transition(r['local_job_id'], [job_state.QUEUED], job_state.STAGING):
+                        if not use_pilot:
+                            service_admission.release(service_id)
+                        continue
+                    submission_executor.submit(r['user_id'], service_id, launch_job, r['local_job_id'], jd,
+                                               service_id, service, use_pilot)
+                else:
+                    drained_arrays.add(r['array_id'])
+                    if not admit_job(service_id, service):
+                        busy_services.add(service_id)
+                        continue
+                    # jobs of the array cancelled or deleted while it was queued are left out of it
+                    subjobs = job_state.claim_array(r['array_id'], [job_state.QUEUED], job_state.STAGING)
+                    if len(subjobs) == 0:
+                        service_admission.release(service_id)
+                        continue
+                    try:
+                        jd = job_array_description([m for index, m in subjobs])
+                    except ValueError as e:
+                        service_admission.release(service_id)
+                        app.logger.error("Error submitting job array " + r['array_id'] + ": " + str(e))
+                        transition_array(r['array_id'], [job_state.STAGING], job_state.FAILED)
+                        continue
+                    submission_executor.submit(r['user_id'], service_id, launch_job_array, r['array_id'], subjobs,
+                                               jd, service_id, service)
+
+            except Exception as e:
+                app.logger.error("drain_queued_jobs:" + e.message)
+
+    except Exception as e:
+        app.logger.error(e.message)
+
+
+def route_to_reservation(jobs, service_id, jd):
+
+    # send jobs to the queue of their owner's reservation on the service, if they have one that is
+    # confirmed and long enough to run them. returns the queue, or None if the jobs are not reserved
+
+    queue = get_reservation_queue(jobs[0]['user_id'], service_id, jd.get('wallclock_limit'))
+    if queue is None:
+        return None
+
+    jd['queue'] = queue
+    cmd = "UPDATE JOB SET queue=:queue WHERE local_job_id=:local_job_id"
+    for job in jobs:
+        execute(cmd, queue=queue, local_job_id=job['local_job_id'])
+    return queue
+
+
+def get_reservation_queue(user_id, service_id, wallclock_limit):
+
+    cmd = "SELECT queue, start_time, end_time FROM RESERVATION WHERE user_id=:user_id AND service_id=:service_id " \
+          "AND state IN :states AND end_time > :now ORDER BY start_time"
+    now = datetime.datetime.now()
+    result = execute(cmd, user_id=user_id,
+                     service_id=service_id, states=RESERVATION_USABLE_STATES, now=now).fetchall()
+
+    for r in result:
+        if r['queue'] is None:
+            continue
+        try:
+            walltime = datetime.timedelta(minutes=int(wallclock_limit or 0))
+        except ValueError:
+            walltime = datetime.timedelta(0)
+        if max(now, db_utils.to_datetime(r['start_time'])) + walltime <= db_utils.to_datetime(r['end_time']):
+            return r['queue']
+
+    return None
+
+
+def can_use_pilot(jd):
+
+    # only small, short jobs with no scheduler-specific directives are packed into a pilot
+
+    if not USE_PILOT_JOBS or jd.get('extended') is not None:
+        return False
+    if jd.get('num_total_cpus') is None or int(jd['num_total_cpus']) > PILOT_MAX_CPUS:
+        return False
+    try:
+        return jd.get('wallclock_limit') is None or int(jd['wallclock_limit']) < PILOT_WALLCLOCK_LIMIT
+    except ValueError:
+        return False
+
+
+def submit_job_to_pilot(jd, service_id, service):
+
+    # dispatch a job to the pilot running on the service for the job's project and queue,
+    # starting one if there is none or if the newest one hasn't enough of its allocation left
+    # to run the job. a pilot that has stopped taking work is retired and the job goes to a
+    # new one. returns the remote job id used to track the job
+
+    with pilot_lock:
+        cmd = "SELECT pilot_id, created FROM PILOT WHERE service_id=:service_id AND state='SUBMITTED' " \
+              "AND (project=:project OR (project IS NULL AND :project IS NULL)) " \
+              "AND (queue=:queue OR (queue IS NULL AND :queue IS NULL)) ORDER BY created DESC"
+        result = execute(cmd, service_id=service_id, project=jd.get('project'),
+                         queue=jd.get('queue')).fetchone()
+
+        # a pilot without enough of its allocation left is told to stop once its running jobs finish,
+        # rather than sitting idle until its idle timeout while newer pilots take the work
+        if result is not None and pilot_time_left(result['created']) < pilot_time_needed(jd):
+            stop_pilot(result['pilot_id'], service)
+            result = None
+
+        if result is not None:
+            try:
+                return pilot_utils.dispatch_task(result['pilot_id'], jd, service)
+            except Exception as e:
+                app.logger.error(e.message)
+                cmd = "UPDATE PILOT SET state=:state WHERE pilot_id=:pilot_id"
+                execute(cmd, state="STOPPED", pilot_id=result['pilot_id'])
+
+        pilot_id = str(uuid.uuid4())
+        remote_job_id = pilot_utils.start_pilot(pilot_id, service, PILOT_NUM_CPUS, PILOT_WALLCLOCK_LIMIT,
+                                                PILOT_NUM_CPUS // PILOT_MAX_CPUS, PILOT_IDLE_TIMEOUT,
+                                                project=jd.get('project'), queue=jd.get('queue'))
+        if remote_job_id == -1:
+            raise Exception("Error submitting pilot to service " + service['name'])
+
+        cmd = "INSERT INTO PILOT (pilot_id, service_id, remote_job_id, state, project, queue) " \
+              "VALUES (:pilot_id, :service_id, :remote_job_id, :state, :project, :queue)"
+        execute(cmd, pilot_id=pilot_id, service_id=service_id, remote_job_id=remote_job_id,
+                state="SUBMITTED", project=jd.get('project'), queue=jd.get('queue'))
+        app.logger.info("Started pilot " + pilot_id + " as " + remote_job_id)
+
+        return pilot_utils.dispatch_task(pilot_id, jd, service)
+
+
+def stop_pilot(pilot_id, service):
+
+    # ask a pilot to take no more work and retire it. refresh_pilot_states cleans it up once its
+    # allocation ends
+    try:
+        pilot_utils.stop_pilot(pilot_id, service)
+    except Exception as e:
+        app.logger.error("Error stopping pilot " + pilot_id + ": " + e.message)
+    cmd = "UPDATE PILOT SET state=:state WHERE pilot_id=:pilot_id"
+    execute(cmd, state="STOPPED", pilot_id=pilot_id)
+
+
+def pilot_time_left(created):
+
+    # the least time a pilot's allocation has left. it can't have started before the pilot was created
+    return db_utils.to_datetime(created) + datetime.timedelta(minutes=PILOT_WALLCLOCK_LIMIT) - \
+        datetime.datetime.now()
+
+
+def pilot_time_needed(jd):
+
+    # a job with no wallclock limit of its own runs until the pilot ends, so needs only a pilot that hasn't
+    if jd.get('wallclock_limit') is None:
+        return datetime.timedelta(0)
+    return datetime.timedelta(minutes=int(jd['wallclock_limit']))
+
+
+def get_pilot_task_states(pilot_id, service):
+
+    # the state of every job dispatched to a pilot. once the pilot's allocation has ended, jobs it
+    # was running have failed, and jobs it never started are dispatched again to a new pilot
+
+    states = pilot_utils.get_task_states(pilot_id, service)
+
+    cmd = "SELECT remote_job_id, service_id FROM PILOT WHERE pilot_id=:pilot_id"
+    result = execute(cmd, pilot_id=pilot_id).fetchone()
+    if result is None:
+        return states
+
+    pilot_state = saga_utils.get_remote_job_state(result['remote_job_id'], service)
+    if pilot_state not in [saga.job.DONE, saga.job.FAILED, saga.job.CANCELED]:
+        return states
+
+    cmd = "UPDATE PILOT SET state=:state WHERE pilot_id=:pilot_id"
+    execute(cmd, state="FINISHED", pilot_id=pilot_id)
+
+    for local_job_id, state in states.items():
+        if state == saga.job.RUNNING:
+            states[local_job_id] = saga.job.FAILED
+        elif state == saga.job.PENDING:
+            cmd = "SELECT * FROM JOB WHERE local_job_id=:local_job_id AND state='SUBMITTED'"
+            job = execute(cmd, local_job_id=local_job_id).fetchone()
+            if job is None:
+                continue
+            try:
+                remote_job_id = submit_job_to_pilot(job_record_to_description(job), result['service_id'], service)
+                if not transition(local_job_id, [job_state.SUBMITTED], job_state.SUBMITTED,
+                                  remote_job_id=remote_job_id):
+                    cancel_superseded_job(remote_job_id, service)
+            except Exception as e:
+                app.logger.error(e.message)
+                states[local_job_id] = saga.job.FAILED
+
+    try:
+        cleanup_directory(pilot_utils.get_pilot_dir(pilot_id, service), service)
+    except Exception as e:
+        app.logger.error("SAGA: error cleaning up directory:" + e.message)
+
+    return states
+
+
+@db_utils.task
+def refresh_pilot_states():
+
+    # retire pilots that have ended with no jobs left in them, eg on reaching their idle timeout.
+    # pilots still running jobs are retired when those jobs are refreshed. once pilot jobs have been
+    # turned off, idle pilots are stopped rather than left to time out
+    try:
+        cmd = "SELECT remote_job_id FROM JOB WHERE state='SUBMITTED' AND remote_job_id LIKE :pilot_task"
+        busy = set([pilot_utils.get_pilot_id(r['remote_job_id'])
+                    for r in execute(cmd, pilot_task=pilot_utils.PILOT_TASK_PREFIX + '%')])
+
+        cmd = "SELECT pilot_id, remote_job_id, service_id, state FROM PILOT WHERE state IN ('SUBMITTED', 'STOPPED')"
+        for r in execute(cmd).fetchall():
+            if r['pilot_id'] in busy:
+                continue
+            try:
+                service = get_service(r['service_id'])
+                if not USE_PILOT_JOBS and r['state'] == 'SUBMITTED':
+                    stop_pilot(r['pilot_id'], service)
+
+                pilot_state = saga_utils.get_remote_job_state(r['remote_job_id'], service)
+                if pilot_state not in [saga.job.DONE, saga.job.FAILED, saga.job.CANCELED]:
+                    continue
+
+                cmd = "UPDATE PILOT SET state=:state WHERE pilot_id=:pilot_id"
+                execute(cmd, state="FINISHED", pilot_id=r['pilot_id'])
+                cleanup_directory(pilot_utils.get_pilot_dir(r['pilot_id'], service), service)
+            except Exception as e:
+                app.logger.error("refresh_pilot_states:" + e.message)
+    except Exception as e:
+        app.logger.error(e.message)
+
+
+def cancel_remote_jobs(remote_job_ids, service):
+
+    # cancel jobs on one service, whether they are PBS jobs or running in a pilot.
+    # returns a dict of remote job id to None on success, or an error
+
+    pbs_job_ids = []
+    pilot_jobs = {}
+    for remote_job_id in remote_job_ids:
+        pilot_id = pilot_utils.get_pilot_id(remote_job_id)
+        if pilot_id is None:
+            pbs_job_ids.append(remote_job_id)
+        else:
+            pilot_jobs.setdefault(pilot_id, {})[remote_job_id.rsplit(':', 1)[1]] = remote_job_id
+
+    errors = {}
+    if len(pbs_job_ids) > 0:
+        errors.update(saga_utils.cancel_jobs(pbs_job_ids, service))
+    for pilot_id, jobs in pilot_jobs.items():
+        for local_job_id, error in pilot_utils.cancel_tasks(pilot_id, jobs.keys(), service).items():
+            errors[jobs[local_job_id]] = error
+    return errors
+
+
+@app.route('/jobs/<id>/submit',  methods=['POST'])
+@login_required
+def handle_submit_job(id):
+
+    # only the owner of a job can submit it
+
+    cmd = "SELECT * FROM JOB WHERE local_job_id=:local_job_id"
+    result = execute(cmd, local_job_id=id).fetchone()
+
+    if result is None:
+        abort(404)
+
+    if(int(result['user_id']) != get_principal().user_id):
+        abort(403)
+
+    if result['state'] != "NEW":
+        abort("inconsistent state", 500)
+
+    submission_executor.submit(result['user_id'], result['service_id'], submit_job, id)
+
+    return 'Success', 200, {'Content-Type': 'text/plain'}
+
+
+
+@db_utils.task
+def submit_job_array(array_id):
+
+    cmd = "SELECT * FROM JOB WHERE array_id=:array_id ORDER BY array_index"
+    result = execute(cmd, array_id=array_id).fetchall()
+
+    if len(result) == 0:
+        app.logger.error("Error submitting job array, array not found")
+        return
+
+    # the array is taken for submission whole, or not at all
+    claimed = transition_array(array_id, [job_state.NEW], job_state.STAGING)
+    if claimed != len(result):
+        app.logger.error("Error submitting job array, inconsistent state")
+        if claimed > 0:
+            transition_array(array_id, [job_state.STAGING], job_state.NEW)
+        return
+
+    try:
+        jd = job_array_description(result)
+    except ValueError as e:
+        app.logger.error("Error submitting job array " + array_id + ": " + str(e))
+        transition_array(array_id, [job_state.STAGING], job_state.FAILED)
+        return
+
+    service_id = result[0]['service_id']
+    service = get_service(service_id)
+
+    # all subjobs get the same resources, so size the array for its largest member
+    if result[0]['auto_cpus']:
+        jd['num_total_cpus'] = max([size_job(r, service) for r in result])
+
+    if result[0]['auto_walltime']:
+        jd['wallclock_limit'] = max([fit_walltime(r, jd['num_total_cpus']) for r in result])
+
+    route_to_reservation(result, service_id, jd)
+
+    # stage the inputs of every member into its own working directory
+    for r in result:
+        id = r['local_job_id']
+        try:
+            if r['input_set_id'] is not None:
+                input_set_dir = os.path.join(INPUTSET_STAGING_AREA, str(r['input_set_id']))
+                stage_files(id, input_set_dir, service_id, service)
+            stage_files(id, os.path.join(INPUT_STAGING_AREA, id), service_id, service)
+        except Exception as e:
+            app.logger.error(e.message)
+            transition_array(array_id, [job_state.STAGING], job_state.STAGING_FAILED)
+            return
+
+    if not admit_job(service_id, service):
+        app.logger.info("Service " + service['name'] + " is busy, queueing job array " + array_id)
+        transition_array(array_id, [job_state.STAGING], job_state.QUEUED)
+        return
+
+    # every job of the array is submitted, numbered as subjobs in order of array_index
+    launch_job_array(array_id, list(enumerate(result)), jd, service_id, service)
+
+
+def job_array_description(result):
+
+    # every member shares the description of the first, apart from its arguments and working directory.
+    # all subjobs get the same resources, so the array takes the most cores and the longest wallclock
+    # limit of its members. raises ValueError if the members' limits differ and can't be compared
+    jd = job_record_to_description(result[0])
+    jd['array'] = [{'local_job_id': r['local_job_id'],
+                    'arguments': job_record_to_description(r).get('arguments')} for r in result]
+
+    num_total_cpus = [r['num_total_cpus'] for r in result if r['num_total_cpus'] is not None]
+    if len(num_total_cpus) > 0:
+        jd['num_total_cpus'] = max(num_total_cpus)
+
+    wallclock_limits = set([r['wallclock_limit'] for r in result if r['wallclock_limit'] is not None])
+    if len(wallclock_limits) > 1:
+        try:
+            jd['wallclock_limit'] = max(wallclock_limits, key=int)
+        except ValueError:
+            raise ValueError("job array members have different wallclock limits: " +
+                             ", ".join(sorted(wallclock_limits)))
+    return jd
+
+
+@db_utils.task
+def launch_job_array(array_id, subjobs, jd, service_id, service):
+
+    # a single qsub for the whole array
+    remote_job_id = None
+    try:
+        remote_job_id = saga_utils.submit_saga_job(jd, service)
+    except Exception as e:
+        app.logger.error(e.message)
+    finally:
+        service_admission.release(service_id)
+
+    if remote_job_id is None or remote_job_id == -1:
+        transition_array(array_id, [job_state.STAGING], job_state.FAILED)
+        return
+
+    # each member tracks its own subjob, numbered by its place in the array as submitted
+    for index, r in subjobs:
+        subjob_id = saga_utils.get_array_subjob_id(remote_job_id, index)
+        if not transition(r['local_job_id'], [job_state.STAGING], job_state.SUBMITTED, remote_job_id=subjob_id):
+            cancel_superseded_job(subjob_id, service)
+
+
+@app.route('/arrays/<array_id>/submit',  methods=['POST'])
+@login_required
+def handle_submit_job_array(array_id):
+
+    # only the owner of a job array can submit it
+
+    cmd = "SELECT user_id, service_id, state FROM JOB WHERE array_id=:array_id"
+    result = execute(cmd, array_id=array_id).fetchall()
+
+    if len(result) == 0:
+        abort(404)
+
+    if int(result[0]['user_id']) != get_principal().user_id:
+        abort(403)
+
+    for r in result:
+        if r['state'] != "NEW":
+            abort(500, "inconsistent state")
+
+    submission_executor.submit(result[0]['user_id'], result[0]['service_id'], submit_job_array, array_id)
+
+    return 'Success', 200, {'Content-Type': 'text/plain'}
+
+
+
+@app.route('/jobs/<id>/files',  methods=['POST'])
+@login_required
+def add_file_to_job(id):
+    # first check the job exists
+    cmd = "SELECT local_job_id, user_id, service_id FROM JOB WHERE local_job_id=:local_job_id"
+    result = execute(cmd, local_job_id=id)
+    r = result.fetchone()
+    if r is None:
+        abort(404)
+    local_job_id = r['local_job_id']
+    user_id = r['user_id']
+    if int(r['user_id']) != get_principal().user_id:
+        abort(403)
+
+    print("Uploading files for job " + local_job_id)
+
+    for f in request.files:
+        file = request.files[f]
+        print(f)
+        file_path = os.path.join(INPUT_STAGING_AREA, local_job_id, secure_filename(f))
+        print("upload path is " + file_path)
+        file.save(file_path)
+        try:
+            print(os.path.getsize(file_path))
+        except Exception as e:
+            print(e)
+
+        # remember the size of the geometry, for jobs that ask to be sized automatically
+        if file_path.endswith('.gmy'):
+            try:
+                fluid_sites = count_fluid_sites(file_path)
+                cmd = "UPDATE JOB SET fluid_sites=:fluid_sites WHERE local_job_id=:local_job_id"
+                execute(cmd, fluid_sites=fluid_sites, local_job_id=local_job_id)
+            except Exception as e:
+                app.logger.error("Error reading geometry file " + file_path + ": " + str(e))
+
+        # start copying the file to the service straight away, rather than when the job is submitted
+        if SPECULATIVE_STAGING:
+            db_utils.commit()
+            staging_executor.submit(user_id, r['service_id'], stage_speculatively, local_job_id,
+                                    secure_filename(f))
+
+    return 'Success', 200, {'Content-Type': 'text/plain'}
+
+
+def stage_files(local_job_id, local_dir, service_id, service, names=None):
+
+    # copy the files in a local directory into the job's remote working directory, skipping any that
+    # were already copied with the same contents. names limits the copy to the given files
+
+    with staging_locks[hash(local_job_id) % len(staging_locks)]:
+        cmd = "SELECT name, hash FROM STAGED_FILE WHERE local_job_id=:local_job_id AND service_id=:service_id"
+        result = execute(cmd, local_job_id=local_job_id, service_id=service_id)
+        staged = dict([(r['name'], r['hash']) for r in result])
+
+        files = os.listdir(local_dir)
+        skip = []
+        hashes = {}
+        for f in files:
+            if names is not None and f not in names:
+                skip.append(f)
+                continue
+            hashes[f] = compute_file_hash(os.path.join(local_dir, f))
+            if staged.get(f) == hashes[f]:
+                skip.append(f)
+
+        if len(skip) == len(files):
+            return
+
+        if saga_utils.stage_input_files(local_job_id, local_dir, service, skip=skip) != 0:
+            raise Exception("Error staging files from " + local_dir + " for job " + local_job_id)
+
+        for f, file_hash in hashes.items():
+            if f in skip:
+                continue
+            cmd = "DELETE FROM STAGED_FILE WHERE local_job_id=:local_job_id AND name=:name"
+            execute(cmd, local_job_id=local_job_id, name=f)
+            cmd = "INSERT INTO STAGED_FILE (local_job_id, service_id, name, hash) " \
+                  "VALUES (:local_job_id, :service_id, :name, :hash)"
+            execute(cmd, local_job_id=local_job_id, service_id=service_id, name=f, hash=file_hash)
+
+
+@db_utils.task
+def stage_speculatively(local_job_id, name):
+
+    # copy an uploaded file (or, with no name, the job's input set) to the job's service before the
+    # job is submitted. failures only cost time, as anything missing is copied again at submission
+
+    try:
+        cmd = "SELECT service_id, input_set_id, state FROM JOB WHERE local_job_id=:local_job_id"
+        job = execute(cmd, local_job_id=local_job_id).fetchone()
+        if job is None or job['state'] != "NEW":
+            return
+
+        service = get_service(job['service_id'])
+        if name is None:
+            stage_files(local_job_id, os.path.join(INPUTSET_STAGING_AREA, str(job['input_set_id'])),
+                        job['service_id'], service)
+        else:
+            stage_files(local_job_id, os.path.join(INPUT_STAGING_AREA, local_job_id), job['service_id'], service,
+                        names=[name])
+    except Exception as e:
+        app.logger.error("stage_speculatively:" + str(e))
+
+@app.route('/jobs/<id>/files',  methods=['GET'])
+@login_required
+def get_job_output_file_list(id):
+
+    # quickly check if the job id is real
+    r = find_job("local_job_id, user_id, reused_from", id)
+    if r is None:
+        abort(404)
+    # a job that reused an earlier job's results lists that job's outputs
+    local_job_id = r['reused_from'] or r['local_job_id']
+    user_id = r['user_id']
+
+    # normal users can only see their own jobs
+    if int(user_id) != get_principal().user_id:
+        if not (get_principal().has_any_role(SUPERUSER_ROLE, POWERUSER_ROLE)):
+            abort(403)
+
+    # list the files in the job's output directory
+    # in the case of Azure we would list the output storage container
+
+    #filelist = []
+    #base_dir = os.path.join(OUTPUT_STAGING_AREA, local_job_id)
+    #for path, subdirs, files in os.walk(base_dir):
+    #    for name in files:
+    #        filelist.append( os.path.join(path, name).replace(base_dir+"/",''))
+
+
+    # list the files from the WOS
+    if USE_WOS == True:
+        return json_stream_response(s3_iter_files_for_job(local_job_id))
+    else:
+        base_dir = os.path.join(OUTPUT_STAGING_AREA, local_job_id)
+        return json_stream_response(walk_files(base_dir))
+
+
+def walk_files(base_dir):
+
+    # the paths of the files under a directory, relative to it
+    for path, subdirs, files in os.walk(base_dir):
+        for name in files:
+            yield os.path.join(path, name).replace(base_dir+"/",'')
+
+
+
+
+@app.route('/jobs/<job_id>/files/<path:path>',  methods=['GET'])
+@login_required
+def get_job_output_file(job_id, path):
+
+    # quickly check if the job id is real
+    r = find_job("local_job_id, user_id, reused_from", job_id)
+    if r is None:
+        abort(404)
+    local_job_id = r['reused_from'] or r['local_job_id']
+    user_id = r['user_id']
+
+    if int(user_id) != get_principal().user_id:
+        abort(403)
+
+    # check if the requested file exists
+    # we need a check to see if we are listing normal files or redirecting to WOS
+
+    if USE_WOS == True:
+        key_path = os.path.join(local_job_id, path)
+        url = get_presigned_url(key_path)
+        return redirect(url, code=302)
+    else:
+        exists = os.path.isfile(os.path.join(OUTPUT_STAGING_AREA, local_job_id, path))
+        if not exists:
+           abort(404)
+
+    return send_from_directory(directory=os.path.join(OUTPUT_STAGING_AREA, local_job_id), filename=path)
+
+
+@app.route('/jobs/<id>', methods=['DELETE'])
+@login_required
+def delete_job(id):
+
+    try:
+
+        # check ownership of the job
+        r = find_job("user_id, service_id, remote_job_id, state, retrieved, reused_from", id)
+        if r is None:
+            return "Resource not found", 404, {'Content-Type': 'text/plain'}
+
+        if int(r['user_id']) != get_principal().user_id:
+            if not (get_principal().has_role(SUPERUSER_ROLE)):
+                return "Permission Denied", 403, {'Content-Type': 'text/plain'}
+
+
+        # if the job is already set as deleted, ignore this request
+        if r['state'] == 'DELETED':
+            return 200
+
+        service = get_service(r['service_id'])
+
+        # only do remote cleanup if not already done
+        if r['retrieved'] != 1:
+
+
+
+            # kill the remote job if still running
+
+            remote_job_id = r['remote_job_id']
 
             if remote_job_id is not None:
                 try:
-                    saga_utils.cancel_job(remote_job_id, service)
+                    pilot_id = pilot_utils.get_pilot_id(remote_job_id)
+                    if pilot_id is None:
+                        saga_utils.cancel_job(remote_job_id, service)
+                    else:
+                        pilot_utils.cancel_tasks(pilot_id, [str(id)], service)
                 except Exception as e:
                     app.logger.error("SAGA: error cancelling job:" + e.message)
 
@@ -858,10 +1996,14 @@ def delete_job(id):
             except Exception as e:
                 app.logger.error("SAGA: error cleaning up directory:" + e.message)
 
-        # delete any retrieved output files associated with the job
+        # delete any retrieved output files associated with the job,
+        # unless they are shared with jobs that reused them and are still needed
+
+        output_job_id = r['reused_from'] or str(id)
+        delete_outputs = not outputs_in_use(output_job_id, str(id))
 
-        LOCAL_OUTPUT_DIR = os.path.join(OUTPUT_STAGING_AREA, str(id))
-        if os.path.exists(LOCAL_OUTPUT_DIR):
+        LOCAL_OUTPUT_DIR = os.path.join(OUTPUT_STAGING_AREA, output_job_id)
+        if delete_outputs and os.path.exists(LOCAL_OUTPUT_DIR):
             shutil.rmtree(LOCAL_OUTPUT_DIR)
 
         # delete any local input files associated with the job
@@ -870,13 +2012,15 @@ def delete_job(id):
             shutil.rmtree(LOCAL_INPUT_DIR)
 
         # delete any files on the WOS
-        if USE_WOS == True:
-            s3_delete_files_for_job(id)
+        if USE_WOS == True and delete_outputs:
+            s3_delete_files_for_job(output_job_id)
 
 
+        cmd = "DELETE FROM STAGED_FILE WHERE local_job_id=:local_job_id"
+        execute(cmd, local_job_id=id)
+
         # update the job to show as deleted
-        cmd = "UPDATE JOB SET state=:state WHERE local_job_id = :local_job_id"
-        result = db.engine.execute(text(cmd), state="DELETED", local_job_id=id)
+        job_state.mark_deleted(id)
 
         return "Deleted", 200, {'Content-Type': 'text/plain'}
 
@@ -884,11 +2028,215 @@ def delete_job(id):
         abort(500, e.message)
 
 
+@app.route('/jobs/cancel', methods=['POST'])
+@login_required
+def cancel_jobs():
+
+    # cancel a batch of jobs, eg an abandoned sweep, with one qdel per service rather than one per job.
+    # the payload is a json list of job ids; the response maps each id to its new state or an error
+
+    job_ids = request.json
+    if not isinstance(job_ids, list):
+        abort(500, "request must contain a list of job ids")
+
+    results = {}
+    remote_jobs = {}
+
+    for id in job_ids:
+        r = find_job("user_id, service_id, remote_job_id, state", id)
+        if r is None:
+            results[id] = "Resource not found"
+            continue
+
+        if int(r['user_id']) != get_principal().user_id:
+            if not (get_principal().has_role(SUPERUSER_ROLE)):
+                results[id] = "Permission Denied"
+                continue
+
+        # queued jobs have not reached the scheduler yet
+        if r['state'] == job_state.QUEUED and transition(id, [job_state.QUEUED], job_state.CANCELED):
+            results[id] = "Canceled"
+            continue
+
+        if r['state'] != 'SUBMITTED' or r['remote_job_id'] is None:
+            results[id] = "Job is not running"
+            continue
+
+        remote_jobs.setdefault(r['service_id'], {})[r['remote_job_id']] = id
+
+    for service_id, jobs in remote_jobs.items():
+        service = get_service(service_id)
+        try:
+            errors = cancel_remote_jobs(jobs.keys(), service)
+        except Exception as e:
+            app.logger.error("SAGA: error cancelling jobs:" + e.message)
+            errors = dict([(remote_job_id, e.message) for remote_job_id in jobs])
+
+        for remote_job_id, id in jobs.items():
+            if errors[remote_job_id] is None:
+                # the job may have finished while it was being cancelled
+                if transition(id, [job_state.SUBMITTED], job_state.CANCELED):
+                    results[id] = "Canceled"
+                else:
+                    results[id] = "Job is not running"
+            else:
+                results[id] = errors[remote_job_id]
+
+    return jsonify(results)
+
+
+@app.route('/reservations', methods=['POST'])
+@login_required
+def create_reservation():
+
+    # book an advance reservation on a service, so the user's jobs there start without queueing.
+    # reservations hold nodes whether or not they are used, so only powerusers or admins may book them.
+    # the payload names the service, the start ("YYYY-MM-DD HH:MM"), the duration in minutes and
+    # optionally the number of nodes
+
+    if not (get_principal().has_any_role(SUPERUSER_ROLE, POWERUSER_ROLE)):
+        abort(403)
+
+    payload = request.json
+
+    service = service_cache.get_by_name(payload.get('service'))
+    if service is None:
+        abort(404, "No matching service found")
+    service_id = service['id']
+
+    try:
+        start = datetime.datetime.strptime(payload.get('start'), '%Y-%m-%d %H:%M')
+        duration = int(payload.get('duration'))
+        num_nodes = int(payload.get('num_nodes', 1))
+    except Exception as e:
+        abort(500, "Invalid reservation specification: " + str(e))
+
+    name = payload.get('name')
+    if name is not None and re.match(r'^\w{1,15}$', name) is None:
+        abort(500, "Reservation names must be at most 15 letters, digits or underscores")
+
+    reservation_description = {'start': start, 'duration': duration, 'num_nodes': num_nodes,
+                               'cores_per_node': service['cores_per_node'], 'name': name}
+    try:
+        remote_reservation_id = PBSProJob().create_reservation(reservation_description, service)
+    except Exception as e:
+        app.logger.error(e.message)
+        abort(500, e.message)
+
+    reservation_id = str(uuid.uuid4())
+    cmd = "INSERT INTO RESERVATION (reservation_id, remote_reservation_id, user_id, service_id, state, " \
+          "start_time, end_time, num_nodes) VALUES (:reservation_id, :remote_reservation_id, :user_id, " \
+          ":service_id, :state, :start_time, :end_time, :num_nodes)"
+    execute(cmd, reservation_id=reservation_id, remote_reservation_id=remote_reservation_id,
+            user_id=get_principal().user_id, service_id=service_id, state="UNCONFIRMED", start_time=start,
+            end_time=start + datetime.timedelta(minutes=duration), num_nodes=num_nodes)
+
+    # PBS usually confirms the reservation straight away. if it can't be asked, the reservation
+    # stays UNCONFIRMED till the next refresh; it has been booked either way, so must be recorded
+    try:
+        refresh_reservation(reservation_id, remote_reservation_id, service)
+    except Exception as e:
+        app.logger.error("create_reservation:" + e.message)
+
+    return get_reservation(reservation_id)
+
+
+@app.route('/reservations', methods=['GET'])
+@login_required
+def list_reservations():
+
+    cmd = "SELECT reservation_id, state, start_time, end_time, num_nodes, queue FROM RESERVATION " \
+          "WHERE user_id=:user_id ORDER BY start_time"
+    result = stream(cmd, user_id=get_principal().user_id)
+    return json_stream_response(result, ['reservation_id', 'state', 'start_time', 'end_time', 'num_nodes', 'queue'])
+
+
+@app.route('/reservations/<reservation_id>', methods=['GET'])
+@login_required
+def get_reservation(reservation_id):
+
+    cmd = "SELECT * FROM RESERVATION WHERE reservation_id=:reservation_id"
+    result = execute(cmd, reservation_id=reservation_id).fetchone()
+    if result is None:
+        abort(404)
+
+    if int(result['user_id']) != get_principal().user_id:
+        if not get_principal().has_role(SUPERUSER_ROLE):
+            abort(403)
+
+    keys = ['reservation_id', 'state', 'start_time', 'end_time', 'num_nodes', 'queue']
+    return jsonify(dict([(k, result[k]) for k in keys]))
+
+
+@app.route('/reservations/<reservation_id>', methods=['DELETE'])
+@login_required
+def delete_reservation(reservation_id):
+
+    cmd = "SELECT * FROM RESERVATION WHERE reservation_id=:reservation_id"
+    result = execute(cmd, reservation_id=reservation_id).fetchone()
+    if result is None:
+        return "Resource not found", 404, {'Content-Type': 'text/plain'}
+
+    if int(result['user_id']) != get_principal().user_id:
+        if not get_principal().has_role(SUPERUSER_ROLE):
+            return "Permission Denied", 403, {'Content-Type': 'text/plain'}
+
+    if result['state'] in RESERVATION_LIVE_STATES:
+        try:
+            PBSProJob().delete_reservation(result['remote_reservation_id'], get_service(result['service_id']))
+        except Exception as e:
+            app.logger.error(e.message)
+            abort(500, e.message)
+
+    cmd = "UPDATE RESERVATION SET state=:state WHERE reservation_id=:reservation_id"
+    execute(cmd, state="DELETED", reservation_id=reservation_id)
+
+    return "Deleted", 200, {'Content-Type': 'text/plain'}
+
+
+def refresh_reservation(reservation_id, remote_reservation_id, service):
+
+    # PBS drops a reservation once it has ended or been deleted
+    info = PBSProJob().get_reservation_info(remote_reservation_id, service)
+    if info is None:
+        info = {'state': 'FINISHED', 'queue': None}
+
+    cmd = "UPDATE RESERVATION SET state=:state, queue=:queue WHERE reservation_id=:reservation_id"
+    execute(cmd, state=info['state'], queue=info['queue'], reservation_id=reservation_id)
+
+
+@db_utils.task
+def refresh_reservation_states():
+
+    try:
+        cmd = "SELECT reservation_id, remote_reservation_id, service_id FROM RESERVATION WHERE state IN :states"
+        result = execute(cmd,
+                         states=RESERVATION_LIVE_STATES).fetchall()
+        for r in result:
+            try:
+                refresh_reservation(r['reservation_id'], r['remote_reservation_id'], get_service(r['service_id']))
+            except Exception as e:
+                app.logger.error("refresh_reservation_states:" + e.message)
+    except Exception as e:
+        app.logger.error(e.message)
+
+
+@app.route('/submissions/stats', methods=['GET'])
+@login_required
+def get_submission_stats():
+
+    # queue depth and wait times of the submission executor, for powerusers or admins keeping an eye on load
+    if not (get_principal().has_any_role(SUPERUSER_ROLE, POWERUSER_ROLE)):
+        abort(403)
+
+    return jsonify(submission_executor.stats())
+
+
 @app.route('/services', methods=['GET'])
 @login_required
 def list_resources():
     cmd = 'SELECT name, scheduler_url, file_url FROM SERVICE'
-    result = db.engine.execute(text(cmd))
+    result = execute(cmd)
     return jsonify(queryresult_to_dict({'name', 'scheduler_url', 'file_url'}, result))
 
 
@@ -904,19 +2252,19 @@ def create_input_set():
 
         # name must be unique, do an explicit check
         cmd = "SELECT id FROM INPUT_SET WHERE name=:name"
-        result = db.engine.execute(text(cmd), name=name)
+        result = execute(cmd, name=name)
         r = result.fetchone()
         if r is not None:
             abort(500, "name already in use")
 
-        user_id = current_user.get_id()
+        user_id = get_principal().user_id
 
         cmd = "INSERT INTO INPUT_SET (user_id, name) VALUES(:user_id, :name)"
-        db.engine.execute(text(cmd), user_id=user_id, name=name)
+        execute(cmd, user_id=user_id, name=name)
 
         # return the id of the new record
         cmd = "SELECT id FROM INPUT_SET WHERE name=:name"
-        result = db.engine.execute(text(cmd), name=name)
+        result = execute(cmd, name=name)
 
         r = result.fetchone()
         if r is None:
@@ -934,8 +2282,8 @@ def create_input_set():
 @login_required
 def list_input_sets():
     cmd = 'SELECT name, id FROM INPUT_SET'
-    result = db.engine.execute(text(cmd))
-    return jsonify(queryresult_to_array({'name', 'id'}, result))
+    result = stream(cmd)
+    return json_stream_response(result, ['name', 'id'])
 
 
 
@@ -945,7 +2293,7 @@ def get_inputset_hash(id):
 
     # check the input set exists
     cmd = "SELECT id FROM INPUT_SET WHERE id=:id"
-    result = db.engine.execute(text(cmd), id=id)
+    result = execute(cmd, id=id)
     r = result.fetchone()
     if r is None:
         abort(404)
@@ -966,15 +2314,15 @@ def get_inputset_hash(id):
 def add_file_to_inputset(id):
     # first check the input set exists
     cmd = "SELECT id, user_id FROM INPUT_SET WHERE id=:id"
-    result = db.engine.execute(text(cmd), id=id)
+    result = execute(cmd, id=id)
     r = result.fetchone()
     if r is None:
         abort(404)
 
     user_id = r['user_id']
 
-    if int(user_id) != int(current_user.get_id()):
-        if not ( current_user.has_role(SUPERUSER_ROLE) or current_user.has_role(POWERUSER_ROLE)):
+    if int(user_id) != get_principal().user_id:
+        if not (get_principal().has_any_role(SUPERUSER_ROLE, POWERUSER_ROLE)):
             abort(403)
 
     # check the directory exists for the input set
@@ -994,32 +2342,26 @@ def get_inputset_file_list(id):
 
     # quickly check if the inputset id is real
     cmd = "SELECT id, user_id FROM INPUT_SET WHERE id=:id"
-    result = db.engine.execute(text(cmd), id=id)
+    result = execute(cmd, id=id)
     r = result.fetchone()
     if r is None:
         abort(404)
     user_id = r['user_id']
 
     # normal users can only see their own assets
-    if int(user_id) != int(current_user.get_id()):
-        if not ( current_user.has_role(SUPERUSER_ROLE) or current_user.has_role(POWERUSER_ROLE)):
+    if int(user_id) != get_principal().user_id:
+        if not (get_principal().has_any_role(SUPERUSER_ROLE, POWERUSER_ROLE)):
             abort(403)
 
     # list the files in the job's output directory
     # in the case of Azure we would list the output storage container
 
-    filelist = []
     base_dir = os.path.join(INPUTSET_STAGING_AREA, id)
 
     if not os.path.exists(base_dir):
         abort(404)
 
-    for path, subdirs, files in os.walk(base_dir):
-        for name in files:
-            filelist.append( os.path.join(path, name).replace(base_dir+"/",''))
-
-
-    return jsonify(filelist)
+    return json_stream_response(walk_files(base_dir))
 
 
 @app.route('/inputsets/<id>/files/<filename>',  methods=['DELETE'])
@@ -1028,15 +2370,15 @@ def delete_inputset_file(id, filename):
 
     # quickly check if the inputset id is real
     cmd = "SELECT id, user_id FROM INPUT_SET WHERE id=:id"
-    result = db.engine.execute(text(cmd), id=id)
+    result = execute(cmd, id=id)
     r = result.fetchone()
     if r is None:
         abort(404)
     user_id = r['user_id']
 
     # normal users can only see their own assets
-    if int(user_id) != int(current_user.get_id()):
-        if not ( current_user.has_role(SUPERUSER_ROLE) or current_user.has_role(POWERUSER_ROLE)):
+    if int(user_id) != get_principal().user_id:
+        if not (get_principal().has_any_role(SUPERUSER_ROLE, POWERUSER_ROLE)):
             abort(403)
 
     # delete the file if it exists, otherwise return a not found
@@ -1055,15 +2397,15 @@ def delete_inputset(id):
 
     # quickly check if the inputset id is real
     cmd = "SELECT id, user_id FROM INPUT_SET WHERE id=:id"
-    result = db.engine.execute(text(cmd), id=id)
+    result = execute(cmd, id=id)
     r = result.fetchone()
     if r is None:
         abort(404)
     user_id = r['user_id']
 
     # normal users can only see their own assets
-    if int(user_id) != int(current_user.get_id()):
-        if not ( current_user.has_role(SUPERUSER_ROLE) or current_user.has_role(POWERUSER_ROLE)):
+    if int(user_id) != get_principal().user_id:
+        if not (get_principal().has_any_role(SUPERUSER_ROLE, POWERUSER_ROLE)):
             abort(403)
 
 
@@ -1081,12 +2423,19 @@ def delete_inputset(id):
 
 # refresh the local job state for any jobs with a local state of SUBMITTED
 # do this on some kind of background thread?
+@db_utils.task
 def refresh_job_state():
 
     try:
 
         cmd = "SELECT local_job_id, remote_job_id, service_id FROM JOB WHERE state='SUBMITTED'"
-        result = db.engine.execute(text(cmd))
+        result = execute(cmd)
+
+        # subjobs of a job array are refreshed together with one query per array,
+        # and jobs running in a pilot with one query per pilot
+        array_states = {}
+        pilot_states = {}
+
         for r in result:
 
             try:
@@ -1097,14 +2446,30 @@ def refresh_job_state():
                 remote_state = None
 
                 try:
-                    remote_state = saga_utils.get_remote_job_state(remote_job_id, service)
+                    array_job_id = saga_utils.get_array_job_id(remote_job_id)
+                    pilot_id = pilot_utils.get_pilot_id(remote_job_id)
+                    if pilot_id is not None:
+                        if pilot_id not in pilot_states:
+                            pilot_states[pilot_id] = get_pilot_task_states(pilot_id, service)
+                        remote_state = pilot_states[pilot_id].get(local_job_id)
+                    elif array_job_id is None:
+                        remote_state = saga_utils.get_remote_job_state(remote_job_id, service)
+                    else:
+                        if array_job_id not in array_states:
+                            array_states[array_job_id] = saga_utils.get_remote_array_job_states(array_job_id,
+                                                                                                service)
+                        remote_state = array_states[array_job_id].get(remote_job_id)
                 except Exception as e:
                     app.logger.error("refresh_job_state 1:" + e.message)
 
-                if (remote_state in ['Done', 'DONE', 'Failed', 'FAILED']):
-                    # update the local state
-                    cmd = "UPDATE JOB SET state=:state WHERE local_job_id=:local_job_id"
-                    db.engine.execute(text(cmd), state=remote_state, local_job_id=local_job_id)
+                # only the refresh that moves the job on records it and retrieves its outputs
+                if remote_state in job_state.FINISHED_STATES and \
+                        transition(local_job_id, [job_state.SUBMITTED], remote_state):
+
+                    try:
+                        record_runtime(local_job_id, remote_job_id, service)
+                    except Exception as e:
+                        app.logger.error("refresh_job_state 2:" + e.message)
 
                     try:
                         scheduler.add_job(retrieve_output_files, args=[local_job_id])
@@ -1118,25 +2483,96 @@ def refresh_job_state():
         app.logger.error(e.message)
 
 
+def find_job(columns, local_job_id):
+
+    # the given columns of a job's record, looked for in the archive if the job isn't in JOB; None if it's in neither
+    for table in ['JOB', 'JOB_ARCHIVE']:
+        cmd = "SELECT " + columns + " FROM " + table + " WHERE local_job_id=:local_job_id"
+        result = execute(cmd, local_job_id=local_job_id).fetchone()
+        if result is not None:
+            return result
+    return None
+
+
+@db_utils.task
+def archive_jobs():
+
+    # move jobs that were deleted or finished more than ARCHIVE_AGE days ago from JOB to JOB_ARCHIVE,
+    # ARCHIVE_BATCH_SIZE at a time, each batch in a transaction of its own so that JOB isn't locked for long.
+    # a job array is only archived once all its jobs can be, so it is never split between the tables
+
+    try:
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=ARCHIVE_AGE)
+        while True:
+            cmd = "SELECT id, local_job_id FROM JOB j WHERE state IN :states AND last_modified < :cutoff " \
+                  "AND (array_id IS NULL OR NOT EXISTS (SELECT 1 FROM JOB a WHERE a.array_id=j.array_id " \
+                  "AND (a.state NOT IN :states OR a.last_modified >= :cutoff))) ORDER BY id LIMIT :batch_size"
+            result = execute(cmd, states=ARCHIVABLE_STATES, cutoff=cutoff, batch_size=ARCHIVE_BATCH_SIZE).fetchall()
+            if len(result) == 0:
+                break
+
+            ids = [r['id'] for r in result]
+            with db_utils.transaction():
+                cmd = "INSERT INTO JOB_ARCHIVE (" + ARCHIVED_JOB_COLUMNS + ", archived) " \
+                      "SELECT " + ARCHIVED_JOB_COLUMNS + ", :archived FROM JOB WHERE id IN :ids"
+                execute(cmd, archived=datetime.datetime.now().replace(microsecond=0), ids=ids)
+                cmd = "DELETE FROM STAGED_FILE WHERE local_job_id IN :local_job_ids"
+                execute(cmd, local_job_ids=[r['local_job_id'] for r in result])
+                cmd = "DELETE FROM JOB WHERE id IN :ids"
+                execute(cmd, ids=ids)
+
+            app.logger.info("Archived " + str(len(ids)) + " jobs")
+            if len(result) < ARCHIVE_BATCH_SIZE:
+                break
+
+    except Exception as e:
+        app.logger.error("archive_jobs:" + str(e))
+
+
+def load_services():
+
+    cmd = "SELECT * FROM SERVICE"
+    result = execute(cmd)
+
+    services = []
+    for r in result:
+        service = {}
+        service["id"] = r["id"]
+        service["name"] = r["name"]
+        service["scheduler_url"] = r["scheduler_url"]
+        service["username"] = r["username"]
+        service["user_pass"] = r["user_pass"]
+        service["user_key"] = r["user_key"]
+        service["file_url"] = r["file_url"]
+        service["working_directory"] = r["working_directory"]
+        service["cores_per_node"] = r["cores_per_node"]
+        service["sites_per_core"] = r["sites_per_core"]
+        service["known_nodes"] = r["known_nodes"]
+        service["qsub_rate"] = r["qsub_rate"]
+        service["qsub_burst"] = r["qsub_burst"]
+        service["max_in_flight"] = r["max_in_flight"]
+        services.append(service)
+
+    return services
+
+
 def get_service(service_id):
-    cmd = "SELECT * FROM SERVICE WHERE id=:service_id"
-    result = db.engine.execute(text(cmd), service_id=service_id).fetchone()
-
-    service = {}
-    service["name"] = result["name"]
-    service["scheduler_url"] = result["scheduler_url"]
-    service["username"] = result["username"]
-    service["user_pass"] = result["user_pass"]
-    service["user_key"] = result["user_key"]
-    service["file_url"] = result["file_url"]
-    service["working_directory"] = result["working_directory"]
 
+    service = service_cache.get(service_id)
+    if service is None:
+        raise Exception("No service with id " + str(service_id))
     return service
 
 
+@db_utils.task
 def retrieve_output_files(job_id):
-    cmd = "SELECT remote_job_id, service_id, filter FROM JOB WHERE local_job_id=:local_job_id"
-    result = db.engine.execute(text(cmd), local_job_id=job_id)
+
+    # a job's outputs are retrieved once, however many times it's scheduled
+    if not job_state.claim_retrieval(job_id):
+        return
+
+    cmd = "SELECT remote_job_id, service_id, filter, template_id FROM JOB WHERE local_job_id=:local_job_id"
+    result = execute(cmd, local_job_id=job_id)
     job = result.fetchone()
 
     local_file_dir = os.path.join(OUTPUT_STAGING_AREA, job_id)
@@ -1145,7 +2581,11 @@ def retrieve_output_files(job_id):
 
     try:
         REMOTE_WORKING_DIR = os.path.join(service['working_directory'], str(job_id))
+        # a filter taken unchanged from the job's template is already compiled
         filter = job['filter']
+        template = job_template(job)
+        if template is not None and filter == template.filter and template.filter_regex is not None:
+            filter = template.filter_regex
         try:
             log_message = "Staging output files: " + REMOTE_WORKING_DIR + "," + local_file_dir
             app.logger.info(log_message)
@@ -1183,11 +2623,11 @@ def retrieve_output_files(job_id):
             app.logger.error("retrieve_output_files:" + e.message)
 
         # flag the job as retrieved
-        cmd = "UPDATE JOB SET retrieved=1 WHERE local_job_id=:local_job_id"
-        db.engine.execute(text(cmd), local_job_id=job_id)
+        job_state.finish_retrieval(job_id)
 
     except Exception as e:
         app.logger.error("retrieve_output_files:" + e.message)
+        job_state.abandon_retrieval(job_id)
 
 
 def copy_local_files_to_s3(local_job_dir, parent_dir):
@@ -1201,6 +2641,11 @@ def copy_local_files_to_s3(local_job_dir, parent_dir):
 
 
 scheduler.add_job(refresh_job_state, 'interval', minutes=REMOTE_JOB_STATE_REFRESH_PERIOD)
+scheduler.add_job(refresh_queue_snapshots, 'interval', minutes=QUEUE_SNAPSHOT_REFRESH_PERIOD)
+scheduler.add_job(refresh_reservation_states, 'interval', minutes=REMOTE_JOB_STATE_REFRESH_PERIOD)
+scheduler.add_job(refresh_pilot_states, 'interval', minutes=REMOTE_JOB_STATE_REFRESH_PERIOD)
+scheduler.add_job(drain_queued_jobs, 'interval', seconds=QUEUED_JOB_DRAIN_PERIOD)
+scheduler.add_job(archive_jobs, 'interval', minutes=ARCHIVE_PERIOD)
 scheduler.start()
 
 if __name__ == '__main__':
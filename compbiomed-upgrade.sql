@@ -0,0 +1,60 @@
+-- Upgrade of an existing compbiomed database to the current schema.
+--
+-- compbiomed.sql only creates tables that don't exist yet, so on a database created from an earlier
+-- version it adds any new tables but leaves the columns and indexes of the existing ones as they were.
+-- To upgrade, as root:
+--
+--   source compbiomed.sql;
+--   source compbiomed-upgrade.sql;
+--
+-- with the service stopped. Run this script once only; MySQL has no ADD COLUMN IF NOT EXISTS.
+
+USE `compbiomed` ;
+
+ALTER TABLE `JOB`
+  ADD COLUMN `array_id` VARCHAR(128) NULL DEFAULT NULL AFTER `filter`,
+  ADD COLUMN `array_index` INT NULL DEFAULT NULL AFTER `array_id`,
+  ADD INDEX `JOB_array_idx` (`array_id` ASC, `array_index` ASC);
+
+ALTER TABLE `JOB_TEMPLATE`
+  ADD COLUMN `family` VARCHAR(45) NULL DEFAULT NULL AFTER `description`,
+  ADD INDEX `JOB_TEMPLATE_family_idx` (`family` ASC);
+
+ALTER TABLE `SERVICE`
+  ADD COLUMN `cores_per_node` INT NULL DEFAULT NULL AFTER `working_directory`,
+  ADD COLUMN `sites_per_core` INT NULL DEFAULT NULL AFTER `cores_per_node`,
+  ADD COLUMN `known_nodes` VARCHAR(128) NULL DEFAULT NULL AFTER `sites_per_core`;
+
+ALTER TABLE `JOB`
+  ADD COLUMN `auto_cpus` TINYINT(1) NULL DEFAULT 0 AFTER `array_index`,
+  ADD COLUMN `fluid_sites` BIGINT NULL DEFAULT NULL AFTER `auto_cpus`;
+
+ALTER TABLE `SERVICE`
+  ADD COLUMN `qsub_rate` FLOAT NULL DEFAULT NULL AFTER `known_nodes`,
+  ADD COLUMN `qsub_burst` INT NULL DEFAULT NULL AFTER `qsub_rate`,
+  ADD COLUMN `max_in_flight` INT NULL DEFAULT NULL AFTER `qsub_burst`;
+
+ALTER TABLE `JOB`
+  ADD COLUMN `auto_walltime` TINYINT(1) NULL DEFAULT 0 AFTER `fluid_sites`,
+  ADD COLUMN `runtime` INT NULL DEFAULT NULL AFTER `auto_walltime`;
+
+ALTER TABLE `JOB`
+  ADD COLUMN `reuse` TINYINT(1) NULL DEFAULT 0 AFTER `runtime`,
+  ADD COLUMN `input_hash` VARCHAR(64) NULL DEFAULT NULL AFTER `reuse`,
+  ADD COLUMN `reused_from` VARCHAR(128) NULL DEFAULT NULL AFTER `input_hash`,
+  ADD INDEX `JOB_input_hash_idx` (`user_id` ASC, `input_hash` ASC),
+  ADD INDEX `JOB_reused_from_idx` (`reused_from` ASC);
+
+ALTER TABLE `JOB`
+  ADD COLUMN `hold` TINYINT(1) NULL DEFAULT 0 AFTER `reused_from`;
+
+ALTER TABLE `JOB`
+  ADD INDEX `JOB_user_created_idx` (`user_id` ASC, `created` ASC, `id` ASC),
+  ADD INDEX `JOB_created_idx` (`created` ASC, `id` ASC);
+
+ALTER TABLE `JOB`
+  ADD INDEX `JOB_state_idx` (`state` ASC);
+
+ALTER TABLE `JOB`
+  ADD COLUMN `template_id` INT NULL DEFAULT NULL AFTER `hold`,
+  ADD INDEX `JOB_runtime_idx` (`service_id` ASC, `template_id` ASC, `runtime` ASC);
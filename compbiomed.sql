@@ -2,6 +2,8 @@
 -- Tue Dec  4 11:20:42 2018
 -- Model: New Model    Version: 1.0
 -- MySQL Workbench Forward Engineering
+-- schema.py holds the same schema for SQLite, used when running locally; the two are changed together.
+-- existing databases are brought up to date with compbiomed-upgrade.sql, which is changed along with them
 
 SET @OLD_UNIQUE_CHECKS=@@UNIQUE_CHECKS, UNIQUE_CHECKS=0;
 SET @OLD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, FOREIGN_KEY_CHECKS=0;
@@ -82,6 +84,12 @@ CREATE TABLE IF NOT EXISTS `compbiomed`.`SERVICE` (
   `user_key` VARCHAR(256) NULL DEFAULT NULL,
   `file_url` VARCHAR(256) NULL,
   `working_directory` VARCHAR(256) NULL,
+  `cores_per_node` INT NULL DEFAULT NULL,
+  `sites_per_core` INT NULL DEFAULT NULL,
+  `known_nodes` VARCHAR(128) NULL DEFAULT NULL,
+  `qsub_rate` FLOAT NULL DEFAULT NULL,
+  `qsub_burst` INT NULL DEFAULT NULL,
+  `max_in_flight` INT NULL DEFAULT NULL,
   PRIMARY KEY (`id`),
   UNIQUE INDEX `name_UNIQUE` (`name` ASC))
 ENGINE = InnoDB;
@@ -131,11 +139,29 @@ CREATE TABLE IF NOT EXISTS `compbiomed`.`JOB` (
   `extended` VARCHAR(1024) NULL DEFAULT NULL,
   `retrieved` TINYINT(1) NULL DEFAULT 0,
   `filter` VARCHAR(512) NULL DEFAULT NULL,
+  `array_id` VARCHAR(128) NULL DEFAULT NULL,
+  `array_index` INT NULL DEFAULT NULL,
+  `auto_cpus` TINYINT(1) NULL DEFAULT 0,
+  `fluid_sites` BIGINT NULL DEFAULT NULL,
+  `auto_walltime` TINYINT(1) NULL DEFAULT 0,
+  `runtime` INT NULL DEFAULT NULL,
+  `reuse` TINYINT(1) NULL DEFAULT 0,
+  `input_hash` VARCHAR(64) NULL DEFAULT NULL,
+  `reused_from` VARCHAR(128) NULL DEFAULT NULL,
+  `hold` TINYINT(1) NULL DEFAULT 0,
+  `template_id` INT NULL DEFAULT NULL,
   PRIMARY KEY (`id`),
   INDEX `fk_JOBS_user1_idx` (`user_id` ASC),
   INDEX `fk_JOBS_SERVICES1_idx` (`service_id` ASC),
   INDEX `fk_JOB_INPUT_SET1_idx` (`input_set_id` ASC),
   UNIQUE INDEX `local_job_id_UNIQUE` (`local_job_id` ASC),
+  INDEX `JOB_array_idx` (`array_id` ASC, `array_index` ASC),
+  INDEX `JOB_runtime_idx` (`service_id` ASC, `template_id` ASC, `runtime` ASC),
+  INDEX `JOB_input_hash_idx` (`user_id` ASC, `input_hash` ASC),
+  INDEX `JOB_reused_from_idx` (`reused_from` ASC),
+  INDEX `JOB_user_created_idx` (`user_id` ASC, `created` ASC, `id` ASC),
+  INDEX `JOB_created_idx` (`created` ASC, `id` ASC),
+  INDEX `JOB_state_idx` (`state` ASC),
   CONSTRAINT `fk_JOBS_user1`
     FOREIGN KEY (`user_id`)
     REFERENCES `compbiomed`.`user` (`id`)
@@ -196,11 +222,13 @@ CREATE TABLE IF NOT EXISTS `compbiomed`.`JOB_TEMPLATE` (
   `extended` VARCHAR(1024) NULL DEFAULT NULL,
   `filter` VARCHAR(512) NULL DEFAULT NULL,
   `description` VARCHAR(512) NULL,
+  `family` VARCHAR(45) NULL DEFAULT NULL,
   PRIMARY KEY (`id`),
   INDEX `fk_JOB_TEMPLATE_user1_idx` (`user_id` ASC),
   INDEX `fk_JOB_TEMPLATE_SERVICES1_idx` (`service_id` ASC),
   INDEX `fk_JOB_TEMPLATE_INPUT_SET1_idx` (`input_set_id` ASC),
   UNIQUE INDEX `name_UNIQUE` (`name` ASC),
+  INDEX `JOB_TEMPLATE_family_idx` (`family` ASC),
   CONSTRAINT `fk_JOB_TEMPLATE_user1`
     FOREIGN KEY (`user_id`)
     REFERENCES `compbiomed`.`user` (`id`)
@@ -219,6 +247,143 @@ CREATE TABLE IF NOT EXISTS `compbiomed`.`JOB_TEMPLATE` (
 ENGINE = InnoDB;
 
 
+-- -----------------------------------------------------
+-- Table `compbiomed`.`PILOT`
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS `compbiomed`.`PILOT` (
+  `id` INT NOT NULL AUTO_INCREMENT,
+  `pilot_id` VARCHAR(128) NOT NULL,
+  `service_id` INT NOT NULL,
+  `remote_job_id` VARCHAR(256) NULL DEFAULT NULL,
+  `state` VARCHAR(45) NULL DEFAULT 'SUBMITTED',
+  `project` VARCHAR(45) NULL DEFAULT NULL,
+  `queue` VARCHAR(45) NULL DEFAULT NULL,
+  `created` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `last_modified` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  UNIQUE INDEX `pilot_id_UNIQUE` (`pilot_id` ASC),
+  INDEX `fk_PILOT_SERVICE1_idx` (`service_id` ASC),
+  CONSTRAINT `fk_PILOT_SERVICE1`
+    FOREIGN KEY (`service_id`)
+    REFERENCES `compbiomed`.`SERVICE` (`id`)
+    ON DELETE NO ACTION
+    ON UPDATE NO ACTION)
+ENGINE = InnoDB;
+
+
+-- -----------------------------------------------------
+-- Table `compbiomed`.`RESERVATION`
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS `compbiomed`.`RESERVATION` (
+  `id` INT NOT NULL AUTO_INCREMENT,
+  `reservation_id` VARCHAR(128) NOT NULL,
+  `remote_reservation_id` VARCHAR(256) NULL DEFAULT NULL,
+  `user_id` INT NOT NULL,
+  `service_id` INT NOT NULL,
+  `state` VARCHAR(45) NULL DEFAULT 'UNCONFIRMED',
+  `queue` VARCHAR(45) NULL DEFAULT NULL,
+  `start_time` DATETIME NOT NULL,
+  `end_time` DATETIME NOT NULL,
+  `num_nodes` INT NULL DEFAULT NULL,
+  `created` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  UNIQUE INDEX `reservation_id_UNIQUE` (`reservation_id` ASC),
+  INDEX `RESERVATION_user_service_idx` (`user_id` ASC, `service_id` ASC),
+  CONSTRAINT `fk_RESERVATION_user1`
+    FOREIGN KEY (`user_id`)
+    REFERENCES `compbiomed`.`user` (`id`)
+    ON DELETE NO ACTION
+    ON UPDATE NO ACTION,
+  CONSTRAINT `fk_RESERVATION_SERVICE1`
+    FOREIGN KEY (`service_id`)
+    REFERENCES `compbiomed`.`SERVICE` (`id`)
+    ON DELETE NO ACTION
+    ON UPDATE NO ACTION)
+ENGINE = InnoDB;
+
+
+-- -----------------------------------------------------
+-- Table `compbiomed`.`STAGED_FILE`
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS `compbiomed`.`STAGED_FILE` (
+  `id` INT NOT NULL AUTO_INCREMENT,
+  `local_job_id` VARCHAR(128) NOT NULL,
+  `service_id` INT NOT NULL,
+  `name` VARCHAR(256) NOT NULL,
+  `hash` VARCHAR(64) NOT NULL,
+  `staged` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  INDEX `STAGED_FILE_job_idx` (`local_job_id` ASC, `name` ASC))
+ENGINE = InnoDB;
+
+
+-- -----------------------------------------------------
+-- Table `compbiomed`.`JOB_ARCHIVE`
+-- jobs moved out of JOB some time after they were deleted or finished.
+-- the columns are those of JOB, followed by the time the job was archived
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS `compbiomed`.`JOB_ARCHIVE` (
+  `id` INT NOT NULL,
+  `name` VARCHAR(45) NOT NULL,
+  `state` VARCHAR(45) NULL DEFAULT 'NEW',
+  `user_id` INT NOT NULL,
+  `service_id` INT NOT NULL,
+  `input_set_id` INT NULL,
+  `local_job_id` VARCHAR(128) NOT NULL,
+  `remote_job_id` VARCHAR(256) NULL DEFAULT NULL,
+  `created` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `last_modified` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  `executable` VARCHAR(256) NULL DEFAULT NULL,
+  `arguments` VARCHAR(256) NULL DEFAULT NULL,
+  `env` VARCHAR(45) NULL DEFAULT NULL,
+  `num_total_cpus` INT NULL DEFAULT NULL,
+  `total_physical_memory` VARCHAR(45) NULL DEFAULT NULL,
+  `working_directory` VARCHAR(256) NULL DEFAULT NULL,
+  `wallclock_limit` VARCHAR(45) NULL DEFAULT NULL,
+  `project` VARCHAR(45) NULL DEFAULT NULL,
+  `queue` VARCHAR(45) NULL DEFAULT NULL,
+  `extended` VARCHAR(1024) NULL DEFAULT NULL,
+  `retrieved` TINYINT(1) NULL DEFAULT 0,
+  `filter` VARCHAR(512) NULL DEFAULT NULL,
+  `array_id` VARCHAR(128) NULL DEFAULT NULL,
+  `array_index` INT NULL DEFAULT NULL,
+  `auto_cpus` TINYINT(1) NULL DEFAULT 0,
+  `fluid_sites` BIGINT NULL DEFAULT NULL,
+  `auto_walltime` TINYINT(1) NULL DEFAULT 0,
+  `runtime` INT NULL DEFAULT NULL,
+  `reuse` TINYINT(1) NULL DEFAULT 0,
+  `input_hash` VARCHAR(64) NULL DEFAULT NULL,
+  `reused_from` VARCHAR(128) NULL DEFAULT NULL,
+  `hold` TINYINT(1) NULL DEFAULT 0,
+  `template_id` INT NULL DEFAULT NULL,
+  `archived` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  UNIQUE INDEX `local_job_id_UNIQUE` (`local_job_id` ASC),
+  INDEX `JOB_ARCHIVE_array_idx` (`array_id` ASC, `array_index` ASC),
+  INDEX `JOB_ARCHIVE_runtime_idx` (`service_id` ASC, `template_id` ASC, `runtime` ASC),
+  INDEX `JOB_ARCHIVE_reused_from_idx` (`reused_from` ASC),
+  INDEX `JOB_ARCHIVE_user_created_idx` (`user_id` ASC, `created` ASC, `id` ASC),
+  INDEX `JOB_ARCHIVE_created_idx` (`created` ASC, `id` ASC))
+ENGINE = InnoDB;
+
+
+-- -----------------------------------------------------
+-- Table `compbiomed`.`USER_JOB_COUNT`
+-- the number of jobs each user has that aren't deleted, archived or not, kept up to date as jobs are
+-- created and deleted. a user's row is added by their first job created after the table
+-- -----------------------------------------------------
+CREATE TABLE IF NOT EXISTS `compbiomed`.`USER_JOB_COUNT` (
+  `user_id` INT NOT NULL,
+  `active_jobs` INT NOT NULL DEFAULT 0,
+  PRIMARY KEY (`user_id`),
+  CONSTRAINT `fk_USER_JOB_COUNT_user1`
+    FOREIGN KEY (`user_id`)
+    REFERENCES `compbiomed`.`user` (`id`)
+    ON DELETE NO ACTION
+    ON UPDATE NO ACTION)
+ENGINE = InnoDB;
+
+
 SET SQL_MODE=@OLD_SQL_MODE;
 SET FOREIGN_KEY_CHECKS=@OLD_FOREIGN_KEY_CHECKS;
 SET UNIQUE_CHECKS=@OLD_UNIQUE_CHECKS;
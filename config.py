@@ -1,3 +1,5 @@
+import os
+
 # Create dummy secret key so we can use sessions
 SECRET_KEY = '*********'
 
@@ -11,6 +13,12 @@ DATABASE_FILE = 'compbiomed'
 # assuming webservice and database are on same server, config database to only accept requests on localhost
 SQLALCHEMY_DATABASE_URI = 'mysql://<user>:<pass>@localhost/' + DATABASE_FILE
 
+# local mode, for tests and benchmarks without a MySQL server: HOFF_DATABASE_URI, if set, replaces the
+# database with SQLite, eg 'sqlite:////tmp/compbiomed.db' for a file or 'sqlite://' for an in-memory
+# database, whose tables are created from schema.py when the app starts. an in-memory database only
+# suits running one request or task at a time; use a file for anything concurrent
+SQLALCHEMY_DATABASE_URI = os.environ.get('HOFF_DATABASE_URI', SQLALCHEMY_DATABASE_URI)
+
 # path for static web content
 APP_STATIC_URL = '/home/ubuntu/PycharmProjects/hemelb-hoff/static'
 
@@ -19,6 +27,16 @@ APP_LOGFILE = '/home/ubuntu/foo.log'
 
 SQLALCHEMY_ECHO = False
 
+# database connection pool: connections kept open, extra connections allowed when they are all in use, and
+# seconds to wait for one before giving up. connections are replaced after SQLALCHEMY_POOL_RECYCLE seconds,
+# well inside MySQL's wait_timeout, and checked before use in case the server has dropped them anyway.
+# requests and background tasks (scheduler and submission workers) each hold a connection while they run
+SQLALCHEMY_POOL_SIZE = 10
+SQLALCHEMY_MAX_OVERFLOW = 20
+SQLALCHEMY_POOL_TIMEOUT = 30
+SQLALCHEMY_POOL_RECYCLE = 3600
+SQLALCHEMY_POOL_PRE_PING = True
+
 # Flask-Security config
 SECURITY_URL_PREFIX = "/admin"
 # specify the hashing algorithm
@@ -63,9 +81,72 @@ TEMP_FOLDER = "/home/ubuntu/temp"
 # DELETED jobs are not counted
 MAX_USER_JOBS = 10
 
+# number of jobs listed per page by GET /jobs, unless the client asks for another number up to the maximum
+JOB_LIST_DEFAULT_LIMIT = 100
+JOB_LIST_MAX_LIMIT = 1000
+
+# jobs that were deleted, or that finished, more than ARCHIVE_AGE days ago are moved out of the JOB table
+# into JOB_ARCHIVE every ARCHIVE_PERIOD minutes, ARCHIVE_BATCH_SIZE at a time. archived jobs can still be
+# looked up one at a time, and listed with GET /jobs?archived=true
+ARCHIVE_AGE = 30
+ARCHIVE_PERIOD = 60
+ARCHIVE_BATCH_SIZE = 500
+
 # time (in minutes) to wait before checking remote job state
 REMOTE_JOB_STATE_REFRESH_PERIOD = 2
 
+# time (in minutes) between snapshots of each service's queue, used to pick a service
+# for jobs created with service "auto"
+QUEUE_SNAPSHOT_REFRESH_PERIOD = 5
+
+# pilot jobs: small jobs are packed into one long-running allocation per service and project,
+# rather than each waiting in the queue for a node of its own. off by default, as a pilot holds
+# its allocation until it has been idle for PILOT_IDLE_TIMEOUT
+USE_PILOT_JOBS = False
+# largest job (in cores) that is run in a pilot
+PILOT_MAX_CPUS = 2
+# size of the pilot's allocation in cores, and its wallclock limit in minutes
+PILOT_NUM_CPUS = 36
+PILOT_WALLCLOCK_LIMIT = 240
+# seconds a pilot waits with nothing to run before giving back its allocation
+PILOT_IDLE_TIMEOUT = 600
+
+# job submissions (staging and qsub) run on a pool of this many workers, shared round-robin between users.
+# no user, and no service, has more than the given number of submissions running at once
+SUBMISSION_WORKERS = 4
+SUBMISSION_MAX_PER_USER = 2
+SUBMISSION_MAX_PER_SERVICE = 4
+
+# time (in seconds) between attempts to submit jobs held in the QUEUED state by a service's
+# qsub rate or in-flight limits (set per service in the SERVICE table)
+QUEUED_JOB_DRAIN_PERIOD = 10
+
+# walltime prediction for jobs created with wallclock_limit "auto": the number of earlier runs of a
+# template considered, the fewest needed for a prediction, and the safety margin added, as a fraction
+# of the predicted run time plus a number of minutes
+WALLTIME_HISTORY = 50
+WALLTIME_MIN_SAMPLES = 5
+WALLTIME_MARGIN = 0.5
+WALLTIME_PADDING = 5
+
+# time (in seconds) service configurations are cached for before being read from the SERVICE table again.
+# changes made through the ORM take effect at once; changes made directly in the database
+# are picked up within this time
+SERVICE_CACHE_MAX_AGE = 300
+
+# likewise for job templates, which are also reloaded whenever one is saved or deleted in the admin interface
+TEMPLATE_CACHE_MAX_AGE = 300
+
+# time (in seconds) a user's roles are remembered between requests. changes made in the admin interface
+# take effect at once. 0 looks the roles up afresh for every request
+PRINCIPAL_CACHE_MAX_AGE = 60
+
+# copy input files to a job's service in the background as soon as they are uploaded,
+# rather than when the job is submitted. off by default, as it copies files for jobs that may never run
+SPECULATIVE_STAGING = False
+# number of workers for speculative staging, apart from the submission workers
+SPECULATIVE_STAGING_WORKERS = 2
+
 # WOS config stuff
 USE_WOS = True
 # configer the S3 endpoint, region and credentials. Could be any S3-compatible service, but here we assume its the CIRRUS WOS
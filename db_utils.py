@@ -0,0 +1,220 @@
+"""
+   Copyright 2018-2019 EPCC, University Of Edinburgh
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+# Data access for the raw SQL in the app. Each request runs its statements on one pooled connection,
+# in one transaction that is committed when the request ends, or rolled back if it fails. Each
+# background task likewise runs on one connection of its own. Statements are built once and their
+# compiled forms cached, so running one again only binds the new parameters.
+
+import contextlib
+import datetime
+import functools
+import threading
+from flask import has_request_context
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.sql import text, bindparam
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+
+    # Flask-SQLAlchemy 2.3 takes the pool size, overflow, timeout and recycle time from the app config,
+    # but has no setting for pre-ping, so it is added to the engine options here. pre-ping checks each
+    # connection as it leaves the pool, so one the server has dropped is replaced rather than failing.
+    #
+    # SQLite, used when running locally, has no server to pool connections to: a file database opens
+    # a connection as each is needed, and an in-memory one shares a single connection between all
+    # threads, so is only suitable for running one request or task at a time. the pool timeout is used
+    # instead as the time to wait for another connection to finish writing
+
+    def apply_driver_hacks(self, app, info, options):
+        sqlite = info.drivername.startswith('sqlite')
+        if sqlite:
+            for option in ['pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle']:
+                options.pop(option, None)
+            timeout = app.config.get('SQLALCHEMY_POOL_TIMEOUT')
+            if timeout is not None:
+                options.setdefault('connect_args', {})['timeout'] = timeout
+
+        rv = super(PooledSQLAlchemy, self).apply_driver_hacks(app, info, options)
+        if not sqlite:
+            options.setdefault('pool_pre_ping', app.config.get('SQLALCHEMY_POOL_PRE_PING', True))
+        return rv
+
+
+_db = None
+
+# (sql, names of list parameters) -> statement
+_statements = {}
+
+# compiled forms of the statements, for all connections
+_compiled_cache = {}
+
+# the connection, and transaction if any, of the request or task running on this thread
+_local = threading.local()
+
+
+def init_app(app, db):
+
+    global _db
+    _db = db
+    app.after_request(_check_response)
+    app.teardown_request(_end_request)
+
+
+def statement(sql, expanding=()):
+
+    # the statement for some SQL, built the first time it's asked for. parameters named in expanding
+    # take a list of values, for use in IN clauses
+    key = (sql, tuple(sorted(expanding)))
+    stmt = _statements.get(key)
+    if stmt is None:
+        stmt = text(sql)
+        if len(expanding) > 0:
+            stmt = stmt.bindparams(*[bindparam(name, expanding=True) for name in expanding])
+        _statements[key] = stmt
+    return stmt
+
+
+def _connect(**kwargs):
+
+    return _db.engine.connect(**kwargs).execution_options(compiled_cache=_compiled_cache)
+
+
+def _current():
+
+    # the connection of the request or task running on this thread, if any. a request's connection and
+    # transaction are started by its first statement, so requests that don't use the database don't take one
+    connection = getattr(_local, 'connection', None)
+    if connection is None and has_request_context():
+        connection = _local.connection = _connect()
+        _local.transaction = connection.begin()
+        _local.failed = False
+    return connection
+
+
+def _prepare(sql, params):
+
+    stmt = sql
+    if not hasattr(sql, 'compile'):
+        stmt = statement(sql, [k for k, v in params.items() if isinstance(v, (list, tuple))])
+
+    connection = _current()
+    if connection is None:
+        # outside any request or task the statement runs, and commits, on its own. the connection goes
+        # back to the pool once the result has been read
+        connection = _connect(close_with_result=True)
+    return connection, stmt
+
+
+def execute(sql, **params):
+
+    # run a statement, given as SQL or a statement. parameters given a list or tuple are expanded,
+    # so "state IN :states" can be passed states=['NEW', 'QUEUED']
+    connection, stmt = _prepare(sql, params)
+    return connection.execute(stmt, **params)
+
+
+def stream(sql, **params):
+
+    # like execute, but the rows come from a server side cursor as they're read, rather than all being
+    # fetched at once. nothing else can run on the connection until they've all been read
+    connection, stmt = _prepare(sql, params)
+    return connection.execution_options(stream_results=True).execute(stmt, **params)
+
+
+def to_datetime(value):
+
+    # DATETIME columns read with raw SQL come back as datetimes from MySQL, but as text from SQLite
+    if isinstance(value, basestring):
+        return datetime.datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S')
+    return value
+
+
+def commit():
+
+    # commit what the current request has done so far, and carry on in a new transaction. needed before
+    # handing work that reads what the request wrote to a background task, which can't see it till then
+    transaction = getattr(_local, 'transaction', None)
+    if transaction is not None:
+        transaction.commit()
+        _local.transaction = _local.connection.begin()
+
+
+@contextlib.contextmanager
+def transaction():
+
+    # run the statements in the block in one transaction, for a background task whose statements otherwise
+    # commit as they go. within a request, whose statements are already in a transaction, it changes nothing
+    connection = _current()
+    if connection is None:
+        raise Exception("no connection to run a transaction on")
+    trans = connection.begin()
+    try:
+        yield
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+
+
+def task(fn):
+
+    # runs a background task on one connection of its own. its statements commit as they go rather than
+    # in one transaction, as tasks hold their connection across slow remote calls, and mustn't keep rows
+    # locked while they do. a task called from another request or task shares that one's connection
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if getattr(_local, 'connection', None) is not None:
+            return fn(*args, **kwargs)
+
+        _local.connection = _connect()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            connection = _local.connection
+            _local.connection = None
+            connection.close()
+
+    return wrapper
+
+
+def _check_response(response):
+
+    # abort(500) is turned into a response rather than reaching teardown as an exception, so
+    # server errors are noted here for the transaction to be rolled back
+    if response.status_code >= 500:
+        _local.failed = True
+    return response
+
+
+def _end_request(exc):
+
+    connection = getattr(_local, 'connection', None)
+    if connection is None:
+        return
+
+    transaction = _local.transaction
+    failed = _local.failed or exc is not None
+    _local.connection = None
+    _local.transaction = None
+    _local.failed = False
+    try:
+        if failed:
+            transaction.rollback()
+        else:
+            transaction.commit()
+    finally:
+        connection.close()
@@ -1,3 +1,6 @@
+import saga_utils
+
+
 class BaseJob:
 
     def set_local_id(id):
@@ -21,12 +24,25 @@ class BaseJob:
     def delete_job(self):
         pass
 
-    def create_reservation(self):
+    def create_reservation(self, reservation_description, service):
         pass
 
-    def delete_reservation(self):
+    def delete_reservation(self, reservation_id, service):
         pass
 
     def submit_job(self, job_description, endpoint):
         pass
 
+
+class PBSProJob(BaseJob):
+
+    # advance reservations on a PBSPro service, which SAGA has no API for
+
+    def create_reservation(self, reservation_description, service):
+        return saga_utils.create_reservation(reservation_description, service)
+
+    def delete_reservation(self, reservation_id, service):
+        saga_utils.delete_reservation(reservation_id, service)
+
+    def get_reservation_info(self, reservation_id, service):
+        return saga_utils.get_reservation_info(reservation_id, service)
@@ -0,0 +1,171 @@
+"""
+   Copyright 2018-2019 EPCC, University Of Edinburgh
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+# The job state machine. Every change of a job's state is a conditional UPDATE that only applies if the job
+# is still in one of the states it was expected to be in, and reports whether it applied. Whoever moves a job
+# out of a state owns the work that follows, so two submissions, refreshes or retrievals of the same job
+# can't both go ahead: the second one finds the job has already moved on, and stops.
+
+from sqlalchemy.exc import IntegrityError
+from db_utils import execute
+
+NEW = 'NEW'
+STAGING = 'STAGING'
+STAGING_FAILED = 'STAGING_FAILED'
+QUEUED = 'QUEUED'
+SUBMITTED = 'SUBMITTED'
+FAILED = 'FAILED'
+CANCELED = 'Canceled'
+DELETED = 'DELETED'
+
+# the final states of a job that ran, as reported by SAGA
+DONE_STATES = ['Done', 'DONE']
+FINISHED_STATES = DONE_STATES + ['Failed', 'FAILED']
+
+# STAGING covers everything between a job being taken for submission and its qsub: sizing, staging its
+# inputs, and submitting it. a job is also STAGING while its inputs are staged after a held qsub, and
+# while a job QUEUED by a busy service is being submitted
+TRANSITIONS = {
+    NEW: [STAGING],
+    # a job taken for submission goes back to NEW if the rest of its array couldn't be taken with it
+    STAGING: [NEW, QUEUED, SUBMITTED, FAILED, STAGING_FAILED] + DONE_STATES,
+    QUEUED: [STAGING, CANCELED],
+    SUBMITTED: [CANCELED] + FINISHED_STATES,
+}
+
+ALL_STATES = [NEW, STAGING, STAGING_FAILED, QUEUED, SUBMITTED, FAILED, CANCELED, DELETED] + FINISHED_STATES
+
+# any job can be deleted
+for s in ALL_STATES:
+    if s != DELETED:
+        TRANSITIONS.setdefault(s, []).append(DELETED)
+
+# values of the retrieved column. a retrieval in progress isn't shown to clients
+NOT_RETRIEVED = 0
+RETRIEVED = 1
+RETRIEVING = 2
+
+
+class TransitionError(Exception):
+    pass
+
+
+def _check(expected, state, values):
+
+    # moving a job to the state it's already in just updates its other columns
+    for e in expected:
+        if state != e and state not in TRANSITIONS.get(e, []):
+            raise TransitionError("a job can't go from " + e + " to " + state)
+    for column in values:
+        if column == 'state' or not column.replace('_', '').isalnum():
+            raise TransitionError("can't set " + column + " with the state")
+
+
+def _update(key_column, key, expected, state, values):
+
+    _check(expected, state, values)
+    cmd = "UPDATE JOB SET state=:new_state"
+    for column in sorted(values.keys()):
+        cmd += ", " + column + "=:" + column
+    cmd += " WHERE " + key_column + "=:key AND state IN :expected"
+    return execute(cmd, new_state=state, key=key, expected=list(expected), **values).rowcount
+
+
+def transition(local_job_id, expected, state, **values):
+
+    # move a job to state, setting any other columns given with it, if it's still in one of the expected
+    # states. returns whether it was, and so whether this caller now owns the job's next step
+    return _update('local_job_id', local_job_id, expected, state, values) == 1
+
+
+def transition_array(array_id, expected, state, **values):
+
+    # move the jobs of an array that are in one of the expected states to state. returns how many moved
+    return _update('array_id', array_id, expected, state, values)
+
+
+def claim_array(array_id, expected, state):
+
+    # move the jobs of an array that are in one of the expected states to state, and return them as
+    # (subjob index, JOB record) pairs. the array is submitted with just these jobs, which PBS runs as
+    # subjobs 0, 1, ... in order of array_index; once any of the array's other jobs have been cancelled
+    # or deleted, a job's subjob index is no longer its array_index
+    if transition_array(array_id, expected, state) == 0:
+        return []
+    cmd = "SELECT * FROM JOB WHERE array_id=:array_id AND state=:state ORDER BY array_index"
+    return list(enumerate(execute(cmd, array_id=array_id, state=state).fetchall()))
+
+
+def claim_retrieval(local_job_id):
+
+    # whether the caller is the one to retrieve a finished job's outputs
+    cmd = "UPDATE JOB SET retrieved=:retrieving WHERE local_job_id=:local_job_id AND retrieved=:not_retrieved"
+    result = execute(cmd, retrieving=RETRIEVING, not_retrieved=NOT_RETRIEVED, local_job_id=local_job_id)
+    return result.rowcount == 1
+
+
+def finish_retrieval(local_job_id):
+
+    cmd = "UPDATE JOB SET retrieved=:retrieved WHERE local_job_id=:local_job_id"
+    execute(cmd, retrieved=RETRIEVED, local_job_id=local_job_id)
+
+
+def abandon_retrieval(local_job_id):
+
+    # a retrieval that failed leaves the job not retrieved, as it found it
+    cmd = "UPDATE JOB SET retrieved=:not_retrieved WHERE local_job_id=:local_job_id AND retrieved=:retrieving"
+    execute(cmd, not_retrieved=NOT_RETRIEVED, retrieving=RETRIEVING, local_job_id=local_job_id)
+
+
+def mark_deleted(local_job_id):
+
+    # delete a job from whatever state it's in, in JOB or the archive. returns whether this caller deleted it
+    for table in ['JOB', 'JOB_ARCHIVE']:
+        cmd = "UPDATE " + table + " SET state=:deleted WHERE local_job_id=:local_job_id AND state!=:deleted"
+        if execute(cmd, deleted=DELETED, local_job_id=local_job_id).rowcount == 1:
+            cmd = "UPDATE USER_JOB_COUNT SET active_jobs=active_jobs-1 WHERE active_jobs>0 AND " \
+                  "user_id=(SELECT user_id FROM " + table + " WHERE local_job_id=:local_job_id)"
+            execute(cmd, local_job_id=local_job_id)
+            return True
+    return False
+
+
+def admit_jobs(user_id, count, limit):
+
+    # count count new jobs against the user, if that leaves them with no more than limit jobs. returns
+    # whether it did. the user's count stays locked till the caller's transaction ends, so jobs created
+    # at the same time can't take them over their limit between them
+    cmd = "UPDATE USER_JOB_COUNT SET active_jobs=active_jobs+:count " \
+          "WHERE user_id=:user_id AND active_jobs+:count<=:limit"
+    if execute(cmd, count=count, limit=limit, user_id=user_id).rowcount == 1:
+        return True
+
+    cmd = "SELECT active_jobs FROM USER_JOB_COUNT WHERE user_id=:user_id"
+    if execute(cmd, user_id=user_id).fetchone() is not None:
+        return False
+
+    # the user's first job since they were counted; start from the jobs they already have
+    active_jobs = 0
+    for table in ['JOB', 'JOB_ARCHIVE']:
+        cmd = "SELECT COUNT(id) AS n FROM " + table + " WHERE user_id=:user_id AND state!=:deleted"
+        active_jobs += int(execute(cmd, user_id=user_id, deleted=DELETED).fetchone()['n'])
+    try:
+        cmd = "INSERT INTO USER_JOB_COUNT(user_id, active_jobs) VALUES(:user_id, :active_jobs)"
+        execute(cmd, user_id=user_id, active_jobs=active_jobs)
+    except IntegrityError:
+        # another request started the count first
+        pass
+    return admit_jobs(user_id, count, limit)
@@ -0,0 +1,147 @@
+"""
+   Copyright 2018-2019 EPCC, University Of Edinburgh
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import collections
+import re
+import threading
+import time
+
+
+# the columns of a JOB_TEMPLATE row that go into a job
+TEMPLATE_FIELDS = ['id', 'name', 'description', 'family', 'service_id', 'input_set_id', 'executable', 'arguments',
+                   'env', 'num_total_cpus', 'total_physical_memory', 'wallclock_limit', 'project', 'queue',
+                   'extended', 'filter']
+
+# a template, checked and parsed once when loaded. argument_list and env_dict are the arguments split
+# into a list and the env as a dict, filter_regex the compiled filter. error says what's wrong with
+# a template that can't be used, or is None
+JobTemplate = collections.namedtuple('JobTemplate',
+                                     TEMPLATE_FIELDS + ['argument_list', 'env_dict', 'filter_regex', 'error'])
+
+
+def split_arguments(arguments):
+
+    if arguments is None:
+        return None
+    return [str(s) for s in arguments.split()]
+
+
+# names that can be exported to a job's shell environment
+ENV_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def parse_env(env):
+
+    # env takes the form name=value name=value etc; raises an exception if it doesn't
+    if env is None:
+        return None
+    env_dict = {}
+    for p in [str(s) for s in env.split()]:
+        q = p.split("=")
+        if len(q) < 2 or ENV_NAME_RE.match(q[0]) is None:
+            raise ValueError("invalid environment variable '%s'" % p)
+        env_dict[q[0]] = q[1]
+    return env_dict
+
+
+def compile_template(row):
+
+    fields = dict([(k, row[k]) for k in TEMPLATE_FIELDS])
+    error = None
+
+    filter_regex = None
+    if fields['filter'] is not None:
+        try:
+            filter_regex = re.compile(fields['filter'])
+        except Exception as e:
+            error = "Invalid filter specification: " + str(e)
+
+    # a template env that can't be parsed is left out of the job's environment, rather than stopping the job
+    try:
+        env_dict = parse_env(fields['env'])
+    except Exception:
+        env_dict = None
+
+    return JobTemplate(argument_list=split_arguments(fields['arguments']), env_dict=env_dict,
+                       filter_regex=filter_regex, error=error, **fields)
+
+
+class TemplateRegistry(object):
+
+    # the job templates, compiled and held in memory so that creating a job needs no query. load returns
+    # the JOB_TEMPLATE rows; they are compiled again when the registry is invalidated, as it is when a
+    # template is saved or deleted, or when they're older than max_age seconds, to pick up direct edits
+
+    def __init__(self, load, max_age):
+
+        self._load = load
+        self.max_age = max_age
+
+        self._lock = threading.Lock()
+        self._version = 0
+        self._templates = None
+        self._loaded_time = 0
+
+    def invalidate(self):
+
+        with self._lock:
+            self._version += 1
+            self._templates = None
+
+    def get(self, name):
+
+        templates = self._get_templates()
+        if name not in templates:
+            # it may have been added since the templates were loaded
+            templates = self._reload()
+        return templates.get(name)
+
+    def get_by_id(self, id):
+
+        # the template a job was created from. one deleted since isn't looked for again
+        for t in self._get_templates().values():
+            if t.id == id:
+                return t
+        return None
+
+    def family(self, family):
+
+        return [t for t in self._get_templates().values() if t.family == family]
+
+    def all(self):
+
+        templates = self._get_templates()
+        return [templates[name] for name in sorted(templates.keys())]
+
+    def _get_templates(self):
+
+        templates = self._templates
+        if templates is None or time.time() - self._loaded_time > self.max_age:
+            templates = self._reload()
+        return templates
+
+    def _reload(self):
+
+        with self._lock:
+            version = self._version
+
+        templates = dict([(t.name, t) for t in [compile_template(row) for row in self._load()]])
+
+        with self._lock:
+            if self._version == version:
+                self._templates = templates
+                self._loaded_time = time.time()
+        return templates
@@ -17,16 +17,126 @@ from saga.job.constants import *
 
 import re
 import os 
+import pipes
 import time
+import json
 import threading
+import collections
 
 from cgi  import parse_qs
 
 SYNC_CALL  = saga.adaptors.cpi.decorators.SYNC_CALL
 ASYNC_CALL = saga.adaptors.cpi.decorators.ASYNC_CALL
 
-SYNC_WAIT_UPDATE_INTERVAL =  1  # seconds
 MONITOR_UPDATE_INTERVAL   = 60  # seconds
+MONITOR_WAIT_INTERVAL     = 10  # seconds, used while someone waits for a job
+
+# longest command line we send through the pty shell when batching job ids
+MAX_COMMAND_LENGTH        = 4000  # characters
+
+# how many jobs in a final state the job service remembers. older ones are
+# forgotten, and looked up again with qstat if anyone asks for them
+MAX_FINAL_JOBS            = 1000
+
+# ends the here document that carries a job script to the remote shell
+SCRIPT_DELIMITER          = "SAGA_PBSPRO_JOB_SCRIPT_EOF"
+
+# the hoff passes directives that SAGA has no attribute for (eg job arrays)
+# as a JSON document in the otherwise unused spmd_variation attribute,
+# marked with this prefix
+HOFF_DIRECTIVES_PREFIX    = "hoff:"
+
+
+_FINAL_STATES = [saga.job.DONE, saga.job.FAILED, saga.job.CANCELED]
+
+
+# --------------------------------------------------------------------
+#
+class _job_record(object):
+    """ what a job service knows about one job. Slots keep the per-job
+        footprint small; item access keeps the dict interface the rest of
+        the adaptor uses.
+    """
+    __slots__ = ('obj', 'job_id', 'name', 'state', 'exec_hosts', 'returncode',
+                 'create_time', 'start_time', 'end_time', 'gone')
+
+    def __init__(self, **kwargs):
+        for key in self.__slots__:
+            setattr(self, key, kwargs.get(key))
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, val):
+        try:
+            setattr(self, key, val)
+        except AttributeError:
+            raise KeyError(key)
+
+
+# --------------------------------------------------------------------
+#
+class _job_registry(object):
+    """ job id -> _job_record for every job a job service knows about.
+        Jobs in a final state are evicted, least recently used first, once
+        there are more than max_final of them, so a long lived service does
+        not grow without bound. Active jobs are never evicted, as the monitor
+        thread and any waiters rely on them.
+    """
+    def __init__(self, max_final=MAX_FINAL_JOBS):
+
+        self._max_final = max_final
+        self._active    = dict()
+        self._final     = collections.OrderedDict()
+        self._lock      = threading.RLock()
+
+    def __contains__(self, job_id):
+        with self._lock:
+            return job_id in self._active or job_id in self._final
+
+    def __len__(self):
+        with self._lock:
+            return len(self._active) + len(self._final)
+
+    def __getitem__(self, job_id):
+        record = self.get(job_id)
+        if record is None:
+            raise KeyError(job_id)
+        return record
+
+    def __setitem__(self, job_id, record):
+        with self._lock:
+            self._active.pop(job_id, None)
+            self._final.pop(job_id, None)
+
+            if record['state'] in _FINAL_STATES:
+                self._final[job_id] = record
+                while len(self._final) > self._max_final:
+                    self._final.popitem(last=False)
+            else:
+                self._active[job_id] = record
+
+    def get(self, job_id, default=None):
+        with self._lock:
+            if job_id in self._active:
+                return self._active[job_id]
+            if job_id in self._final:
+                # mark as most recently used
+                record = self._final.pop(job_id)
+                self._final[job_id] = record
+                return record
+            return default
+
+    def keys(self):
+        with self._lock:
+            return self._active.keys() + self._final.keys()
+
+    def active_keys(self):
+        with self._lock:
+            return self._active.keys()
 
 
 # --------------------------------------------------------------------
@@ -39,12 +149,19 @@ class _job_state_monitor(threading.Thread):
         self.logger = job_service._logger
         self.js = job_service
         self._stop = threading.Event()
+        self._wakeup = threading.Event()
 
         super(_job_state_monitor, self).__init__()
         self.setDaemon(True)
 
     def stop(self):
         self._stop.set()
+        self._wakeup.set()
+
+    def wakeup(self):
+        """ cut the current sleep short, eg because someone started waiting
+        """
+        self._wakeup.set()
 
 
     def run(self):
@@ -60,14 +177,14 @@ class _job_state_monitor(threading.Thread):
                 # job by job. that would be too inefficient!
                 jobs = self.js.jobs
 
-                for job_id in jobs.keys() :
+                # we only need to monitor jobs that are not in a
+                # terminal state, so we can skip the ones that are 
+                # either done, failed or canceled
+                for job_id in jobs.active_keys() :
 
-                    job_info = jobs[job_id]
+                    job_info = jobs.get(job_id)
 
-                    # we only need to monitor jobs that are not in a
-                    # terminal state, so we can skip the ones that are 
-                    # either done, failed or canceled
-                    if  job_info['state'] not in [saga.job.DONE, saga.job.FAILED, saga.job.CANCELED] :
+                    if  job_info is not None and job_info['state'] not in _FINAL_STATES :
 
                         # Store the current state since the current state 
                         # variable is updated when _job_get_info is called
@@ -81,10 +198,11 @@ class _job_state_monitor(threading.Thread):
                         # fire job state callback if 'state' has changed
                         if  new_job_info['state'] != pre_update_state:
                             job_obj = job_info['obj']
-                            job_obj._attributes_i_set('state', new_job_info['state'], job_obj._UP, True)
+                            if  job_obj is not None:
+                                job_obj._attributes_i_set('state', new_job_info['state'], job_obj._UP, True)
 
-                        # update job info
-                        jobs[job_id] = new_job_info
+                        # update job info, and wake anyone waiting on it
+                        self.js._job_set_info(job_id, new_job_info)
 
             except Exception as e:
                 import traceback
@@ -103,7 +221,61 @@ class _job_state_monitor(threading.Thread):
                         return
 
             finally :
-                time.sleep (MONITOR_UPDATE_INTERVAL)
+                # poll more often while someone is blocked in a wait. a timed
+                # Event.wait polls every 50ms on python 2, so a timer sets the
+                # event instead, and we block on it untimed
+                if  self.js._waiters > 0 :
+                    interval = MONITOR_WAIT_INTERVAL
+                else :
+                    interval = MONITOR_UPDATE_INTERVAL
+                timer = threading.Timer (interval, self._wakeup.set)
+                timer.setDaemon (True)
+                timer.start ()
+                self._wakeup.wait ()
+                timer.cancel ()
+                self._wakeup.clear ()
+
+
+# --------------------------------------------------------------------
+#
+def qdel_jobs(job_ids, pids, qdel, run):
+    """ cancel many jobs with as few 'qdel' calls as the command line length
+        allows. pids maps each job id to its PBS id, and run runs a shell
+        command, returning its exit code and output. returns a dict of job id
+        to None on success, or the error reported by qdel for that job
+    """
+    errors = dict([(job_id, None) for job_id in job_ids])
+
+    chunks = [[]]
+    length = len(qdel)
+    for job_id in job_ids:
+        if chunks[-1] and length + len(pids[job_id]) + 3 > MAX_COMMAND_LENGTH:
+            chunks.append([])
+            length = len(qdel)
+        chunks[-1].append(job_id)
+        length += len(pids[job_id]) + 3
+
+    for chunk in chunks:
+        if not chunk:
+            continue
+
+        ret, out = run("%s %s" % (qdel, ' '.join(["'%s'" % pids[job_id] for job_id in chunk])))
+
+        if ret != 0:
+            # qdel carries on past ids it can't delete, and reports each
+            # of them on a line of its own, eg
+            #     qdel: Unknown Job Id 1234.host
+            matched = False
+            for line in out.split('\n'):
+                for job_id in chunk:
+                    if re.search(r'(^|\s)%s(\.|\s|$)' % re.escape(pids[job_id]), line):
+                        errors[job_id] = line.strip()
+                        matched   = True
+            if not matched:
+                for job_id in chunk:
+                    errors[job_id] = out.strip()
+
+    return errors
 
 
 # --------------------------------------------------------------------
@@ -130,6 +302,7 @@ def _pbs_to_saga_jobstate(job_state, logger=None):
     # 'E' PBS Pro and TORQUE: Job is exiting after having run
     # 'T' PBS Pro and TORQUE: Job is being moved to new location
     # 'X' PBS Pro           : Subjob has completed execution or has been deleted
+    # 'B' PBS Pro           : Array job has at least one subjob running
 
     ret = None
 
@@ -142,6 +315,7 @@ def _pbs_to_saga_jobstate(job_state, logger=None):
     elif job_state == 'E': ret = saga.job.RUNNING
     elif job_state == 'T': ret = saga.job.RUNNING
     elif job_state == 'X': ret = saga.job.CANCELED
+    elif job_state == 'B': ret = saga.job.RUNNING
     else                 : ret = saga.job.UNKNOWN
 
     logger.debug('check state: %s', job_state)
@@ -149,6 +323,52 @@ def _pbs_to_saga_jobstate(job_state, logger=None):
     return ret
 
 
+# --------------------------------------------------------------------
+#
+def _parse_hoff_directives(jd):
+    """ returns the dict of hoff directives carried in spmd_variation, or an
+        empty dict if spmd_variation holds anything else
+    """
+    spmd_variation = jd.spmd_variation
+
+    if not spmd_variation or not spmd_variation.startswith(HOFF_DIRECTIVES_PREFIX):
+        return dict()
+
+    try:
+        return json.loads(spmd_variation[len(HOFF_DIRECTIVES_PREFIX):])
+    except ValueError as e:
+        raise saga.BadParameter("invalid hoff directives '%s': %s" % (spmd_variation, e))
+
+
+# --------------------------------------------------------------------
+#
+def _array_dispatch_script(jd, subjobs):
+    """ generates the part of an array job script which selects the working
+        directory and arguments of a subjob from $PBS_ARRAY_INDEX
+    """
+    # each argument is quoted into a bash array, so that none of them is
+    # expanded or run by the shell
+    script  = 'case $PBS_ARRAY_INDEX in\n'
+    for index, subjob in enumerate(subjobs):
+        script += '    %d) HOFF_SUBJOB_DIR=%s; HOFF_SUBJOB_ARGS=(%s) ;;\n' \
+                % (index, pipes.quote(subjob['working_directory']),
+                   ' '.join([pipes.quote(arg) for arg in subjob.get('arguments') or []]))
+    script += 'esac\n'
+
+    script += 'export    PBS_O_WORKDIR="$HOFF_SUBJOB_DIR"\n'
+    script += 'mkdir -p  "$HOFF_SUBJOB_DIR"\n'
+    script += 'cd        "$HOFF_SUBJOB_DIR"\n'
+
+    # PBS would collect the output of all subjobs in one place, but the hoff
+    # expects each subjob's stdout and stderr in its own working directory
+    if jd.output and not os.path.isabs(jd.output):
+        script += 'exec 1>%s\n' % jd.output
+    if jd.error and not os.path.isabs(jd.error):
+        script += 'exec 2>%s\n' % jd.error
+
+    return script
+
+
 # --------------------------------------------------------------------
 #
 def _pbscript_generator(url, logger, jd, ppn, gres, pbs_version, is_cray=False,
@@ -159,21 +379,37 @@ def _pbscript_generator(url, logger, jd, ppn, gres, pbs_version, is_cray=False,
     pbs_params  = str()
     exec_n_args = str()
 
+    directives = _parse_hoff_directives(jd)
+
+    # a job array runs one subjob per entry, each with its own working
+    # directory and arguments, from a single submission
+    subjobs = directives.get('array')
 
     if jd.processes_per_host:
         logger.info("Overriding the detected ppn (%d) with the user specified processes_per_host (%d)" % (ppn, jd.processes_per_host))
         ppn = jd.processes_per_host
 
     exec_n_args += 'export SAGA_PPN=%d\n' % ppn
+    if subjobs:
+        exec_n_args += _array_dispatch_script(jd, subjobs)
     if jd.executable:
         exec_n_args += "%s " % (jd.executable)
-    if jd.arguments:
+    if subjobs:
+        exec_n_args += '"${HOFF_SUBJOB_ARGS[@]}" '
+    elif jd.arguments:
         for arg in jd.arguments:
             exec_n_args += "%s " % (arg)
 
     if jd.name:
         pbs_params += "#PBS -N %s \n" % jd.name
 
+    if subjobs:
+        pbs_params += "#PBS -J 0-%d \n" % (len(subjobs) - 1)
+
+    # a held job waits in the queue until the hoff releases it with qrls
+    if directives.get('hold'):
+        pbs_params += "#PBS -h \n"
+
     if (is_cray is "") or not('Version: 4.2.7' in pbs_version):
         # qsub on Cray systems complains about the -V option:
         # Warning:
@@ -211,7 +447,8 @@ def _pbscript_generator(url, logger, jd, ppn, gres, pbs_version, is_cray=False,
                 # user provided a relative path for STDOUT. in this case 
                 # we prepend the workind directory path before passing
                 # it on to PBS
-                pbs_params += "#PBS -o %s/%s \n" % (jd.working_directory, jd.output)
+                pbs_params += "#PBS -o %s/%s%s \n" % (jd.working_directory, jd.output,
+                                                       '.^array_index^' if subjobs else '')
         else:
             pbs_params += "#PBS -o %s \n" % jd.output
 
@@ -226,7 +463,8 @@ def _pbscript_generator(url, logger, jd, ppn, gres, pbs_version, is_cray=False,
                 # user provided a realtive path for STDERR. in this case 
                 # we prepend the workind directory path before passing
                 # it on to PBS
-                pbs_params += "#PBS -e %s/%s \n" % (jd.working_directory, jd.error)
+                pbs_params += "#PBS -e %s/%s%s \n" % (jd.working_directory, jd.error,
+                                                       '.^array_index^' if subjobs else '')
         else:
             pbs_params += "#PBS -e %s \n" % jd.error
 
@@ -385,15 +623,12 @@ def _pbscript_generator(url, logger, jd, ppn, gres, pbs_version, is_cray=False,
     if gres:
         pbs_params += "#PBS -l gres=%s\n" % gres
 
-    # escape all double quotes and dollarsigns, otherwise 'echo |'
-    # further down won't work
-    # only escape '$' in args and exe. not in the params
+    # the script is passed to the remote shell verbatim in a quoted here
+    # document (see _job_run), so nothing needs escaping
     exec_n_args = workdir_directives + exec_n_args
-    exec_n_args = exec_n_args.replace('$', '\\$')
 
     pbscript = "\n#!/bin/bash \n%s%s" % (pbs_params, exec_n_args)
 
-    pbscript = pbscript.replace('"', '\\"')
     logger.info(pbscript)
 
 
@@ -576,9 +811,14 @@ class PBSProJobService (saga.adaptors.cpi.job.Service):
         self.is_cray = ""
         self.queue   = None
         self.shell   = None
-        self.jobs    = dict()
+        self.jobs    = _job_registry()
         self.gres    = None
 
+        # notified whenever a job's info changes, so that waiters can block
+        # rather than poll. _waiters counts the threads currently blocked.
+        self._state_cond = threading.Condition()
+        self._waiters    = 0
+
         # the monitoring thread - one per service instance
         self.mt = _job_state_monitor(job_service=self)
         self.mt.start()
@@ -754,23 +994,35 @@ class PBSProJobService (saga.adaptors.cpi.job.Service):
         except Exception, ex:
             log_error_and_raise(str(ex), saga.BadParameter, self._logger)
 
-        # try to create the working directory (if defined)
-        # WARNING: this assumes a shared filesystem between login node and
-        #          compute nodes.
+        # Now we want to execute the script, in a single round trip to the
+        # remote shell:
+        # (1) we create the working directory (if defined)
+        #     WARNING: this assumes a shared filesystem between login node and
+        #              compute nodes.
+        # (2) we create a temporary file with 'mktemp' and write the script
+        #     into it through a quoted here document. Unlike an 'echo' of the
+        #     escaped script this needs no escaping, and as the script arrives
+        #     line by line its size is not limited by the pty's line length
+        # (3) we call 'qsub <tmpfile>' to submit the script to the queueing
+        #     system, and remove the temporary file
         if jd.working_directory:
             self._logger.info("Creating working directory %s" % jd.working_directory)
-            ret, out, _ = self.shell.run_sync("mkdir -p %s" % (jd.working_directory))
-            if ret != 0:
-                # something went wrong
-                message = "Couldn't create working directory - %s" % (out)
-                log_error_and_raise(message, saga.NoSuccess, self._logger)
+            mkdir = "mkdir -p '%s' && " % jd.working_directory
+        else:
+            mkdir = ""
 
-        # Now we want to execute the script. This process consists of two steps:
-        # (1) we create a temporary file with 'mktemp' and write the contents of 
-        #     the generated PBS script into it
-        # (2) we call 'qsub <tmpfile>' to submit the script to the queueing system
-        cmdline = """SCRIPTFILE=`mktemp -t SAGA-Python-PBSProJobScript.XXXXXX` &&  echo "%s" > $SCRIPTFILE && %s $SCRIPTFILE && rm -f $SCRIPTFILE""" %  (script, self._commands['qsub']['path'])
+        if SCRIPT_DELIMITER in script.split('\n'):
+            log_error_and_raise("PBS script contains the line '%s'" % SCRIPT_DELIMITER,
+                                saga.BadParameter, self._logger)
+
+        cmdline = "%sSCRIPTFILE=`mktemp -t SAGA-Python-PBSProJobScript.XXXXXX` && " \
+                  "cat > $SCRIPTFILE <<'%s' && %s $SCRIPTFILE; RET=$?; rm -f $SCRIPTFILE; test $RET -eq 0\n" \
+                  "%s\n%s" \
+                % (mkdir, SCRIPT_DELIMITER, self._commands['qsub']['path'], script, SCRIPT_DELIMITER)
+
+        time_start  = time.time()
         ret, out, _ = self.shell.run_sync(cmdline)
+        self._logger.debug("qsub round trip took %.3f seconds" % (time.time() - time_start))
 
         if ret != 0:
             # something went wrong
@@ -797,20 +1049,20 @@ class PBSProJobService (saga.adaptors.cpi.job.Service):
             state = saga.job.PENDING
 
             # populate job info dict
-            self.jobs[job_id] = {'obj'         : job_obj,
-                                 'job_id'      : job_id,
-                                 'name'        : job_name,
-                                 'state'       : state,
-                                 'exec_hosts'  : None,
-                                 'returncode'  : None,
-                                 'create_time' : None,
-                                 'start_time'  : None,
-                                 'end_time'    : None,
-                                 'gone'        : False
-                                 }
-
-            self._logger.info ("assign job id  %s / %s / %s to watch list (%s)" \
-                            % (job_name, job_id, job_obj, self.jobs.keys()))
+            self._job_set_info(job_id, _job_record(obj         = job_obj,
+                                                   job_id      = job_id,
+                                                   name        = job_name,
+                                                   state       = state,
+                                                   exec_hosts  = None,
+                                                   returncode  = None,
+                                                   create_time = None,
+                                                   start_time  = None,
+                                                   end_time    = None,
+                                                   gone        = False
+                                                   ))
+
+            self._logger.info ("assign job id  %s / %s / %s to watch list (%d jobs)" \
+                            % (job_name, job_id, job_obj, len(self.jobs)))
 
             # set status to 'pending' and manually trigger callback
             job_obj._attributes_i_set('state', state, job_obj._UP, True)
@@ -882,17 +1134,17 @@ class PBSProJobService (saga.adaptors.cpi.job.Service):
                 return job_info
         else:
             # Create a template data structure
-            job_info = {
-                'job_id':       job_id,
-                'state':        saga.job.UNKNOWN,
-                'name':         None,
-                'exec_hosts':   None,
-                'returncode':   None,
-                'create_time':  None,
-                'start_time':   None,
-                'end_time':     None,
-                'gone':         False
-            }
+            job_info = _job_record(
+                job_id       = job_id,
+                state        = saga.job.UNKNOWN,
+                name         = None,
+                exec_hosts   = None,
+                returncode   = None,
+                create_time  = None,
+                start_time   = None,
+                end_time     = None,
+                gone         = False
+            )
 
         rm, pid = self._adaptor.parse_id(job_id)
 
@@ -1022,14 +1274,14 @@ class PBSProJobService (saga.adaptors.cpi.job.Service):
     def _job_get_state(self, job_id):
         """ get the job's state
         """
-        return self.jobs[job_id]['state']
+        return self._job_info(job_id)['state']
 
     # ----------------------------------------------------------------
     #
     def _job_get_exit_code(self, job_id):
         """ get the job's exit code
         """
-        ret = self.jobs[job_id]['returncode']
+        ret = self._job_info(job_id)['returncode']
 
         # FIXME: 'None' should cause an exception
         if ret == None : return None
@@ -1040,72 +1292,161 @@ class PBSProJobService (saga.adaptors.cpi.job.Service):
     def _job_get_execution_hosts(self, job_id):
         """ get the job's exit code
         """
-        return self.jobs[job_id]['exec_hosts']
+        return self._job_info(job_id)['exec_hosts']
 
     # ----------------------------------------------------------------
     #
     def _job_get_create_time(self, job_id):
         """ get the job's creation time
         """
-        return self.jobs[job_id]['create_time']
+        return self._job_info(job_id)['create_time']
 
     # ----------------------------------------------------------------
     #
     def _job_get_start_time(self, job_id):
         """ get the job's start time
         """
-        return self.jobs[job_id]['start_time']
+        return self._job_info(job_id)['start_time']
 
     # ----------------------------------------------------------------
     #
     def _job_get_end_time(self, job_id):
         """ get the job's end time
         """
-        return self.jobs[job_id]['end_time']
+        return self._job_info(job_id)['end_time']
 
     # ----------------------------------------------------------------
     #
     def _job_cancel(self, job_id):
         """ cancel the job via 'qdel'
         """
-        rm, pid = self._adaptor.parse_id(job_id)
+        errors = self._job_cancel_bulk([job_id])
 
-        ret, out, _ = self.shell.run_sync("%s %s\n" \
-            % (self._commands['qdel']['path'], pid))
-
-        if ret != 0:
-            message = "Error canceling job via 'qdel': %s" % out
+        if errors[job_id] is not None:
+            message = "Error canceling job via 'qdel': %s" % errors[job_id]
             log_error_and_raise(message, saga.NoSuccess, self._logger)
 
-        # assume the job was succesfully canceled
-        self.jobs[job_id]['state'] = saga.job.CANCELED
 
+    # ----------------------------------------------------------------
+    #
+    def _job_cancel_bulk(self, job_ids):
+        """ cancel many jobs with as few 'qdel' calls as the command line
+            length allows. returns a dict of job id to None on success, or
+            the error reported by qdel for that job
+        """
+        pids = dict()
+        for job_id in job_ids:
+            rm, pid = self._adaptor.parse_id(job_id)
+            pids[job_id] = pid
+
+        def run(cmd):
+            ret, out, _ = self.shell.run_sync("%s\n" % cmd)
+            return ret, out
+
+        errors = qdel_jobs(job_ids, pids, self._commands['qdel']['path'], run)
+
+        for job_id in job_ids:
+            # assume the job was succesfully canceled
+            if errors[job_id] is None and job_id in self.jobs:
+                self._job_set_state(job_id, saga.job.CANCELED)
+
+        return errors
+
+
+    # ----------------------------------------------------------------
+    #
+    def _job_info(self, job_id):
+        """ the job's info, looked up again via qstat if it has been
+            evicted from the registry
+        """
+        job_info = self.jobs.get(job_id)
+
+        if job_info is None:
+            job_info = self._job_get_info(job_id, reconnect=True)
+            self._job_set_info(job_id, job_info)
+
+        return job_info
+
+    # ----------------------------------------------------------------
+    #
+    def _job_set_info(self, job_id, job_info):
+        """ replace the job's info, and wake up anyone waiting for a change
+        """
+        with self._state_cond:
+            self.jobs[job_id] = job_info
+            self._state_cond.notify_all()
+
+    # ----------------------------------------------------------------
+    #
+    def _job_set_state(self, job_id, state):
+        """ update the job's state, and wake up anyone waiting for a change
+        """
+        with self._state_cond:
+            job_info = self.jobs[job_id]
+            job_info['state'] = state
+            self.jobs[job_id] = job_info
+            self._state_cond.notify_all()
 
     # ----------------------------------------------------------------
     #
     def _job_wait(self, job_id, timeout):
         """ wait for the job to finish or fail
         """
-        time_start = time.time()
-        time_now   = time_start
-        rm, pid    = self._adaptor.parse_id(job_id)
-
-        while True:
-            state = self.jobs[job_id]['state']  # this gets updated in the bg.
+        return self._jobs_wait([job_id], saga.task.ALL, timeout)
 
-            if state == saga.job.DONE or \
-               state == saga.job.FAILED or \
-               state == saga.job.CANCELED:
-                    return True
+    # ----------------------------------------------------------------
+    #
+    def _jobs_wait(self, job_ids, mode, timeout):
+        """ wait for any (mode ANY) or all (mode ALL) of the jobs to finish or
+            fail. The monitor thread notifies us of every state change, so we
+            block until then instead of polling the job dict. The wait itself
+            is untimed, as a timed Condition.wait polls every 50ms on python
+            2; a timer notifies us when the timeout is up instead.
+            Returns False if we hit the timeout, True otherwise.
+        """
+        # make sure we know about every job before we start, so that we
+        # don't call out to qstat with the lock held
+        for job_id in job_ids:
+            self._job_info(job_id)
+
+        def _finished():
+            # a job that has since been evicted must have been final
+            done = [self.jobs.get(job_id, _job_record(state=saga.job.DONE))['state'] in _FINAL_STATES
+                    for job_id in job_ids]
+            if mode == saga.task.ANY:
+                return any(done)
+            return all(done)
+
+        def _expire():
+            with self._state_cond:
+                self._state_cond.notify_all()
 
-            # avoid busy poll
-            time.sleep(SYNC_WAIT_UPDATE_INTERVAL)
+        time_start = time.time()
+        timer = None
 
-            # check if we hit timeout
-            if timeout >= 0:
-                time_now = time.time()
-                if time_now - time_start > timeout:
-                    return False
+        with self._state_cond:
+            self._waiters += 1
+            try:
+                # have the monitor tighten its interval right away
+                if self.mt:
+                    self.mt.wakeup()
+
+                # started with the lock held, so it can't notify before we wait
+                if timeout >= 0:
+                    timer = threading.Timer(timeout, _expire)
+                    timer.setDaemon(True)
+                    timer.start()
+
+                while not _finished():
+                    if timeout >= 0 and time.time() - time_start >= timeout:
+                        return False
+                    self._state_cond.wait()
+
+                return True
+            finally:
+                if timer:
+                    timer.cancel()
+                self._waiters -= 1
 
     # ----------------------------------------------------------------
     #
@@ -1135,8 +1476,9 @@ class PBSProJobService (saga.adaptors.cpi.job.Service):
         """
 
         # If we already have the job info, we just pass the current info.
-        if job_id in self.jobs :
-            return self.jobs[job_id]['obj']
+        job_info = self.jobs.get(job_id)
+        if job_info is not None and job_info['obj'] is not None:
+            return job_info['obj']
 
         # Try to get some initial information about this job (again)
         job_info = self._job_get_info(job_id, reconnect=True)
@@ -1156,7 +1498,7 @@ class PBSProJobService (saga.adaptors.cpi.job.Service):
 
         # throw it into our job dictionary.
         job_info['obj']   = job_obj
-        self.jobs[job_id] = job_info
+        self._job_set_info(job_id, job_info)
 
         return job_obj
 
@@ -1214,9 +1556,7 @@ class PBSProJobService (saga.adaptors.cpi.job.Service):
 
         self._logger.debug ("container wait: %s"  %  str(jobs))
 
-        # TODO: this is not optimized yet
-        for job in jobs:
-            job.wait ()
+        return self._jobs_wait([job.id for job in jobs], mode, timeout)
    
    
     # ----------------------------------------------------------------
@@ -1225,9 +1565,13 @@ class PBSProJobService (saga.adaptors.cpi.job.Service):
 
         self._logger.debug ("container cancel: %s"  %  str(jobs))
 
-        # TODO: this is not optimized yet
-        for job in jobs:
-            job.cancel (timeout)
+        errors = self._job_cancel_bulk([job.id for job in jobs])
+
+        failed = [job_id for job_id in errors if errors[job_id] is not None]
+        if failed:
+            message = "Error canceling jobs via 'qdel': %s" \
+                % '; '.join([errors[job_id] for job_id in failed])
+            log_error_and_raise(message, saga.NoSuccess, self._logger)
 
 
 
@@ -0,0 +1,251 @@
+"""
+   Copyright 2018-2019 EPCC, University Of Edinburgh
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+# Pilot jobs: a single long-running PBS allocation per service runs an agent that picks up small
+# hoff jobs ("tasks") dropped into a directory on the shared filesystem, so the queue wait is paid
+# once rather than once per job. The hoff talks to the agent only through files, over the same SSH
+# channel it uses for everything else:
+#
+#   <pilot dir>/queue/<local job id>      task scripts waiting for a free slot
+#   <pilot dir>/running/<local job id>    task scripts that have been started
+#   <pilot dir>/done/<local job id>       exit status of finished tasks
+#   <pilot dir>/canceled/<local job id>   tasks canceled before they started
+#   <pilot dir>/cancel/<local job id>     requests for the agent to kill a running task
+#   <pilot dir>/stopped                   the agent is shutting down and will start no more tasks
+
+
+from __future__ import print_function
+import saga
+import os
+import re
+import pipes
+import saga_utils
+from job_templates import ENV_NAME_RE
+
+
+# prefix for the remote job id of a job running in a pilot, eg pilot:<pilot id>:<local job id>
+PILOT_TASK_PREFIX = "pilot:"
+
+PILOT_TASK_ID_RE = re.compile(r'^pilot:([^:]+):(.+)$')
+
+# seconds between the agent's scans of its queue
+PILOT_POLL_INTERVAL = 5
+
+PILOT_AGENT_SCRIPT = """#!/bin/bash
+# hoff pilot agent: runs the tasks dropped into queue/ by the hoff, at most SLOTS at a time,
+# until stopped or idle for IDLE_TIMEOUT seconds
+
+SLOTS=%(slots)d
+IDLE_TIMEOUT=%(idle_timeout)d
+POLL_INTERVAL=%(poll_interval)d
+
+cd %(pilot_dir)s || exit 1
+trap 'touch stopped' EXIT
+
+declare -A PIDS
+IDLE=0
+
+while [ ! -e stop ]; do
+
+    # reap finished tasks, and kill any the hoff has canceled
+    for id in "${!PIDS[@]}"; do
+        pid=${PIDS[$id]}
+        if ! kill -0 $pid 2>/dev/null; then
+            wait $pid
+            echo $? > done/.$id && mv done/.$id done/$id
+            rm -f running/$id cancel/$id
+            unset PIDS[$id]
+        elif [ -e cancel/$id ]; then
+            kill -- -$pid 2>/dev/null
+        fi
+    done
+
+    # start queued tasks while there are free slots, each in its own process group
+    for task in queue/*; do
+        [ ${#PIDS[@]} -lt $SLOTS ] || break
+        [ -e "$task" ] || continue
+        id=`basename $task`
+        mv "$task" running/$id 2>/dev/null || continue
+        setsid bash running/$id &
+        PIDS[$id]=$!
+    done
+
+    if [ ${#PIDS[@]} -eq 0 ]; then
+        IDLE=$((IDLE + POLL_INTERVAL))
+        [ $IDLE -lt $IDLE_TIMEOUT ] || break
+    else
+        IDLE=0
+    fi
+
+    sleep $POLL_INTERVAL
+done
+
+touch stopped
+wait
+"""
+
+
+def get_task_id(pilot_id, local_job_id):
+
+    return "%s%s:%s" % (PILOT_TASK_PREFIX, pilot_id, local_job_id)
+
+
+def get_pilot_id(remote_job_id):
+
+    # returns the id of the pilot a job was dispatched to, or None for ordinary jobs
+    if remote_job_id is None:
+        return None
+    match = PILOT_TASK_ID_RE.match(remote_job_id)
+    if match is None:
+        return None
+    return match.group(1)
+
+
+def get_pilot_dir(pilot_id, service):
+
+    return os.path.join(service['working_directory'], get_pilot_name(pilot_id))
+
+
+def get_pilot_name(pilot_id):
+
+    return "pilot-" + str(pilot_id)
+
+
+def start_pilot(pilot_id, service, num_total_cpus, wallclock_limit, slots, idle_timeout, project=None, queue=None):
+
+    # write the agent script into the pilot's directory and submit the placeholder allocation that runs it.
+    # returns the remote job id of the allocation, or -1 if it could not be submitted
+
+    pilot_dir = get_pilot_dir(pilot_id, service)
+    agent = PILOT_AGENT_SCRIPT % {'slots': slots,
+                                  'idle_timeout': idle_timeout,
+                                  'poll_interval': PILOT_POLL_INTERVAL,
+                                  'pilot_dir': pipes.quote(pilot_dir)}
+
+    cmd = "mkdir -p %s && cd %s && mkdir -p queue running done canceled cancel && " \
+          "cat > agent.sh <<'HOFF_PILOT_EOF'\n%sHOFF_PILOT_EOF" % (pipes.quote(pilot_dir), pipes.quote(pilot_dir),
+                                                                  agent)
+    ret, out = saga_utils.run_remote_shell_command(cmd, service)
+    if ret != 0:
+        raise Exception("Error creating pilot directory %s: %s" % (pilot_dir, out))
+
+    jd = {'local_job_id': get_pilot_name(pilot_id),
+          'name': get_pilot_name(pilot_id),
+          'executable': '/bin/bash',
+          'arguments': ['agent.sh'],
+          'num_total_cpus': num_total_cpus,
+          'wallclock_limit': wallclock_limit,
+          'project': project,
+          'queue': queue}
+
+    return saga_utils.submit_saga_job(jd, service)
+
+
+def dispatch_task(pilot_id, job_description, service):
+
+    # queue a job in a pilot. the job runs in its own working directory, as it would as a PBS job,
+    # and is killed if it outlives its wallclock limit.
+    # returns the remote job id used to track it, or raises if the pilot has stopped
+
+    local_job_id = str(job_description['local_job_id'])
+    working_dir = os.path.join(service['working_directory'], local_job_id)
+
+    script = "cd %s || exit 1\n" % pipes.quote(working_dir)
+
+    # jobs normally find their core count in the PBS environment
+    if job_description.get('num_total_cpus') is not None:
+        script += "export NCPUS=%d\n" % int(job_description['num_total_cpus'])
+
+    # names that aren't valid shell variables are skipped, as they can't be exported and would be run as
+    # part of the script
+    env = job_description.get('environment')
+    if env is not None:
+        for key, val in env.items():
+            if ENV_NAME_RE.match(key) is None:
+                continue
+            script += "export %s=%s\n" % (key, pipes.quote(val))
+
+    command = [job_description['executable']] + (job_description.get('arguments') or [])
+    command = " ".join([pipes.quote(c) for c in command])
+
+    wallclock_limit = job_description.get('wallclock_limit')
+    if wallclock_limit is not None:
+        command = "timeout %dm %s" % (int(wallclock_limit), command)
+
+    script += "exec %s > %s 2> %s\n" % (command, saga_utils.JOB_STDOUT, saga_utils.JOB_STDERR)
+
+    # the task is written under a hidden name and renamed, so the agent never picks up a partial script
+    cmd = "cd %s && test ! -e stopped && cat > queue/.%s <<'HOFF_PILOT_EOF' && mv queue/.%s queue/%s\n%s" \
+          "HOFF_PILOT_EOF" % (pipes.quote(get_pilot_dir(pilot_id, service)), local_job_id, local_job_id,
+                              local_job_id, script)
+    ret, out = saga_utils.run_remote_shell_command(cmd, service)
+    if ret != 0:
+        raise Exception("Error dispatching job %s to pilot %s: %s" % (local_job_id, pilot_id, out))
+
+    return get_task_id(pilot_id, local_job_id)
+
+
+def get_task_states(pilot_id, service):
+
+    # query the state of every task in a pilot with one remote command
+    # returns a dict of local job id to SAGA state. tasks still running when the pilot's allocation
+    # ends will never finish, which only the state of the allocation itself can tell
+
+    cmd = "cd %s && for d in queue running done canceled; do for f in $d/*; do " \
+          "test -e \"$f\" && echo \"$d `basename $f` `test $d = done && cat $f`\"; done; done; " \
+          "true" % pipes.quote(get_pilot_dir(pilot_id, service))
+    ret, out = saga_utils.run_remote_shell_command(cmd, service)
+    if ret != 0:
+        raise Exception("Error retrieving pilot %s task states: %s" % (pilot_id, out))
+
+    states = {}
+    for line in out.split('\n'):
+        fields = line.split()
+        if len(fields) == 0:
+            continue
+        if fields[0] == 'queue':
+            states[fields[1]] = saga.job.PENDING
+        elif fields[0] == 'running':
+            states[fields[1]] = saga.job.RUNNING
+        elif fields[0] == 'canceled':
+            states[fields[1]] = saga.job.CANCELED
+        elif fields[0] == 'done' and len(fields) == 3:
+            states[fields[1]] = saga.job.DONE if fields[2] == '0' else saga.job.FAILED
+
+    return states
+
+
+def cancel_tasks(pilot_id, local_job_ids, service):
+
+    # cancel jobs in a pilot: queued tasks are moved aside, running ones are killed by the agent.
+    # returns a dict of local job id to None on success, or an error
+
+    cmd = "cd %s" % pipes.quote(get_pilot_dir(pilot_id, service))
+    for id in local_job_ids:
+        cmd += " && { mv queue/%s canceled/%s 2>/dev/null || touch cancel/%s; }" % (id, id, id)
+    ret, out = saga_utils.run_remote_shell_command(cmd, service)
+
+    error = None
+    if ret != 0:
+        error = "Error cancelling jobs in pilot %s: %s" % (pilot_id, out)
+    return dict([(id, error) for id in local_job_ids])
+
+
+def stop_pilot(pilot_id, service):
+
+    # ask the agent to finish its running tasks and exit
+    saga_utils.run_remote_shell_command("touch %s" % pipes.quote(os.path.join(get_pilot_dir(pilot_id, service),
+                                                                              'stop')), service)
@@ -0,0 +1,67 @@
+"""
+   Copyright 2018-2019 EPCC, University Of Edinburgh
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import collections
+import threading
+import time
+
+
+class Principal(collections.namedtuple('Principal', ['user_id', 'roles'])):
+
+    # who a request is made by: their user id, and the names of their roles as a frozenset
+
+    def has_role(self, role):
+        return role in self.roles
+
+    def has_any_role(self, *roles):
+        return not self.roles.isdisjoint(roles)
+
+
+class PrincipalCache(object):
+
+    # principals by user id, kept for max_age seconds so that a user polling the service doesn't have
+    # their roles loaded on every request. a max_age of 0 or less turns the cache off
+
+    def __init__(self, max_age):
+
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._principals = {}
+
+    def get(self, user_id, load):
+
+        # the cached principal for the user, or the one load returns if there's none or it's too old
+        if self.max_age <= 0:
+            return load()
+
+        with self._lock:
+            cached = self._principals.get(user_id)
+        if cached is not None and time.time() - cached[1] <= self.max_age:
+            return cached[0]
+
+        principal = load()
+        with self._lock:
+            self._principals[user_id] = (principal, time.time())
+        return principal
+
+    def invalidate(self, user_id=None):
+
+        # forget one user's principal, or everyone's
+        with self._lock:
+            if user_id is None:
+                self._principals.clear()
+            else:
+                self._principals.pop(user_id, None)
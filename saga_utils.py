@@ -17,8 +17,14 @@
 
 from __future__ import print_function
 import saga
+import saga.utils.pty_shell as sups
 import os
 import re
+import json
+import time
+import datetime
+from walltime import parse_walltime
+from pbsprojob import qdel_jobs
 
 
 
@@ -33,6 +39,13 @@ JOB_STDOUT = "job.stdout"
 # name for the job's stderr file
 JOB_STDERR = "job.stderr"
 
+# prefix for directives passed through to our PBSPro adaptor in spmd_variation,
+# must match HOFF_DIRECTIVES_PREFIX in pbsprojob.py
+HOFF_DIRECTIVES_PREFIX = "hoff:"
+
+# a PBS array subjob id, eg [pbspro+ssh://host]-[1234[5]]
+ARRAY_SUBJOB_ID_RE = re.compile(r'^(\[.*\]-\[\d+)\[(\d+)\]\]$')
+
 
 
 
@@ -57,7 +70,10 @@ def get_remote_job_state(remote_job_id, service):
 
 
 
-def stage_input_files(job_id, local_input_file_dir, service):
+def stage_input_files(job_id, local_input_file_dir, service, skip=None):
+
+    # copy the files in a local directory into the job's remote working directory,
+    # apart from any named in skip. the working directory may already exist
     try:
 
         # create an SSH context and populate it with our SSH details.
@@ -72,10 +88,13 @@ def stage_input_files(job_id, local_input_file_dir, service):
         # create the job's working directory and copy over the contents of our input directory
 
         dir = saga.filesystem.Directory(service['file_url'] + REMOTE_WORKING_DIR, session=session)
-        dir.make_dir(str(job_id))
+        dir.make_dir(str(job_id), saga.filesystem.CREATE_PARENTS)
 
 
         for f in os.listdir(local_input_file_dir):
+            if skip is not None and f in skip:
+                continue
+
             transfertarget = service['file_url'] + REMOTE_WORKING_DIR + str(job_id) + "/" + f
             transfersource = 'sftp://localhost' + os.path.join(local_input_file_dir, f)
 
@@ -160,6 +179,27 @@ def submit_saga_job(job_description, service):
             print("setting {}".format(extended))
             jd.spmd_variation = extended
 
+        directives = {}
+
+        # a job array is submitted with a single qsub; each subjob runs in the working
+        # directory of its own local job, with its own arguments
+        array = job_description.get('array')
+        if array is not None:
+            subjobs = []
+            for subjob in array:
+                subjobs.append({'working_directory': os.path.join(service['working_directory'],
+                                                                  str(subjob['local_job_id'])),
+                                'arguments': subjob.get('arguments')})
+            directives['array'] = subjobs
+            REMOTE_WORKING_DIR = service['working_directory']
+
+        # a held job waits in the queue without starting until it is released
+        if job_description.get('hold'):
+            directives['hold'] = True
+
+        if len(directives) > 0:
+            jd.spmd_variation = HOFF_DIRECTIVES_PREFIX + json.dumps(directives)
+
         # specify where the job's stdout and stderr will go
         jd.output = JOB_STDOUT
         jd.error = JOB_STDERR
@@ -190,6 +230,97 @@ def submit_saga_job(job_description, service):
         return -1
 
 
+def get_array_subjob_id(array_job_id, index):
+
+    # PBS names subjobs by putting the index between the brackets of the array id
+    return re.sub(r'\[\]\]$', '[%d]]' % index, array_job_id)
+
+
+def get_array_job_id(subjob_id):
+
+    # returns the id of the array a subjob belongs to, or None for ordinary jobs
+    match = ARRAY_SUBJOB_ID_RE.match(subjob_id)
+    if match is None:
+        return None
+    return match.group(1) + '[]]'
+
+
+def get_remote_array_job_states(array_job_id, service):
+
+    # query the state of every subjob of an array with one qstat, rather than one per subjob
+    # returns a dict of subjob id to SAGA state
+
+    pid = get_remote_pid(array_job_id)
+    ret, out = run_remote_shell_command("unset GREP_OPTIONS; qstat -fxt '%s' | "
+                                        "grep -E '(Job Id:)|(job_state)|(Exit_status)'" % pid, service)
+    if ret != 0:
+        raise Exception("Error retrieving array job info via 'qstat': %s" % out)
+
+    subjobs = {}
+    subjob_id = None
+    for line in out.split('\n'):
+        line = line.strip()
+        if line.startswith('Job Id:'):
+            # eg Job Id: 1234[5].indy2-login0
+            match = re.search(r'\[(\d+)\]', line)
+            subjob_id = None
+            if match is not None:
+                subjob_id = get_array_subjob_id(array_job_id, int(match.group(1)))
+                subjobs[subjob_id] = {'state': None, 'exit_status': None}
+        elif subjob_id is not None and '=' in line:
+            key, val = [s.strip() for s in line.split('=', 1)]
+            if key == 'job_state':
+                subjobs[subjob_id]['state'] = val
+            elif key == 'Exit_status':
+                subjobs[subjob_id]['exit_status'] = int(val)
+
+    states = {}
+    for subjob_id, info in subjobs.items():
+        states[subjob_id] = _pbs_subjob_state_to_saga(info['state'], info['exit_status'])
+    return states
+
+
+def _pbs_subjob_state_to_saga(job_state, exit_status):
+
+    # finished subjobs show as F or X; only the exit status distinguishes success from failure
+    if job_state in ['F', 'X']:
+        if exit_status is None:
+            return saga.job.CANCELED
+        if exit_status != 0:
+            return saga.job.FAILED
+        return saga.job.DONE
+    if job_state in ['R', 'E', 'T', 'B']:
+        return saga.job.RUNNING
+    if job_state in ['Q', 'H', 'S', 'W']:
+        return saga.job.PENDING
+    return saga.job.UNKNOWN
+
+
+def run_remote_shell_command(command, service):
+
+    # run a command on the service's login node, for anything the SAGA job API has no call for
+
+    session = create_session_for_service(service)
+    shell = sups.PTYShell(get_shell_url(service), session)
+    try:
+        ret, out, _ = shell.run_sync(command)
+    finally:
+        shell.finalize(True)
+    return ret, out
+
+
+def get_shell_url(service):
+
+    # the scheduler url is of the form pbspro+ssh://host, the shell needs ssh://host
+    scheduler_url = saga.Url(service['scheduler_url'])
+    shell_url = saga.Url(scheduler_url)
+    if '+' in scheduler_url.scheme:
+        shell_url.scheme = scheduler_url.scheme.split('+', 1)[1]
+    else:
+        shell_url.scheme = 'fork'
+    return shell_url
+
+
 def cancel_job(job_id, service):
 
     try:
@@ -203,6 +334,175 @@ def cancel_job(job_id, service):
         raise e
 
 
+def release_job(job_id, service):
+
+    # release a job submitted on hold
+    ret, out = run_remote_shell_command("qrls '%s'" % get_remote_pid(job_id), service)
+    if ret != 0:
+        raise Exception("Error releasing job via 'qrls': %s" % out)
+
+
+def cancel_jobs(job_ids, service):
+
+    # cancel many jobs on one service with as few qdel calls as the command line length allows,
+    # rather than one job service connection and qdel per job.
+    # returns a dict of job id to None on success, or the error reported by qdel for that job
+
+    # the batching and parsing of qdel's output are the PBSPro adaptor's, which cancels jobs the same way
+    pids = dict([(job_id, get_remote_pid(job_id)) for job_id in job_ids])
+    return qdel_jobs(job_ids, pids, 'qdel', lambda cmd: run_remote_shell_command(cmd, service))
+
+
+def get_queue_snapshot(service):
+
+    # summarise how busy a service's scheduler is, from one round trip running qstat -Q and qstat -T.
+    # returns a dict with the number of queued and running jobs, and an estimate in seconds of how long
+    # a newly queued job would wait (None if the scheduler doesn't estimate start times)
+
+    ret, out = run_remote_shell_command("qstat -Q; echo HOFF_QSTAT_T; qstat -T", service)
+    if 'HOFF_QSTAT_T' not in out:
+        raise Exception("Error retrieving queue info via 'qstat -Q': %s" % out)
+
+    queue_out, estimate_out = out.split('HOFF_QSTAT_T', 1)
+
+    snapshot = {'queued': 0, 'running': 0, 'estimated_wait': None, 'time': time.time()}
+
+    # qstat -Q prints a table with one line per queue, eg
+    # Queue              Max   Tot Ena Str   Que   Run   Hld   Wat   Trn   Ext Type
+    # ---------------- ----- ----- --- --- ----- ----- ----- ----- ----- ----- ----
+    # workq                0     3 yes yes     1     2     0     0     0     0 Exec
+    header = None
+    for line in queue_out.split('\n'):
+        fields = line.split()
+        if len(fields) == 0 or fields[0].startswith('---'):
+            continue
+        if fields[0] == 'Queue':
+            header = fields
+            continue
+        if header is None or len(fields) != len(header):
+            continue
+        row = dict(zip(header, fields))
+        if row.get('Type') != 'Exec':
+            continue
+        try:
+            snapshot['queued'] += int(row['Que'])
+            snapshot['running'] += int(row['Run'])
+        except (KeyError, ValueError):
+            pass
+
+    # qstat -T lists queued jobs with their estimated start time in the last column,
+    # as HH:MM for today or as an abbreviated day and hour within the next week.
+    # a new job joins the back of the queue, so take the latest estimate
+    now = datetime.datetime.now()
+    latest_start = None
+    for line in estimate_out.split('\n'):
+        start = _parse_estimated_start(line.split(), now)
+        if start is not None and (latest_start is None or start > latest_start):
+            latest_start = start
+
+    if latest_start is not None:
+        snapshot['estimated_wait'] = max(0, int((latest_start - now).total_seconds()))
+
+    return snapshot
+
+
+def _parse_estimated_start(fields, now):
+
+    days = ['Mo', 'Tu', 'We', 'Th', 'Fr', 'Sa', 'Su']
+
+    try:
+        if len(fields) >= 2 and fields[-2] in days:
+            day_offset = (days.index(fields[-2]) - now.weekday()) % 7
+            start = now.replace(hour=int(fields[-1]), minute=0, second=0, microsecond=0)
+            return start + datetime.timedelta(days=day_offset)
+        if len(fields) >= 1 and re.match(r'^\d{1,2}:\d{2}$', fields[-1]):
+            hour, minute = [int(f) for f in fields[-1].split(':')]
+            return now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    except ValueError:
+        pass
+    return None
+
+
+def create_reservation(reservation_description, service):
+
+    # book a PBS advance reservation with pbs_rsub. the description holds the start (a datetime),
+    # the duration in minutes, the number of nodes and optionally the cores per node.
+    # returns the reservation id, eg R1234.indy2-login0, which PBS confirms (or rejects) shortly after
+
+    select = "%d" % int(reservation_description['num_nodes'])
+    if reservation_description.get('cores_per_node') is not None:
+        select += ":ncpus=%d" % int(reservation_description['cores_per_node'])
+
+    duration = int(reservation_description['duration'])
+    cmd = "pbs_rsub -R %s -D %02d:%02d:00 -l select=%s" % (reservation_description['start'].strftime('%Y%m%d%H%M'),
+                                                            duration // 60, duration % 60, select)
+    name = reservation_description.get('name')
+    if name is not None:
+        cmd += " -N '%s'" % name
+
+    ret, out = run_remote_shell_command(cmd, service)
+    if ret != 0 or len(out.split()) == 0:
+        raise Exception("Error creating reservation via 'pbs_rsub': %s" % out)
+
+    # eg R1234.indy2-login0 UNCONFIRMED
+    return out.split()[0]
+
+
+def get_reservation_info(reservation_id, service):
+
+    # returns the state of a reservation (eg CONFIRMED, RUNNING) and the name of its queue,
+    # or None if PBS no longer knows about it. other errors, eg the service being unreachable,
+    # raise rather than passing for a reservation that has gone
+
+    ret, out = run_remote_shell_command("pbs_rstat -f '%s'" % reservation_id, service)
+    if ret != 0:
+        # eg pbs_rstat: Unknown Reservation Id R1234.host
+        if 'unknown reservation' in out.lower():
+            return None
+        raise Exception("Error retrieving reservation info via 'pbs_rstat': %s" % out)
+
+    info = {'state': None, 'queue': None}
+    for line in out.split('\n'):
+        if '=' not in line:
+            continue
+        key, val = [f.strip() for f in line.split('=', 1)]
+        if key == 'reserve_state':
+            # eg RESV_CONFIRMED
+            info['state'] = val[len('RESV_'):] if val.startswith('RESV_') else val
+        elif key == 'queue':
+            info['queue'] = val
+
+    if info['state'] is None:
+        return None
+    return info
+
+
+def delete_reservation(reservation_id, service):
+
+    ret, out = run_remote_shell_command("pbs_rdel '%s'" % reservation_id, service)
+    if ret != 0:
+        raise Exception("Error deleting reservation via 'pbs_rdel': %s" % out)
+
+
+def get_remote_walltime(job_id, service):
+
+    # how long a finished job ran for in seconds, from qstat's resources_used.walltime,
+    # or None if PBS doesn't report it
+    ret, out = run_remote_shell_command("qstat -fx '%s' | grep resources_used.walltime" % get_remote_pid(job_id),
+                                        service)
+    if ret != 0 or '=' not in out:
+        return None
+
+    # eg resources_used.walltime = 00:12:34
+    return parse_walltime(out.split('=', 1)[1])
+
+
+def get_remote_pid(job_id):
+
+    # SAGA job ids take the form [scheduler url]-[pid]
+    return job_id[job_id.rfind('-[') + 2:-1]
+
+
 def copy_remote_directory_to_local(remote_dir, local_job_dir, base_dir, filter, logger):
 
     if not os.path.exists(local_job_dir):
@@ -240,6 +540,8 @@ def copy_remote_directory_to_local(remote_dir, local_job_dir, base_dir, filter,
 
 def stage_output_files(remote_working_dir, local_job_dir, service, filter, logger):
 
+    # filter is a regular expression, or one already compiled, that the output files copied must match
+
     try:
 
         if not os.path.exists(local_job_dir):
@@ -0,0 +1,282 @@
+"""
+   Copyright 2018-2019 EPCC, University Of Edinburgh
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+# The database schema, as SQLAlchemy tables rather than MySQL DDL, so that it can be created in SQLite
+# for running the service locally, eg for tests and benchmarks. compbiomed.sql is still what production
+# databases are created from; the two must be changed together. index names are prefixed with their
+# table's name, as SQLite wants them unique across the database
+
+from sqlalchemy import MetaData, Table, Column, Index, ForeignKey, DDL, event
+from sqlalchemy import Integer, SmallInteger, BigInteger, Float, String, DateTime
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+
+class now(FunctionElement):
+
+    # the time now, as a column default. MySQL's CURRENT_TIMESTAMP is in the server's local time, as are
+    # the times the app compares against; SQLite's is in UTC, so there the local time is asked for instead
+    type = DateTime()
+    name = 'now'
+
+
+@compiles(now)
+def _now(element, compiler, **kw):
+    return "CURRENT_TIMESTAMP"
+
+
+@compiles(now, 'sqlite')
+def _now_sqlite(element, compiler, **kw):
+    return "(datetime('now', 'localtime'))"
+
+
+metadata = MetaData()
+
+
+def _last_modified():
+
+    return Column('last_modified', DateTime, nullable=False, server_default=now())
+
+
+def _track_last_modified(table):
+
+    # last_modified follows updates of the row. SQLite has no ON UPDATE, so a trigger does it there
+    event.listen(table, 'after_create', DDL(
+        "CREATE TRIGGER IF NOT EXISTS %(name)s_last_modified AFTER UPDATE ON %(table)s FOR EACH ROW "
+        "WHEN NEW.last_modified = OLD.last_modified BEGIN "
+        "UPDATE %(table)s SET last_modified=datetime('now', 'localtime') WHERE id=NEW.id; END",
+        context={'name': table.name}
+    ).execute_if(dialect='sqlite'))
+    event.listen(table, 'after_create', DDL(
+        "ALTER TABLE %(table)s MODIFY last_modified DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP "
+        "ON UPDATE CURRENT_TIMESTAMP"
+    ).execute_if(dialect='mysql'))
+
+
+def _job_columns(archive=False):
+
+    # the columns of JOB, which JOB_ARCHIVE shares so that jobs can be archived with INSERT ... SELECT.
+    # archived jobs keep their ids, and aren't tied to other tables
+    def references(column):
+        return [] if archive else [ForeignKey(column)]
+
+    return [
+        Column('id', Integer, primary_key=True, autoincrement=not archive),
+        Column('name', String(45), nullable=False),
+        Column('state', String(45), server_default='NEW'),
+        Column('user_id', Integer, *references('user.id'), nullable=False),
+        Column('service_id', Integer, *references('SERVICE.id'), nullable=False),
+        Column('input_set_id', Integer, *references('INPUT_SET.id')),
+        Column('local_job_id', String(128), nullable=False),
+        Column('remote_job_id', String(256)),
+        Column('created', DateTime, nullable=False, server_default=now()),
+        _last_modified(),
+        Column('executable', String(256)),
+        Column('arguments', String(256)),
+        Column('env', String(45)),
+        Column('num_total_cpus', Integer),
+        Column('total_physical_memory', String(45)),
+        Column('working_directory', String(256)),
+        Column('wallclock_limit', String(45)),
+        Column('project', String(45)),
+        Column('queue', String(45)),
+        Column('extended', String(1024)),
+        Column('retrieved', SmallInteger, server_default='0'),
+        Column('filter', String(512)),
+        Column('array_id', String(128)),
+        Column('array_index', Integer),
+        Column('auto_cpus', SmallInteger, server_default='0'),
+        Column('fluid_sites', BigInteger),
+        Column('auto_walltime', SmallInteger, server_default='0'),
+        Column('runtime', Integer),
+        Column('reuse', SmallInteger, server_default='0'),
+        Column('input_hash', String(64)),
+        Column('reused_from', String(128)),
+        Column('hold', SmallInteger, server_default='0'),
+        Column('template_id', Integer),
+    ]
+
+
+# TINYINT(1) columns are SmallInteger rather than Boolean, as retrieved holds more than 0 and 1
+
+user = Table(
+    'user', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('first_name', String(45), nullable=False),
+    Column('last_name', String(45), nullable=False),
+    Column('email', String(128), nullable=False),
+    Column('password', String(256), nullable=False),
+    Column('active', SmallInteger),
+    Column('confirmed_at', DateTime),
+    Index('user_email_UNIQUE', 'email', unique=True))
+
+role = Table(
+    'role', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(45), nullable=False),
+    Column('description', String(45)),
+    Index('role_name_UNIQUE', 'name', unique=True))
+
+roles_users = Table(
+    'roles_users', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('role_id', Integer, ForeignKey('role.id'), nullable=False),
+    Column('user_id', Integer, ForeignKey('user.id'), nullable=False),
+    Index('roles_users_role_idx', 'role_id'),
+    Index('roles_users_user_idx', 'user_id'))
+
+service = Table(
+    'SERVICE', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(45), nullable=False),
+    Column('scheduler_url', String(256), nullable=False),
+    Column('username', String(128)),
+    Column('user_pass', String(128)),
+    Column('user_key', String(256)),
+    Column('file_url', String(256)),
+    Column('working_directory', String(256)),
+    Column('cores_per_node', Integer),
+    Column('sites_per_core', Integer),
+    Column('known_nodes', String(128)),
+    Column('qsub_rate', Float),
+    Column('qsub_burst', Integer),
+    Column('max_in_flight', Integer),
+    Index('SERVICE_name_UNIQUE', 'name', unique=True))
+
+input_set = Table(
+    'INPUT_SET', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(45), nullable=False),
+    Column('user_id', Integer, ForeignKey('user.id'), nullable=False),
+    Index('INPUT_SET_name_UNIQUE', 'name', unique=True),
+    Index('INPUT_SET_user_idx', 'user_id'))
+
+job = Table(
+    'JOB', metadata,
+    *_job_columns() + [
+        Index('JOB_user_idx', 'user_id'),
+        Index('JOB_service_idx', 'service_id'),
+        Index('JOB_input_set_idx', 'input_set_id'),
+        Index('JOB_local_job_id_UNIQUE', 'local_job_id', unique=True),
+        Index('JOB_array_idx', 'array_id', 'array_index'),
+        Index('JOB_runtime_idx', 'service_id', 'template_id', 'runtime'),
+        Index('JOB_input_hash_idx', 'user_id', 'input_hash'),
+        Index('JOB_reused_from_idx', 'reused_from'),
+        Index('JOB_user_created_idx', 'user_id', 'created', 'id'),
+        Index('JOB_created_idx', 'created', 'id'),
+        Index('JOB_state_idx', 'state')])
+
+input_set_file = Table(
+    'INPUT_SET_FILE', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(128), nullable=False),
+    Column('description', String(128)),
+    Column('input_set_id', Integer, ForeignKey('INPUT_SET.id'), nullable=False),
+    Index('INPUT_SET_FILE_name_UNIQUE', 'name', unique=True),
+    Index('INPUT_SET_FILE_input_set_idx', 'input_set_id'))
+
+job_template = Table(
+    'JOB_TEMPLATE', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('name', String(45), nullable=False),
+    Column('user_id', Integer, ForeignKey('user.id'), nullable=False),
+    Column('service_id', Integer, ForeignKey('SERVICE.id'), nullable=False),
+    Column('input_set_id', Integer, ForeignKey('INPUT_SET.id')),
+    Column('created', DateTime, nullable=False, server_default=now()),
+    _last_modified(),
+    Column('executable', String(256)),
+    Column('arguments', String(256)),
+    Column('env', String(45)),
+    Column('num_total_cpus', Integer),
+    Column('total_physical_memory', String(45)),
+    Column('working_directory', String(256)),
+    Column('wallclock_limit', String(45)),
+    Column('project', String(45)),
+    Column('queue', String(45)),
+    Column('extended', String(1024)),
+    Column('filter', String(512)),
+    Column('description', String(512)),
+    Column('family', String(45)),
+    Index('JOB_TEMPLATE_user_idx', 'user_id'),
+    Index('JOB_TEMPLATE_service_idx', 'service_id'),
+    Index('JOB_TEMPLATE_input_set_idx', 'input_set_id'),
+    Index('JOB_TEMPLATE_name_UNIQUE', 'name', unique=True),
+    Index('JOB_TEMPLATE_family_idx', 'family'))
+
+pilot = Table(
+    'PILOT', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('pilot_id', String(128), nullable=False),
+    Column('service_id', Integer, ForeignKey('SERVICE.id'), nullable=False),
+    Column('remote_job_id', String(256)),
+    Column('state', String(45), server_default='SUBMITTED'),
+    Column('project', String(45)),
+    Column('queue', String(45)),
+    Column('created', DateTime, nullable=False, server_default=now()),
+    _last_modified(),
+    Index('PILOT_pilot_id_UNIQUE', 'pilot_id', unique=True),
+    Index('PILOT_service_idx', 'service_id'))
+
+reservation = Table(
+    'RESERVATION', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('reservation_id', String(128), nullable=False),
+    Column('remote_reservation_id', String(256)),
+    Column('user_id', Integer, ForeignKey('user.id'), nullable=False),
+    Column('service_id', Integer, ForeignKey('SERVICE.id'), nullable=False),
+    Column('state', String(45), server_default='UNCONFIRMED'),
+    Column('queue', String(45)),
+    Column('start_time', DateTime, nullable=False),
+    Column('end_time', DateTime, nullable=False),
+    Column('num_nodes', Integer),
+    Column('created', DateTime, nullable=False, server_default=now()),
+    Index('RESERVATION_reservation_id_UNIQUE', 'reservation_id', unique=True),
+    Index('RESERVATION_user_service_idx', 'user_id', 'service_id'))
+
+staged_file = Table(
+    'STAGED_FILE', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('local_job_id', String(128), nullable=False),
+    Column('service_id', Integer, nullable=False),
+    Column('name', String(256), nullable=False),
+    Column('hash', String(64), nullable=False),
+    Column('staged', DateTime, nullable=False, server_default=now()),
+    Index('STAGED_FILE_job_idx', 'local_job_id', 'name'))
+
+job_archive = Table(
+    'JOB_ARCHIVE', metadata,
+    *_job_columns(archive=True) + [
+        Column('archived', DateTime, nullable=False, server_default=now()),
+        Index('JOB_ARCHIVE_local_job_id_UNIQUE', 'local_job_id', unique=True),
+        Index('JOB_ARCHIVE_array_idx', 'array_id', 'array_index'),
+        Index('JOB_ARCHIVE_runtime_idx', 'service_id', 'template_id', 'runtime'),
+        Index('JOB_ARCHIVE_reused_from_idx', 'reused_from'),
+        Index('JOB_ARCHIVE_user_created_idx', 'user_id', 'created', 'id'),
+        Index('JOB_ARCHIVE_created_idx', 'created', 'id')])
+
+user_job_count = Table(
+    'USER_JOB_COUNT', metadata,
+    Column('user_id', Integer, ForeignKey('user.id'), primary_key=True, autoincrement=False),
+    Column('active_jobs', Integer, nullable=False, server_default='0'))
+
+for table in [job, job_template, pilot, job_archive]:
+    _track_last_modified(table)
+
+
+def create_all(engine):
+
+    # create whichever tables don't exist yet
+    metadata.create_all(engine)
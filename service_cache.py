@@ -0,0 +1,106 @@
+"""
+   Copyright 2018-2019 EPCC, University Of Edinburgh
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import threading
+import time
+
+
+class ServiceCache(object):
+
+    # read-through cache of the service configurations, by id and by name. the SERVICE table is small
+    # and rarely changes, so the whole of it is loaded at once, and loaded again when it's invalidated,
+    # when it's older than max_age seconds, or when first asked for a service it doesn't have. a service
+    # still missing after that is remembered as unknown until the next load, so that requests naming
+    # one can't force a load each. invalidating bumps a version number, so a load that was already
+    # under way when the table changed isn't kept
+
+    def __init__(self, load, max_age):
+
+        # load returns a list of service dicts, each with its 'id' and 'name'
+        self._load = load
+        self.max_age = max_age
+
+        self._lock = threading.Lock()
+        self._version = 0
+        self._by_id = None
+        self._by_name = None
+        # ids and names looked for since the last load and not found
+        self._unknown = (set(), set())
+        self._loaded_time = 0
+
+    def invalidate(self):
+
+        with self._lock:
+            self._version += 1
+            self._by_id = None
+            self._by_name = None
+            self._unknown = (set(), set())
+
+    def get(self, service_id):
+
+        # a copy of the service's configuration, or None if there's no such service
+        return self._lookup(0, int(service_id))
+
+    def get_by_name(self, name):
+
+        return self._lookup(1, name)
+
+    def all(self):
+
+        by_id = self._services()[0]
+        return [dict(by_id[k]) for k in sorted(by_id.keys())]
+
+    def _lookup(self, index, key):
+
+        services = self._services()[index]
+        if key not in services:
+            with self._lock:
+                known_missing = key in self._unknown[index]
+            if not known_missing:
+                # it may have been added since the table was loaded
+                services = self._reload()[index]
+                if key not in services:
+                    with self._lock:
+                        self._unknown[index].add(key)
+        service = services.get(key)
+        if service is None:
+            return None
+        return dict(service)
+
+    def _services(self):
+
+        with self._lock:
+            by_id, by_name = self._by_id, self._by_name
+        if by_id is None or time.time() - self._loaded_time > self.max_age:
+            by_id, by_name = self._reload()
+        return by_id, by_name
+
+    def _reload(self):
+
+        with self._lock:
+            version = self._version
+
+        services = self._load()
+        by_id = dict([(int(s['id']), s) for s in services])
+        by_name = dict([(s['name'], s) for s in services])
+
+        with self._lock:
+            if self._version == version:
+                self._by_id = by_id
+                self._by_name = by_name
+                self._unknown = (set(), set())
+                self._loaded_time = time.time()
+        return by_id, by_name
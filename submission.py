@@ -0,0 +1,169 @@
+"""
+   Copyright 2018-2019 EPCC, University Of Edinburgh
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import threading
+import collections
+import time
+
+
+class _submission(object):
+
+    __slots__ = ['user_id', 'service_id', 'fn', 'args', 'queued_time']
+
+    def __init__(self, user_id, service_id, fn, args):
+        self.user_id = user_id
+        self.service_id = service_id
+        self.fn = fn
+        self.args = args
+        self.queued_time = time.time()
+
+
+class SubmissionExecutor(object):
+
+    # runs job submissions (staging and qsub) on its own pool of worker threads, apart from the
+    # scheduler's pool used for refresh and retrieval. each user has their own queue, and workers
+    # take from the queues in turn, so one user submitting many jobs can't starve everyone else.
+    # no user, and no service, has more than a set number of submissions running at once
+
+    # number of recent waits kept for the mean wait time
+    WAIT_HISTORY = 100
+
+    def __init__(self, num_workers, max_per_user, max_per_service, logger=None):
+
+        self.max_per_user = max_per_user
+        self.max_per_service = max_per_service
+        self.logger = logger
+
+        self._cond = threading.Condition()
+
+        # user id -> queue of waiting submissions, in the order users are next served
+        self._queues = collections.OrderedDict()
+        self._running_by_user = collections.defaultdict(int)
+        self._running_by_service = collections.defaultdict(int)
+        self._waits = collections.deque(maxlen=self.WAIT_HISTORY)
+
+        self._workers = []
+        for i in range(num_workers):
+            worker = threading.Thread(target=self._run, name="submission-%d" % i)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, user_id, service_id, fn, *args):
+
+        with self._cond:
+            self._queues.setdefault(user_id, collections.deque()).append(_submission(user_id, service_id, fn, args))
+            self._cond.notify()
+
+    def stats(self):
+
+        # queue depth and wait times, for monitoring
+        with self._cond:
+            now = time.time()
+            queued = [s for q in self._queues.values() for s in q]
+            return {
+                'workers': len(self._workers),
+                'queued': len(queued),
+                'running': sum(self._running_by_user.values()),
+                'queued_by_user': dict([(str(u), len(q)) for u, q in self._queues.items()]),
+                'running_by_service': dict([(str(s), n) for s, n in self._running_by_service.items() if n > 0]),
+                'oldest_wait': max([now - s.queued_time for s in queued]) if queued else 0,
+                'mean_wait': sum(self._waits) / len(self._waits) if self._waits else 0
+            }
+
+    def _next(self):
+
+        # the first waiting submission, taking users in turn, that neither its user nor its service
+        # has reached their limit for. its user goes to the back of the line. called holding the lock
+
+        for user_id in list(self._queues.keys()):
+            if self._running_by_user[user_id] >= self.max_per_user:
+                continue
+
+            queue = self._queues[user_id]
+            for i, submission in enumerate(queue):
+                if self._running_by_service[submission.service_id] < self.max_per_service:
+                    del queue[i]
+                    del self._queues[user_id]
+                    if len(queue) > 0:
+                        self._queues[user_id] = queue
+                    return submission
+
+        return None
+
+    def _run(self):
+
+        while True:
+            with self._cond:
+                submission = self._next()
+                while submission is None:
+                    self._cond.wait()
+                    submission = self._next()
+
+                self._running_by_user[submission.user_id] += 1
+                self._running_by_service[submission.service_id] += 1
+                self._waits.append(time.time() - submission.queued_time)
+
+            try:
+                submission.fn(*submission.args)
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.error("submission failed: " + str(e))
+            finally:
+                with self._cond:
+                    self._running_by_user[submission.user_id] -= 1
+                    self._running_by_service[submission.service_id] -= 1
+                    # a finished submission may unblock another user's or service's queue
+                    self._cond.notify_all()
+
+
+class ServiceAdmission(object):
+
+    # admission control for qsub. a token bucket per service limits the rate of submissions
+    # (rate per minute, in bursts of up to burst), and a cap limits the jobs in flight, counting
+    # both those already submitted and those being submitted now. unset limits don't apply
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+
+        # service id -> (tokens, time of last refill)
+        self._buckets = {}
+        self._launching = collections.defaultdict(int)
+
+    def admit(self, service_id, submitted, max_in_flight=None, rate=None, burst=None):
+
+        with self._lock:
+            if max_in_flight is not None and submitted + self._launching[service_id] >= max_in_flight:
+                return False
+
+            if rate is not None:
+                now = time.time()
+                capacity = max(1, burst or 1)
+                tokens, last = self._buckets.get(service_id, (capacity, now))
+                tokens = min(capacity, tokens + (now - last) * rate / 60.0)
+                if tokens < 1:
+                    self._buckets[service_id] = (tokens, now)
+                    return False
+                self._buckets[service_id] = (tokens - 1, now)
+
+            self._launching[service_id] += 1
+            return True
+
+    def release(self, service_id):
+
+        with self._lock:
+            self._launching[service_id] -= 1
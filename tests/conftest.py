@@ -0,0 +1,46 @@
+"""
+   Copyright 2018-2019 EPCC, University Of Edinburgh
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import os
+import shutil
+import tempfile
+import pytest
+from flask import Flask
+import db_utils
+import schema
+
+# fixtures for the tests that need a database: the service's schema, created in a throwaway SQLite
+# database rather than the service's MySQL one, with the production pool settings
+
+
+@pytest.fixture
+def app():
+
+    folder = tempfile.mkdtemp()
+    try:
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(folder, 'test.db')
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        app.config['SQLALCHEMY_POOL_SIZE'] = 10
+        app.config['SQLALCHEMY_MAX_OVERFLOW'] = 20
+        app.config['SQLALCHEMY_POOL_TIMEOUT'] = 30
+        app.config['SQLALCHEMY_POOL_RECYCLE'] = 3600
+        db = db_utils.PooledSQLAlchemy(app)
+        db_utils.init_app(app, db)
+        schema.create_all(db.engine)
+        yield app
+    finally:
+        shutil.rmtree(folder)
@@ -0,0 +1,110 @@
+"""
+   Copyright 2018-2019 EPCC, University Of Edinburgh
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from flask import abort
+import db_utils
+from db_utils import execute
+
+# tests for the data access layer, against the app fixture's throwaway sqlite database
+
+
+def add_job(local_job_id):
+
+    execute("INSERT INTO JOB(name, user_id, service_id, local_job_id) VALUES('test', 1, 1, :local_job_id)",
+            local_job_id=local_job_id)
+
+
+def add_routes(app):
+
+    @app.route('/jobs/<id>', methods=['POST'])
+    def create(id):
+        add_job(id)
+        return 'Success'
+
+    @app.route('/jobs/<id>/fail', methods=['POST'])
+    def create_and_fail(id):
+        add_job(id)
+        abort(500, "failed")
+
+
+def count_jobs():
+
+    return execute("SELECT COUNT(*) AS n FROM JOB").fetchone()['n']
+
+
+def testRequestCommitsOrRollsBack(app):
+
+    add_routes(app)
+    client = app.test_client()
+    assert client.post('/jobs/a').status_code == 200
+    assert count_jobs() == 1
+
+    # a failed request leaves nothing behind
+    assert client.post('/jobs/b/fail').status_code == 500
+    assert count_jobs() == 1
+
+
+def testStatementsAreReused():
+
+    sql = "SELECT state FROM JOB WHERE local_job_id=:local_job_id"
+    assert db_utils.statement(sql) is db_utils.statement(sql)
+    assert db_utils.statement(sql) is not db_utils.statement(sql, ['local_job_id'])
+
+
+def testListsAreExpanded(app):
+
+    for id in ['a', 'b', 'c']:
+        add_job(id)
+    result = execute("SELECT local_job_id FROM JOB WHERE local_job_id IN :ids", ids=['a', 'c']).fetchall()
+    assert sorted([r['local_job_id'] for r in result]) == ['a', 'c']
+
+
+def testTaskSharesOneConnection(app):
+
+    connections = []
+
+    @db_utils.task
+    def task():
+        add_job('t')
+        connections.append(db_utils._current())
+        nested()
+
+    @db_utils.task
+    def nested():
+        connections.append(db_utils._current())
+
+    task()
+    assert connections[0] is not None and connections[0] is connections[1]
+    assert db_utils._current() is None
+    assert count_jobs() == 1
+
+
+def testTransactionInTask(app):
+
+    @db_utils.task
+    def task():
+        try:
+            with db_utils.transaction():
+                add_job('t')
+                raise ValueError()
+        except ValueError:
+            pass
+        with db_utils.transaction():
+            add_job('u')
+
+    task()
+    result = execute("SELECT local_job_id FROM JOB").fetchall()
+    assert [r['local_job_id'] for r in result] == ['u']
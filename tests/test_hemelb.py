@@ -19,7 +19,7 @@ import requests
 import time
 from config import MAX_USER_JOBS
 import uuid
-from tests.test_params import LOGIN_URL, JOBS_URL, INPUTSETS_URL
+from tests.test_params import LOGIN_URL, JOBS_URL, INPUTSETS_URL, ARRAYS_URL
 from tests.test_params import TEST_TEMPLATE_NAME, QUICK_TEMPLATE_NAME, TEST_RESULTS_DIR, QUICK_TEMPLATE_UPLOAD_FILE
 from tests.test_params import TEST_UPLOAD_FILE, TEST_CONFIG_FILE, TEST_INPUT_NAME
 from tests.test_params import login_credentials
@@ -427,6 +427,93 @@ def testQuickMultiUser():
 
 
 
+# submit several copies of the quick template as one job array
+def testQuickJobArray():
+
+    with requests.Session() as s:
+
+        p = s.post(LOGIN_URL, data=login_credentials)
+        assert p.status_code == 200
+
+        array_payload = {'template_name': QUICK_TEMPLATE_NAME,
+                         'array_arguments': ['', '', '']}
+
+        p = s.post(ARRAYS_URL, json=array_payload)
+        assert p.status_code == 200
+        array_id = p.json()['array_id']
+        jobs = p.json()['jobs']
+        assert len(jobs) == 3
+
+        # each member of the array is an ordinary job with its own input files
+        for job_id in jobs:
+            p = s.post(JOBS_URL + "/" + str(job_id) + "/files", files={'fuzzy.pgm': open(QUICK_TEMPLATE_UPLOAD_FILE, 'rb')})
+            assert p.status_code == 200
+
+        p = s.post(ARRAYS_URL + "/" + array_id + "/submit")
+        assert p.status_code == 200
+
+        # submitting again should fail, the jobs are no longer new
+        time.sleep(10)
+        p = s.post(ARRAYS_URL + "/" + array_id + "/submit")
+        assert p.status_code == 500
+
+        while len(jobs) > 0:
+            time.sleep(60)
+            for job_id in list(jobs):
+                p = s.get(JOBS_URL + "/" + str(job_id) + "/state")
+                assert p.status_code == 200
+                state = p.content
+                print(job_id, state)
+                if state in ['Done', 'Failed']:
+                    p = s.delete(JOBS_URL + "/" + str(job_id))
+                    assert p.status_code == 200
+                    jobs.remove(job_id)
+
+
+
+# cancel several running jobs with a single request
+def testBulkCancel():
+
+    with requests.Session() as s:
+
+        p = s.post(LOGIN_URL, data=login_credentials)
+        assert p.status_code == 200
+
+        jobs = []
+        for i in range(2):
+            p = s.post(JOBS_URL, json={'template_name': QUICK_TEMPLATE_NAME})
+            assert p.status_code == 200
+            job_id = p.content
+            jobs.append(job_id)
+
+            p = s.post(JOBS_URL + "/" + str(job_id) + "/files", files={'fuzzy.pgm': open(QUICK_TEMPLATE_UPLOAD_FILE, 'rb')})
+            assert p.status_code == 200
+
+            p = s.post(JOBS_URL + "/" + str(job_id) + "/submit")
+            assert p.status_code == 200
+
+        # wait for the jobs to reach the scheduler
+        for job_id in jobs:
+            state = None
+            while state != 'SUBMITTED':
+                time.sleep(10)
+                state = s.get(JOBS_URL + "/" + str(job_id) + "/state").content
+
+        unknown_job_id = str(uuid.uuid4())
+        p = s.post(JOBS_URL + "/cancel", json=jobs + [unknown_job_id])
+        assert p.status_code == 200
+        results = p.json()
+        print(results)
+        for job_id in jobs:
+            assert results[job_id] == 'Canceled'
+        assert results[unknown_job_id] == 'Resource not found'
+
+        for job_id in jobs:
+            p = s.delete(JOBS_URL + "/" + str(job_id))
+            assert p.status_code == 200
+
+
+
 # note: this test relies on the user having no active jobs in the test database
 # some manual clearup will be needed after running this test
 def testJobLimit():
@@ -462,6 +549,38 @@ def testJobLimit():
         assert p.status_code == 500
 
 
+def testJobListPaging():
+
+    with requests.Session() as s:
+
+        p = s.post(LOGIN_URL, data=login_credentials)
+        assert p.status_code == 200
+
+        job_ids = []
+        for i in range(0, 3):
+            p = s.post(JOBS_URL, json=payload)
+            assert p.status_code == 200
+            job_ids.append(p.content)
+
+        # newest first, two at a time
+        p = s.get(JOBS_URL, params={'limit': 2, 'state': 'NEW'})
+        assert p.status_code == 200
+        page = p.json()
+        assert [j['local_job_id'] for j in page] == [job_ids[2], job_ids[1]]
+        cursor = p.headers['X-Next-Cursor']
+
+        p = s.get(JOBS_URL, params={'limit': 2, 'state': 'NEW', 'after': cursor})
+        assert p.status_code == 200
+        assert p.json()[0]['local_job_id'] == job_ids[0]
+
+        for job_id in job_ids:
+            s.delete(JOBS_URL + "/" + job_id)
+
+        # deleted jobs can be left out
+        p = s.get(JOBS_URL, params={'state': 'NEW'})
+        assert job_ids[0] not in [j['local_job_id'] for j in p.json()]
+
+
 
 def testInputSet():
 
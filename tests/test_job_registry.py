@@ -0,0 +1,128 @@
+"""
+   Copyright 2018-2019 EPCC, University Of Edinburgh
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import saga
+from pbsprojob import _job_record, _job_registry, _array_dispatch_script, qdel_jobs
+
+# soak test for the PBSPro adaptor's job registry; doesn't need a running hoff or PBS service
+
+NUM_SYNTHETIC_JOBS = 100000
+MAX_FINAL_JOBS = 1000
+JOBS_IN_FLIGHT = 50
+
+
+def synthetic_job_id(i):
+    return "[pbspro+ssh://localhost]-[%d]" % i
+
+
+def testRegistryStaysBounded():
+
+    registry = _job_registry(max_final=MAX_FINAL_JOBS)
+
+    for i in range(NUM_SYNTHETIC_JOBS):
+        job_id = synthetic_job_id(i)
+        registry[job_id] = _job_record(job_id=job_id, state=saga.job.PENDING, gone=False)
+
+        # jobs finish a little while after they are submitted
+        if i >= JOBS_IN_FLIGHT:
+            finished_id = synthetic_job_id(i - JOBS_IN_FLIGHT)
+            finished = registry[finished_id]
+            finished['state'] = saga.job.DONE
+            registry[finished_id] = finished
+
+        assert len(registry) <= MAX_FINAL_JOBS + JOBS_IN_FLIGHT
+
+    # the jobs still running are never evicted
+    assert len(registry.active_keys()) == JOBS_IN_FLIGHT
+    for i in range(NUM_SYNTHETIC_JOBS - JOBS_IN_FLIGHT, NUM_SYNTHETIC_JOBS):
+        assert synthetic_job_id(i) in registry
+
+    # the oldest finished jobs have gone, the most recent are still there
+    assert synthetic_job_id(0) not in registry
+    assert synthetic_job_id(NUM_SYNTHETIC_JOBS - JOBS_IN_FLIGHT - 1) in registry
+
+
+def testRegistryEvictsLeastRecentlyUsed():
+
+    registry = _job_registry(max_final=2)
+
+    for i in range(2):
+        registry[synthetic_job_id(i)] = _job_record(state=saga.job.DONE)
+
+    # looking a job up keeps it alive
+    registry.get(synthetic_job_id(0))
+    registry[synthetic_job_id(2)] = _job_record(state=saga.job.DONE)
+
+    assert synthetic_job_id(0) in registry
+    assert synthetic_job_id(1) not in registry
+    assert synthetic_job_id(2) in registry
+
+
+def testRecordIsCompact():
+
+    fields = dict([(key, None) for key in _job_record.__slots__])
+    assert sys.getsizeof(_job_record(**fields)) < sys.getsizeof(fields)
+
+
+class ArrayJobDescription(object):
+    output = None
+    error = None
+
+
+def testArrayArgumentsAreQuoted():
+
+    # a subjob's arguments reach it as they were given, without the shell expanding or running any of them
+    folder = tempfile.mkdtemp()
+    try:
+        arguments = ['config.xml', '"; touch hacked; "', '$(touch hacked)', '`touch hacked`', 'two words']
+        subjobs = [{'working_directory': os.path.join(folder, 'sub job'), 'arguments': arguments}]
+        script = _array_dispatch_script(ArrayJobDescription(), subjobs) + 'printf "%s\\n" "${HOFF_SUBJOB_ARGS[@]}"\n'
+        env = dict(os.environ, PBS_ARRAY_INDEX='0')
+        out = subprocess.check_output(['bash', '-c', script], cwd=folder, env=env)
+        assert out.splitlines() == arguments
+        assert not os.path.exists(os.path.join(folder, 'hacked'))
+        assert not os.path.exists(os.path.join(folder, 'sub job', 'hacked'))
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    testRegistryStaysBounded()
+    testRegistryEvictsLeastRecentlyUsed()
+    testRecordIsCompact()
+    testArrayArgumentsAreQuoted()
+
+
+def testQdelErrorsAreMatchedToJobs():
+
+    commands = []
+
+    def run(cmd):
+        commands.append(cmd)
+        return 35, "qdel: Unknown Job Id 12.host\n"
+
+    pids = dict([(str(i), str(i)) for i in range(10, 1000)])
+    errors = qdel_jobs(sorted(pids.keys()), pids, 'qdel', run)
+
+    # the ids are split over several commands, none of them too long
+    assert len(commands) > 1 and max([len(c) for c in commands]) <= 4000
+    assert errors['12'] == 'qdel: Unknown Job Id 12.host'
+    assert errors['13'] is None
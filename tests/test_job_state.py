@@ -0,0 +1,117 @@
+"""
+   Copyright 2018-2019 EPCC, University Of Edinburgh
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import pytest
+from db_utils import execute
+import job_state
+from job_state import transition, transition_array, TransitionError
+
+# tests for the job state machine, against the app fixture's throwaway sqlite database
+
+
+def add_job(local_job_id, state, array_id=None, array_index=None):
+
+    execute("INSERT INTO JOB(name, user_id, service_id, local_job_id, array_id, array_index, state) "
+            "VALUES('test', 1, 1, :local_job_id, :array_id, :array_index, :state)",
+            local_job_id=local_job_id, array_id=array_id, array_index=array_index, state=state)
+
+
+def get_job(local_job_id):
+
+    return execute("SELECT * FROM JOB WHERE local_job_id=:local_job_id", local_job_id=local_job_id).fetchone()
+
+
+def testIllegalTransitions():
+
+    with pytest.raises(TransitionError):
+        transition('a', [job_state.NEW], job_state.SUBMITTED)
+    with pytest.raises(TransitionError):
+        transition('a', [job_state.DELETED], job_state.NEW)
+    with pytest.raises(TransitionError):
+        transition('a', [job_state.STAGING], job_state.SUBMITTED, **{'queue=NULL, state': 'NEW'})
+
+
+def testOnlyOneTransitionWins(app):
+
+    add_job('a', job_state.NEW)
+    assert transition('a', [job_state.NEW], job_state.STAGING)
+    assert not transition('a', [job_state.NEW], job_state.STAGING)
+
+    assert transition('a', [job_state.STAGING], job_state.SUBMITTED, remote_job_id='1')
+    assert get_job('a')['remote_job_id'] == '1'
+
+    # a job deleted while it was being submitted isn't brought back
+    assert job_state.mark_deleted('a')
+    assert not transition('a', [job_state.SUBMITTED], 'Done')
+    assert get_job('a')['state'] == job_state.DELETED
+    assert not job_state.mark_deleted('a')
+
+
+def testArrayTransitions(app):
+
+    add_job('a', job_state.NEW, 'x')
+    add_job('b', job_state.DELETED, 'x')
+    assert transition_array('x', [job_state.NEW], job_state.STAGING) == 1
+    assert get_job('a')['state'] == job_state.STAGING
+    assert get_job('b')['state'] == job_state.DELETED
+
+
+def testPartlyCancelledArrayIsRenumbered(app):
+
+    # the second job of a queued array was cancelled; the other two are drained as subjobs 0 and 1
+    add_job('a', job_state.QUEUED, 'x', 0)
+    add_job('b', job_state.CANCELED, 'x', 1)
+    add_job('c', job_state.QUEUED, 'x', 2)
+    subjobs = job_state.claim_array('x', [job_state.QUEUED], job_state.STAGING)
+    assert [(index, r['local_job_id']) for index, r in subjobs] == [(0, 'a'), (1, 'c')]
+    assert get_job('c')['state'] == job_state.STAGING
+    assert get_job('b')['state'] == job_state.CANCELED
+
+    # and aren't drained again
+    assert job_state.claim_array('x', [job_state.QUEUED], job_state.STAGING) == []
+
+
+def testRetrievalIsClaimedOnce(app):
+
+    add_job('a', 'Done')
+    assert job_state.claim_retrieval('a')
+    assert not job_state.claim_retrieval('a')
+
+    job_state.abandon_retrieval('a')
+    assert job_state.claim_retrieval('a')
+    job_state.finish_retrieval('a')
+    assert get_job('a')['retrieved'] == job_state.RETRIEVED
+    assert not job_state.claim_retrieval('a')
+
+
+def testJobsAreCountedAgainstTheLimit(app):
+
+    # jobs from before the user was counted are included in the count
+    add_job('a', 'Done')
+    add_job('b', job_state.DELETED)
+    execute("INSERT INTO JOB_ARCHIVE(id, name, user_id, service_id, local_job_id, state) "
+            "VALUES(10, 'test', 1, 1, 'c', 'Done')")
+
+    assert job_state.admit_jobs(1, 2, 4)
+    assert not job_state.admit_jobs(1, 1, 4)
+
+    # deleting a job, archived or not, frees its place
+    assert job_state.mark_deleted('c')
+    assert job_state.admit_jobs(1, 1, 4)
+    assert not job_state.admit_jobs(1, 1, 4)
+
+    # other users have counts of their own
+    assert job_state.admit_jobs(2, 4, 4)
@@ -0,0 +1,86 @@
+"""
+   Copyright 2018-2019 EPCC, University Of Edinburgh
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import pytest
+from job_templates import TemplateRegistry, TEMPLATE_FIELDS, compile_template, parse_env
+
+# tests for the job template registry; doesn't need a running hoff service or database
+
+
+def template_row(name, **values):
+
+    row = dict([(k, None) for k in TEMPLATE_FIELDS])
+    row['name'] = name
+    row.update(values)
+    return row
+
+
+def testTemplatesAreCompiled():
+
+    template = compile_template(template_row('hemelb', arguments='-in input.xml -out results',
+                                             env='OMP_NUM_THREADS=1 FOO=bar', filter='results/.*'))
+    assert template.argument_list == ['-in', 'input.xml', '-out', 'results']
+    assert template.env_dict == {'OMP_NUM_THREADS': '1', 'FOO': 'bar'}
+    assert template.filter_regex.match('results/out.dat') is not None
+    assert template.error is None
+
+    assert compile_template(template_row('bad', filter='results/(')).error is not None
+    assert compile_template(template_row('bad', env='nonsense')).env_dict is None
+    assert compile_template(template_row('bad', env='FOO=bar $(reboot)=x')).env_dict is None
+
+    assert parse_env(None) is None
+
+
+def testEnvNamesMustBeShellVariables():
+
+    assert parse_env('_FOO1=a') == {'_FOO1': 'a'}
+    for env in ['1FOO=a', 'FOO-BAR=a', 'FOO;reboot=a', '$(reboot)=a', '=a']:
+        with pytest.raises(ValueError):
+            parse_env(env)
+
+
+def testRegistryLoadsOnceUntilInvalidated():
+
+    rows = [template_row('a', family='f', service_id=1), template_row('b', family='f', service_id=2),
+            template_row('c')]
+    loads = []
+
+    def load():
+        loads.append(1)
+        return list(rows)
+
+    registry = TemplateRegistry(load, 300)
+    assert registry.get('a').service_id == 1
+    assert sorted([t.name for t in registry.family('f')]) == ['a', 'b']
+    assert [t.name for t in registry.all()] == ['a', 'b', 'c']
+    assert len(loads) == 1
+
+    rows[0] = template_row('a', family='f', service_id=3)
+    assert registry.get('a').service_id == 1
+    registry.invalidate()
+    assert registry.get('a').service_id == 3
+
+    # a template added since the last load is found
+    rows.append(template_row('d'))
+    assert registry.get('d') is not None
+    assert registry.get('e') is None
+
+
+def testTemplatesAreFoundById():
+
+    registry = TemplateRegistry(lambda: [template_row('a', id=1), template_row('b', id=2)], 300)
+    assert registry.get_by_id(2).name == 'b'
+    assert registry.get_by_id(3) is None
@@ -7,6 +7,7 @@ BASE_URL = "http://127.0.0.1:5000"
 LOGIN_URL = BASE_URL + "/admin/login/"
 JOBS_URL = BASE_URL + "/jobs"
 INPUTSETS_URL = BASE_URL + "/inputsets"
+ARRAYS_URL = BASE_URL + "/arrays"
 PEM_CERTIFICATE = "/home/ubuntu/hoff-server.pem"
 
 # local credentials we are going to use for main tests
@@ -0,0 +1,52 @@
+"""
+   Copyright 2018-2019 EPCC, University Of Edinburgh
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from principal import Principal, PrincipalCache
+
+# tests for the cached request principals; doesn't need a running hoff service
+
+
+def testRoles():
+
+    principal = Principal(1, frozenset(['poweruser']))
+    assert principal.has_role('poweruser')
+    assert not principal.has_role('superuser')
+    assert principal.has_any_role('superuser', 'poweruser')
+    assert not Principal(2, frozenset()).has_any_role('superuser', 'poweruser')
+
+
+def testCacheLoadsOnceUntilInvalidated():
+
+    loads = []
+
+    def load():
+        loads.append(1)
+        return Principal(1, frozenset(['superuser']))
+
+    cache = PrincipalCache(60)
+    assert cache.get(1, load).has_role('superuser')
+    assert cache.get(1, load).has_role('superuser')
+    assert len(loads) == 1
+
+    cache.invalidate(1)
+    cache.get(1, load)
+    assert len(loads) == 2
+
+    # with no max age nothing is kept
+    cache = PrincipalCache(0)
+    cache.get(1, load)
+    cache.get(1, load)
+    assert len(loads) == 4
@@ -0,0 +1,68 @@
+"""
+   Copyright 2018-2019 EPCC, University Of Edinburgh
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import datetime
+import db_utils
+from db_utils import execute
+import schema
+
+# tests for local mode: the service's schema created in SQLite by the app fixture in conftest.py
+
+
+def add_job(local_job_id):
+
+    execute("INSERT INTO JOB(name, user_id, service_id, local_job_id) VALUES('test', 1, 1, :local_job_id)",
+            local_job_id=local_job_id)
+
+
+def testFileDatabase(app):
+
+    # creating the schema again changes nothing
+    schema.create_all(app.extensions['sqlalchemy'].db.engine)
+
+    add_job('a')
+    job = execute("SELECT * FROM JOB WHERE local_job_id='a'").fetchone()
+    assert job['state'] == 'NEW' and job['retrieved'] == 0
+
+    # created is in local time, like the times the app compares it with
+    created = db_utils.to_datetime(job['created'])
+    assert abs(created - datetime.datetime.now()) < datetime.timedelta(minutes=1)
+
+    # last_modified follows updates
+    execute("UPDATE JOB SET last_modified='2000-01-01 00:00:00' WHERE local_job_id='a'")
+    assert execute("UPDATE JOB SET state='STAGING' WHERE local_job_id='a' AND state IN ('NEW')").rowcount == 1
+    job = execute("SELECT * FROM JOB WHERE local_job_id='a'").fetchone()
+    assert db_utils.to_datetime(job['last_modified']).year > 2000
+
+
+def testArchiveMatchesJob(app):
+
+    add_job('a')
+    columns = ', '.join([c.name for c in schema.job.columns])
+    execute("INSERT INTO JOB_ARCHIVE (" + columns + ", archived) SELECT " + columns + ", :archived FROM JOB",
+            archived=datetime.datetime.now())
+    archived = execute("SELECT * FROM JOB_ARCHIVE WHERE local_job_id='a'").fetchone()
+    job = execute("SELECT * FROM JOB WHERE local_job_id='a'").fetchone()
+    assert [archived[k] for k in job.keys()] == list(job)
+
+
+def testToDatetime():
+
+    value = datetime.datetime(2019, 1, 2, 3, 4, 5)
+    assert db_utils.to_datetime(value) is value
+    assert db_utils.to_datetime('2019-01-02 03:04:05') == value
+    assert db_utils.to_datetime('2019-01-02 03:04:05.123456') == value
+    assert db_utils.to_datetime(None) is None
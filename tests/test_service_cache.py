@@ -0,0 +1,90 @@
+"""
+   Copyright 2018-2019 EPCC, University Of Edinburgh
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from service_cache import ServiceCache
+
+# tests for the service configuration cache; doesn't need a running hoff service or database
+
+
+class Table(object):
+
+    def __init__(self, services):
+        self.services = services
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+        return [dict(s) for s in self.services]
+
+
+def testLookupsShareOneLoad():
+
+    table = Table([{'id': 1, 'name': 'cirrus'}, {'id': 2, 'name': 'archer'}])
+    cache = ServiceCache(table.load, 300)
+
+    assert cache.get(1)['name'] == 'cirrus'
+    assert cache.get('2')['name'] == 'archer'
+    assert cache.get_by_name('cirrus')['id'] == 1
+    assert [s['id'] for s in cache.all()] == [1, 2]
+    assert table.loads == 1
+
+    # callers get copies, so can't change the cached configuration
+    cache.get(1)['name'] = 'changed'
+    assert cache.get(1)['name'] == 'cirrus'
+
+
+def testInvalidateAndMissesReload():
+
+    table = Table([{'id': 1, 'name': 'cirrus'}])
+    cache = ServiceCache(table.load, 300)
+    assert cache.get(1)['name'] == 'cirrus'
+
+    table.services = [{'id': 1, 'name': 'cirrus2'}]
+    assert cache.get(1)['name'] == 'cirrus'
+    cache.invalidate()
+    assert cache.get(1)['name'] == 'cirrus2'
+
+    # a service added since the last load is found
+    table.services.append({'id': 3, 'name': 'new'})
+    assert cache.get_by_name('new')['id'] == 3
+    assert cache.get(4) is None
+
+
+def testUnknownServicesAreRemembered():
+
+    table = Table([{'id': 1, 'name': 'cirrus'}])
+    cache = ServiceCache(table.load, 300)
+    assert cache.get(1)['name'] == 'cirrus'
+
+    # a miss reloads once, and isn't looked for again until the next load
+    assert cache.get_by_name('nonesuch') is None
+    assert cache.get_by_name('nonesuch') is None
+    assert cache.get(7) is None
+    assert cache.get(7) is None
+    assert table.loads == 3
+
+    table.services.append({'id': 7, 'name': 'nonesuch'})
+    cache.invalidate()
+    assert cache.get_by_name('nonesuch')['id'] == 7
+
+
+def testExpiredLoadIsReplaced():
+
+    table = Table([{'id': 1, 'name': 'cirrus'}])
+    cache = ServiceCache(table.load, -1)
+    cache.get(1)
+    cache.get(1)
+    assert table.loads >= 2
@@ -0,0 +1,115 @@
+"""
+   Copyright 2018-2019 EPCC, University Of Edinburgh
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import threading
+import time
+from submission import SubmissionExecutor, ServiceAdmission
+
+# tests for the fair submission executor; doesn't need a running hoff or PBS service
+
+
+def testUsersTakeTurns():
+
+    # one user queues a large batch before another queues one job; with a single worker,
+    # the second user's job runs next rather than after the whole batch
+
+    order = []
+    gate = threading.Event()
+
+    def submission(user, n):
+        gate.wait()
+        order.append((user, n))
+
+    executor = SubmissionExecutor(1, 1, 10)
+    for n in range(10):
+        executor.submit(1, 1, submission, 1, n)
+    executor.submit(2, 1, submission, 2, 0)
+    gate.set()
+
+    while len(order) < 11:
+        time.sleep(0.01)
+
+    assert order[0] == (1, 0)
+    assert order[1] == (2, 0)
+    assert order[2:] == [(1, n) for n in range(1, 10)]
+
+
+def testLimitsAreRespected():
+
+    lock = threading.Lock()
+    running = {'user': {}, 'service': {}}
+    peaks = {'user': 0, 'service': 0}
+    done = []
+
+    def submission(user, service):
+        with lock:
+            for kind, key in [('user', user), ('service', service)]:
+                running[kind][key] = running[kind].get(key, 0) + 1
+                peaks[kind] = max(peaks[kind], running[kind][key])
+        time.sleep(0.02)
+        with lock:
+            running['user'][user] -= 1
+            running['service'][service] -= 1
+            done.append(user)
+
+    executor = SubmissionExecutor(8, 2, 3)
+    for user in range(5):
+        for i in range(4):
+            executor.submit(user, user % 2, submission, user, user % 2)
+
+    while len(done) < 20:
+        time.sleep(0.01)
+
+    assert peaks['user'] <= 2
+    assert peaks['service'] <= 3
+
+    # the workers count a submission as running until just after it returns, so wait for them to go idle
+    deadline = time.time() + 5
+    stats = executor.stats()
+    while stats['running'] > 0 and time.time() < deadline:
+        time.sleep(0.01)
+        stats = executor.stats()
+    assert stats['queued'] == 0
+    assert stats['running'] == 0
+
+
+def testAdmissionLimitsInFlight():
+
+    admission = ServiceAdmission()
+
+    # two already submitted, room for one more
+    assert admission.admit(1, 2, max_in_flight=3)
+    assert not admission.admit(1, 2, max_in_flight=3)
+
+    # other services are limited separately
+    assert admission.admit(2, 2, max_in_flight=3)
+
+    admission.release(1)
+    assert admission.admit(1, 2, max_in_flight=3)
+
+
+def testAdmissionLimitsRate():
+
+    admission = ServiceAdmission()
+
+    # a burst of three, then nothing until the bucket refills at one a second
+    for i in range(3):
+        assert admission.admit(1, 0, rate=60, burst=3)
+        admission.release(1)
+    assert not admission.admit(1, 0, rate=60, burst=3)
+
+    time.sleep(1.1)
+    assert admission.admit(1, 0, rate=60, burst=3)
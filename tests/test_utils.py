@@ -0,0 +1,31 @@
+"""
+   Copyright 2018-2019 EPCC, University Of Edinburgh
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import json
+from utils import json_array
+
+# tests for the helper functions; doesn't need a running hoff service
+
+
+def testJsonArray():
+
+    assert ''.join(json_array([], json.dumps)) == '[]'
+    assert json.loads(''.join(json_array(['a', 'b'], json.dumps))) == ['a', 'b']
+
+    rows = [('job%d' % i, i) for i in range(250)]
+    chunks = list(json_array(rows, json.dumps, keys=['name', 'id'], chunk_size=100))
+    assert len(chunks) == 4
+    assert json.loads(''.join(chunks)) == [{'name': 'job%d' % i, 'id': i} for i in range(250)]
@@ -0,0 +1,59 @@
+"""
+   Copyright 2018-2019 EPCC, University Of Edinburgh
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from walltime import parse_walltime, fit, suggest_wallclock_limit
+
+# tests for walltime prediction; doesn't need a running hoff or PBS service
+
+
+def testParseWalltime():
+
+    assert parse_walltime("00:12:34") == 754
+    assert parse_walltime(" 01:00:00\n") == 3600
+    assert parse_walltime("garbage") is None
+
+
+def testSuggestionFollowsSitesPerCore():
+
+    # run time is 1 second per 1000 sites per core, plus a minute of setup
+    samples = [(sites, cores, sites / float(cores) / 1000 + 60) for sites, cores in
+               [(1000000, 36), (2000000, 36), (4000000, 72), (8000000, 144), (8000000, 72)]]
+
+    slope, intercept = fit(samples)
+    assert abs(slope - 0.001) < 1e-9
+    assert abs(intercept - 60) < 1e-6
+
+    # 16M sites on 144 cores: ~171 seconds, with 50% margin ~257 seconds, ie 5 minutes, plus 5
+    assert suggest_wallclock_limit(samples, 16000000, 144, 60, 5, 0.5, 5) == 10
+
+    # never more than the template's limit
+    assert suggest_wallclock_limit(samples, 16000000, 144, 8, 5, 0.5, 5) == 8
+    assert suggest_wallclock_limit(samples, 16000000, 144, '8', 5, 0.5, 5) == 8
+
+    # a limit that isn't a number of minutes doesn't cap the suggestion
+    assert suggest_wallclock_limit(samples, 16000000, 144, '01:00:00', 5, 0.5, 5) == 10
+    assert suggest_wallclock_limit(samples, 16000000, 144, '60m', 5, 0.5, 5) == 10
+    assert suggest_wallclock_limit(samples, 16000000, 144, None, 5, 0.5, 5) == 10
+
+
+def testSuggestionNeedsEnoughRuns():
+
+    samples = [(None, 36, 600)] * 4
+    assert suggest_wallclock_limit(samples, None, 36, 60, 5, 0.5, 5) is None
+
+    # without geometries, fall back on the longest run
+    samples.append((None, 36, 1200))
+    assert suggest_wallclock_limit(samples, None, 36, 60, 5, 0.5, 5) == 35
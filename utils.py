@@ -16,7 +16,13 @@
 
 import hashlib
 import os
+import xdrlib
+import bisect
 
+# HemeLB geometry (.gmy) file magic numbers and version
+GMY_HEMELB_MAGIC = 0x686c6221
+GMY_GEOMETRY_MAGIC = 0x676d7904
+GMY_VERSION = 4
 
 
 def queryresult_to_array(keys, queryresult):
@@ -35,6 +41,26 @@ def queryresult_to_array(keys, queryresult):
         d.append(row)
     return d
 
+def json_array(items, dumps, keys=None, chunk_size=100):
+
+    # a JSON array of the items, generated a chunk at a time so that a long list can be streamed as it's
+    # read rather than built up in memory. if keys are given, each item is a row of values for those keys,
+    # and becomes an object. dumps turns one item into JSON
+    yield '['
+    chunk = []
+    separator = ''
+    for item in items:
+        if keys is not None:
+            item = dict(zip(keys, item))
+        chunk.append(separator + dumps(item))
+        separator = ','
+        if len(chunk) >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+    chunk.append(']')
+    yield ''.join(chunk)
+
+
 def queryresult_to_dict(keys, queryresult):
 
     d = {}
@@ -74,6 +100,98 @@ def compute_hash_for_dir_contents(dir):
     return hash_sha.hexdigest()
 
 
+def compute_file_hash(filename):
+
+    hash_sha = hashlib.sha1()
+    read_blocksize = 2 << 15
+
+    with open(filename, 'rb') as f:
+        buf = f.read(read_blocksize)
+        while len(buf) > 0:
+            hash_sha.update(buf)
+            buf = f.read(read_blocksize)
+
+    return hash_sha.hexdigest()
+
+
+def compute_input_hash(dirs, fields):
+
+    # a content hash over a job's inputs: the names and contents of every file under the given
+    # directories, taken in a fixed order, and the given description fields
+
+    hash_sha = hashlib.sha256()
+    read_blocksize = 2 << 15
+
+    for field in fields:
+        hash_sha.update(repr(field))
+        hash_sha.update('\0')
+
+    for dir in dirs:
+        if not os.path.exists(dir):
+            continue
+        for path, subdirs, files in sorted(os.walk(dir)):
+            for name in sorted(files):
+                abspath = os.path.join(path, name)
+                hash_sha.update(os.path.relpath(abspath, dir))
+                hash_sha.update('\0')
+                with open(abspath, 'rb') as f:
+                    buf = f.read(read_blocksize)
+                    while len(buf) > 0:
+                        hash_sha.update(buf)
+                        buf = f.read(read_blocksize)
+
+    return hash_sha.hexdigest()
+
+
+def count_fluid_sites(gmy_filename):
+
+    # read the number of fluid sites from the header of a HemeLB geometry file,
+    # without reading the (much larger) block data that follows
+
+    with open(gmy_filename, 'rb') as gmy:
+        preamble = gmy.read(32)
+        reader = xdrlib.Unpacker(preamble)
+        if reader.unpack_uint() != GMY_HEMELB_MAGIC or reader.unpack_uint() != GMY_GEOMETRY_MAGIC:
+            raise ValueError(gmy_filename + " is not a HemeLB geometry file")
+        if reader.unpack_uint() != GMY_VERSION:
+            raise ValueError(gmy_filename + " has an unsupported geometry file version")
+
+        block_counts = [reader.unpack_uint() for i in range(3)]
+        block_size = reader.unpack_uint()
+        total_blocks = block_counts[0] * block_counts[1] * block_counts[2]
+
+        # the header holds three uints per block: fluid sites, bytes, uncompressed bytes
+        header = gmy.read(total_blocks * 3 * 4)
+
+    reader = xdrlib.Unpacker(header)
+
+    total_fluid = 0
+    for i in range(total_blocks):
+        total_fluid += reader.unpack_uint()
+        reader.unpack_uint()
+        reader.unpack_uint()
+
+    return total_fluid
+
+
+def choose_cores(n_sites, sites_per_core, cores_per_node, known_nodes):
+
+    # size a job to the smallest of the known node counts that gives at least the ideal number of
+    # cores for the number of sites, capped at the largest known node count
+
+    ideal_cores = float(n_sites) / sites_per_core
+    ideal_nodes = ideal_cores / cores_per_node
+
+    # debugging runs on very small problems
+    if ideal_nodes < 0.5:
+        return 2
+
+    known_nodes = sorted(known_nodes)
+    i = bisect.bisect_left(known_nodes, ideal_nodes)
+    i = min(i, len(known_nodes) - 1)
+    return known_nodes[i] * cores_per_node
+
+
 def main():
     print compute_hash_for_dir_contents("/home/ubuntu/inputsets/11")
 
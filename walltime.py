@@ -0,0 +1,87 @@
+"""
+   Copyright 2018-2019 EPCC, University Of Edinburgh
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+# Walltime prediction from the run times of earlier jobs of the same template on the same service.
+# HemeLB's run time is roughly proportional to the number of fluid sites each core updates, so when
+# the earlier jobs' geometries are known we fit run time = a * sites per core + b by least squares.
+# Otherwise we fall back on the longest earlier run. Either way a safety margin is added, and the
+# suggestion is never more than the template's own limit.
+
+import math
+
+
+def parse_walltime(walltime):
+
+    # PBS reports walltime as HH:MM:SS; returns seconds, or None if it can't be read
+    try:
+        fields = [int(f) for f in walltime.strip().split(':')]
+    except (AttributeError, ValueError):
+        return None
+    seconds = 0
+    for f in fields:
+        seconds = seconds * 60 + f
+    return seconds
+
+
+def fit(samples):
+
+    # least squares fit of run time against sites per core, from (fluid sites, cores, run time) samples.
+    # returns (slope, intercept), or None if there is too little spread in the samples to fit a line
+
+    points = [(float(sites) / cores, runtime) for sites, cores, runtime in samples
+              if sites is not None and cores]
+    if len(points) < 2:
+        return None
+
+    n = float(len(points))
+    mean_x = sum([x for x, y in points]) / n
+    mean_y = sum([y for x, y in points]) / n
+    sxx = sum([(x - mean_x) ** 2 for x, y in points])
+    if sxx == 0:
+        return None
+    sxy = sum([(x - mean_x) * (y - mean_y) for x, y in points])
+
+    slope = sxy / sxx
+    if slope <= 0:
+        return None
+    return slope, mean_y - slope * mean_x
+
+
+def suggest_wallclock_limit(samples, fluid_sites, num_total_cpus, limit, min_samples, margin, padding):
+
+    # suggest a wallclock limit in minutes for a new job, from the samples of earlier runs.
+    # margin is a fraction of the predicted run time and padding a number of minutes, both added on top.
+    # returns None if there are fewer than min_samples runs to go on
+
+    if len(samples) < min_samples:
+        return None
+
+    predicted = None
+    model = fit(samples)
+    if model is not None and fluid_sites is not None and num_total_cpus:
+        predicted = model[0] * float(fluid_sites) / num_total_cpus + model[1]
+
+    if predicted is None or predicted <= 0:
+        predicted = max([runtime for sites, cores, runtime in samples])
+
+    suggestion = int(math.ceil(predicted * (1 + margin) / 60.0)) + padding
+
+    # limit comes from a template or the user; one that isn't a number of minutes is no cap
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return suggestion
+    return min(suggestion, limit)
@@ -44,21 +44,18 @@ def s3_upload(local_path, remote_path):
 
 
 def s3_list_files_for_job(job_id):
-    s3_client = get_s3_client()
-    prefix = job_id + "/"
-    result = s3_client.list_objects(Bucket=CIRRUS_WOS_HOFF_BUCKET, Prefix=prefix)
+    return list(s3_iter_files_for_job(job_id))
 
-    # note that s3 paginates after 1000 objects
-    # we assumes that Hoff / Hemelb jobs only produce a small number of files, so we can get away with this
-    # otherwise we will have to paginate
 
-    if 'Contents' not in result:
-        return []
+def s3_iter_files_for_job(job_id):
+    # the names of a job's files, a page of up to 1000 at a time as s3 returns them
+    s3_client = get_s3_client()
+    prefix = job_id + "/"
+    paginator = s3_client.get_paginator('list_objects')
 
-    keys = []
-    for key in result['Contents']:
-        keys.append(key['Key'].replace(prefix,""))
-    return keys
+    for page in paginator.paginate(Bucket=CIRRUS_WOS_HOFF_BUCKET, Prefix=prefix):
+        for key in page.get('Contents', []):
+            yield key['Key'].replace(prefix,"")
 
 
 def s3_delete_files_for_job(job_id):